@@ -18,6 +18,8 @@ from idlelib.tooltip import Hovertip  # type: ignore
 from .backup_manager import BackupManager
 
 SHALLOW = True
+COPY_WORKERS = 1
+SCRUB_SECONDS = 60
 
 
 class ConsoleFrame(tk.Frame):
@@ -113,7 +115,13 @@ class App(tk.Frame):
         self, master, srcdir, bakdir, *args, log_to_file=False, **kwargs
     ):
         tk.Frame.__init__(self, master, *args, **kwargs)
-        self.manager = BackupManager(srcdir, bakdir, log_to_file)
+        self.manager = BackupManager(
+            srcdir,
+            bakdir,
+            log_to_file,
+            shallow=SHALLOW,
+            copy_workers=COPY_WORKERS,
+        )
         self.logger = logging.getLogger(f"{__name__}.{type(self).__name__}")
         self.master = master
 
@@ -209,6 +217,7 @@ class App(tk.Frame):
             moved, move it in the backup location.
             deleted, delete it in the backup location.
             changed, copy it from the source location to the backup location.
+            only changed attributes, copy the attributes to the backup.
         """
         self.logger.debug(
             "Selecting file in backup. event: %s, index: %s", event, index
@@ -220,6 +229,7 @@ class App(tk.Frame):
         moved_len = len(self.manager.report["moved_files"])
         mis_len = moved_len + len(self.manager.report["mismatched_files"])
         removed_len = mis_len + len(self.manager.report["removed_files"])
+        attr_len = removed_len + len(self.manager.report["attribute_files"])
 
         if index < moved_len:
             filename_set = self.manager.report["moved_files"][index]
@@ -230,6 +240,8 @@ class App(tk.Frame):
             )
         elif index < removed_len:
             failed = self.manager.delete_files([filename])
+        elif index < attr_len:
+            failed = self.manager.sync_attributes([filename])
         if failed:
             self.logger.error("The following files failed: %s", failed)
 
@@ -238,6 +250,13 @@ class App(tk.Frame):
         """Command function to call update_files_a_to_b."""
         self.manager.update_files()
 
+    @launch_task
+    def sync_attributes(self):
+        """Command function to copy attributes of files that still match."""
+        failed = self.manager.sync_attributes()
+        if failed:
+            self.logger.error("The following files failed: %s", failed)
+
     @launch_task
     def delete_files(self):
         """Command function to call delete_files_from_b."""
@@ -248,6 +267,28 @@ class App(tk.Frame):
         """Command function to call move_files_in_b."""
         self.manager.move_files()
 
+    @launch_task
+    def dry_run(self):
+        """Command function to estimate what Sync All would do."""
+        self.logger.info(self.manager.dry_run().summary())
+
+    @launch_task
+    def scrub(self):
+        """Command function to check part of the backup for corruption."""
+        result = self.manager.scrub(time_budget=SCRUB_SECONDS)
+        self.logger.info("Scrub: %s", result.summary())
+        if result.problems:
+            self.logger.error(
+                "The following files failed: %s", result.problems
+            )
+
+    @launch_task
+    def sync_all(self):
+        """Command function to apply every change in one planned pass."""
+        failed = self.manager.sync()
+        if failed:
+            self.logger.error("The following operations failed: %s", failed)
+
     def make_window(self):
         """Create the window layout."""
         self.master.winfo_toplevel().title("Backup Master")
@@ -273,6 +314,10 @@ class App(tk.Frame):
             ("Copy Selected to Backup", self.copy_selected),
             ("Remove from Backup", self.delete_files),
             ("Update in Backup", self.update_files),
+            ("Update Attributes", self.sync_attributes),
+            ("Dry Run", self.dry_run),
+            ("Sync All", self.sync_all),
+            ("Scrub Backup", self.scrub),
         )
         self.console = ConsoleFrame(self, buttons)
 
@@ -290,8 +335,9 @@ class App(tk.Frame):
 
     def finish_open(self):
         """Clean up after selecting new folder."""
-        self.manager.source_directory = self.source_panel.directory
-        self.manager.backup_directory = self.backup_panel.directory
+        self.manager.set_directories(
+            self.source_panel.directory, self.backup_panel.directory
+        )
         with open("last_dirs.log", "w", encoding="utf-8") as log:
             log.write(self.source_panel.directory + "\n")
             log.write(self.backup_panel.directory + "\n")
@@ -334,6 +380,12 @@ class App(tk.Frame):
                 for item in self.manager.report["removed_files"]:
                     self.backup_panel.listing.insert(tk.END, item)
                     self.backup_panel.listing.itemconfig(tk.END, {"bg": "red"})
+            if "attribute_files" in self.manager.report:
+                for item in self.manager.report["attribute_files"]:
+                    self.backup_panel.listing.insert(tk.END, item)
+                    self.backup_panel.listing.itemconfig(
+                        tk.END, {"bg": "light blue"}
+                    )
             if "errors" in self.manager.report:
                 for item in self.manager.report["errors"]:
                     self.logger.error(
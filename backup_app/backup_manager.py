@@ -4,25 +4,82 @@ Compare the current state of a source folder with the current state of the
 backup folder.
 """
 
-import filecmp
 import logging
 import os
+import shutil
+import time
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
 from pprint import pprint
 
+import send2trash  # type: ignore
+
+from .comparison import CompareCache
+from .copying import FastCopier
+from .costmodel import CostModel
+from .delta import delta_update
+from .durability import NONE, DurableWriter
 from .filesystem import (
     copy_files_from_a_to_b,
     delete_files_from_b,
     move_files_in_b,
+    sync_attributes_a_to_b,
     update_files_a_to_b,
 )
+from .hashing import HashCache
+from .index import ScanIndex
+from .journal import CHECKPOINT_BYTES, Journal
+from .planner import (
+    COPY,
+    DELETE,
+    METADATA,
+    MOVE,
+    UPDATE,
+    Operation,
+    filesystem_handlers,
+    plan_sync,
+    run_plan,
+    store_handlers,
+)
+from .quarantine import MAX_AGE, Quarantine
 from .report import Report
+from .scanner import KEYS, build_report, compare_trees, walk_diff
+from .scrubber import CORRUPT, Scrubber
+from .snapshots import SnapshotHistory
+from .sparse import copy2 as sparse_copy2
+from .sparse import sparse_copying
+from .store import ContentStore
+from .sync import StreamingCopier
+from .verify import VerifyingCopier
+from .watcher import Watcher
 
 
 class BackupManager:
     """Manage the scanning of directories and the copying of files."""
 
-    def __init__(self, srcdir, bakdir, log_to_file=False):
+    def __init__(
+        self,
+        srcdir,
+        bakdir,
+        log_to_file=False,
+        use_index=False,
+        scan_workers=1,
+        shallow=True,
+        copy_workers=1,
+        fast_copy=False,
+        delta_threshold=None,
+        use_quarantine=False,
+        quarantine_age=MAX_AGE,
+        quarantine_bytes=None,
+        use_journal=False,
+        checkpoint_bytes=CHECKPOINT_BYTES,
+        durability=NONE,
+        throttle=None,
+        use_store=False,
+        use_snapshots=False,
+        retention=None,
+        verify_copies=False,
+    ):
         self.source_directory = srcdir
         self.backup_directory = bakdir
         self.logger = logging.getLogger(f"{__name__}.{type(self).__name__}")
@@ -33,6 +90,26 @@ class BackupManager:
         else:
             self.log_file = None
         self.report = Report()
+        self.use_index = use_index
+        self.scan_workers = scan_workers
+        self.shallow = shallow
+        self.copy_workers = copy_workers
+        self.copier = FastCopier() if fast_copy else None
+        self.delta_threshold = delta_threshold
+        self.use_quarantine = use_quarantine
+        self.quarantine_age = quarantine_age
+        self.quarantine_bytes = quarantine_bytes
+        self.use_journal = use_journal
+        self.checkpoint_bytes = checkpoint_bytes
+        self.recovered = set()
+        self.durability = durability
+        self.throttle = throttle
+        self.use_store = use_store
+        self.use_snapshots = use_snapshots
+        self.retention = retention
+        self.verify_copies = verify_copies
+        self.compare_cache = CompareCache()
+        self.uncommitted = []
 
     def log(self, msg, pretty=False):
         """Log messages to the session log file."""
@@ -55,6 +132,297 @@ class BackupManager:
                 return self.log(msg, pretty)
         return True
 
+    def set_directories(self, srcdir, bakdir):
+        """Point this manager at a source and a backup folder.
+
+        Cached comparisons are dropped when either folder changes.
+        """
+        if (srcdir, bakdir) != (self.source_directory, self.backup_directory):
+            self.compare_cache.clear()
+        self.source_directory = srcdir
+        self.backup_directory = bakdir
+
+    def copy_options(self):
+        """Return the options this manager passes to the copy functions."""
+        options = {
+            "workers": self.copy_workers,
+            "delta_threshold": self.delta_threshold,
+        }
+        if self.copier is not None:
+            options["copy_function"] = sparse_copying(self.copier.copy2)
+        return options
+
+    def open_quarantine(self):
+        """Open the quarantine of the backup folder."""
+        return Quarantine(
+            self.backup_directory,
+            max_age=self.quarantine_age,
+            max_bytes=self.quarantine_bytes,
+        )
+
+    def open_journal(self):
+        """Open the journal of the backup folder."""
+        return Journal.for_backup(
+            self.backup_directory, checkpoint_bytes=self.checkpoint_bytes
+        )
+
+    @contextmanager
+    def _removal_options(self):
+        """Yield the options used to remove files from the backup folder.
+
+        With the quarantine on, removed files are renamed into it in one
+        batch, which is then purged of entries past the retention limits.
+        """
+        if not self.use_quarantine:
+            yield {"remove_function": send2trash.send2trash}
+            return
+        quarantine = self.open_quarantine()
+        try:
+            with quarantine.batch():
+                yield {"remove_function": quarantine.put}
+            purged = quarantine.purge()
+            if purged:
+                self.logger.info("Purged %d quarantined files", purged)
+        finally:
+            quarantine.close()
+
+    def _change_options(self, verifier=None):
+        options = self.copy_options()
+        if verifier is not None:
+            if self.copier is None:
+                options["copy_function"] = verifier.copy2
+            else:
+                # the fast copier still copies, and its copies are checked
+                options["copy_function"] = verifier.copying(
+                    options["copy_function"]
+                )
+        options.setdefault("copy_function", sparse_copy2)
+        update_function = delta_update
+        if verifier is not None:
+            update_function = verifier.updating(update_function)
+        if self.throttle is not None:
+            options["copy_function"] = self.throttle.copying(
+                options["copy_function"]
+            )
+            update_function = self.throttle.updating(update_function)
+        options["update_function"] = update_function
+        return options
+
+    @contextmanager
+    def _sync_options(self):
+        """Yield the copy options and the move function used to change files
+        in the backup folder.
+
+        With the journal on, each copy, move and removal is recorded in it
+        before it runs, and operations left over from an earlier run are
+        recovered the first time the journal of a backup folder is opened.
+        With a durability mode set, copies are only renamed into place once
+        their data is on disk. With verify_copies on, every copy is read
+        back from disk and checked against the digest of the data copied.
+        Copies the durable writer could not rename into place are listed in
+        self.uncommitted once the block exits. A file being overwritten is
+        only removed once its replacement is complete. Files updated with a
+        delta go through the same journal, durability, verification and
+        throttling as copies.
+        """
+        move_function = shutil.move
+        self.uncommitted = []
+        with ExitStack() as stack:
+            verifier = None
+            if self.verify_copies:
+                verifier = VerifyingCopier()
+                stack.callback(self._close_verifier, verifier)
+            options = self._change_options(verifier)
+            copy_function = options["copy_function"]
+            options.update(stack.enter_context(self._removal_options()))
+            if self.throttle is not None:
+                stack.callback(self._log_throttle)
+                options["remove_function"] = self.throttle.removing(
+                    options["remove_function"]
+                )
+                move_function = self.throttle.moving(move_function)
+            journal = None
+            if self.use_journal:
+                journal = self.open_journal()
+                stack.callback(journal.close)
+                if self.backup_directory not in self.recovered:
+                    self._recover(journal, options)
+            remove_function = options["remove_function"]
+            writer = None
+            if self.durability != NONE:
+                writer = DurableWriter(self.durability, copy_function)
+                stack.callback(self._close_writer, writer)
+                options["copy_function"] = writer.copy2
+                options["replace_function"] = writer.replacing(remove_function)
+                options["remove_function"] = writer.removing(
+                    options["remove_function"]
+                )
+                options["update_function"] = writer.updating(
+                    options["update_function"]
+                )
+                move_function = writer.moving(move_function)
+            if journal is not None:
+                options["copy_function"] = journal.copying(
+                    copy_function, writer
+                )
+                options["replace_function"] = journal.copying(
+                    copy_function, writer, remove_function
+                )
+                options["remove_function"] = journal.removing(
+                    options["remove_function"]
+                )
+                options["update_function"] = journal.updating(
+                    options["update_function"]
+                )
+                move_function = journal.moving(move_function)
+            yield options, move_function
+
+    def _close_verifier(self, verifier):
+        hash_cache = HashCache.for_backup(self.backup_directory)
+        try:
+            verifier.save(hash_cache)
+        finally:
+            hash_cache.close()
+        self.logger.info("Verified copies: %s", verifier.stats())
+
+    def _log_throttle(self):
+        self.logger.info("Throttling: %s", self.throttle.stats())
+
+    def _close_writer(self, writer):
+        writer.close()
+        self.uncommitted = [
+            os.path.normpath(os.path.relpath(dst, self.backup_directory))
+            for dst in writer.take_failed()
+        ]
+        self.logger.info("Durable writes: %s", writer.stats())
+
+    def _uncommitted(self, filenames, failed=()):
+        """Return the filenames whose copies were not committed.
+
+        A folder counts as not committed if any file copied into it was
+        not. Filenames already in failed are left out.
+        """
+        found = []
+        for filename in filenames:
+            if filename in failed:
+                continue
+            prefix = os.path.normpath(filename)
+            for path in self.uncommitted:
+                if path == prefix or path.startswith(prefix + os.sep):
+                    found.append(filename)
+                    break
+        return found
+
+    def _recover(self, journal, options):
+        results = journal.recover(
+            options["copy_function"], options["remove_function"], shutil.move
+        )
+        for kind, src, dst, outcome in results:
+            self.logger.warning(
+                "Recovered %s %s %s: %s", kind, src, dst, outcome
+            )
+        self.recovered.add(self.backup_directory)
+        return results
+
+    def recover(self):
+        """Finish or undo the operations a crash left in the journal.
+
+        Return a list of (kind, src, dst, outcome) tuples.
+        """
+        journal = self.open_journal()
+        try:
+            with self._removal_options() as removal:
+                options = self._change_options()
+                options.update(removal)
+                return self._recover(journal, options)
+        finally:
+            journal.close()
+
+    def _recover_once(self):
+        if self.use_journal and self.backup_directory not in self.recovered:
+            self.recover()
+
+    def open_store(self):
+        """Open the content store of the backup folder."""
+        return ContentStore(self.backup_directory)
+
+    def _collect_garbage(self, store):
+        freed = store.collect_garbage()
+        self.logger.info("Content store: %s", store.stats())
+        if freed:
+            self.logger.info("Freed %d bytes of unused chunks", freed)
+
+    def _apply_to_store(self, kind, filenames):
+        """Run one kind of operation on files in the content store.
+
+        Return the files it failed for.
+        """
+        failed = []
+        store = self.open_store()
+        try:
+            handlers = store_handlers(
+                self.source_directory, self.backup_directory, store
+            )
+            for filename in filenames:
+                try:
+                    path, target = (
+                        filename if kind == MOVE else (filename, None)
+                    )
+                    if not handlers[kind](Operation(kind, path, target)):
+                        failed.append(filename)
+                except OSError:
+                    failed.append(filename)
+            self._collect_garbage(store)
+        finally:
+            store.close()
+        return failed
+
+    def restore_stored(self, filename, dest):
+        """Write a file or folder of the content store out to dest.
+
+        Return dest.
+        """
+        store = self.open_store()
+        try:
+            return store.restore(filename, dest)
+        finally:
+            store.close()
+
+    def open_history(self):
+        """Return the snapshot history of the backup folder."""
+        return SnapshotHistory(self.backup_directory, self.retention)
+
+    def snapshot(self):
+        """Take a dated snapshot of the source folder from the report.
+
+        Files the report does not list as added or changed are hard-linked
+        to the snapshot the report was made against, then old snapshots
+        are thinned out. Return the relative paths that failed to copy.
+        """
+        history = self.open_history()
+        path, failed = history.create(
+            self.report,
+            self.source_directory,
+            self._change_options()["copy_function"],
+        )
+        history.thin()
+        for key in ("moved_files", "removed_files", "mismatched_files"):
+            self.report[key] = []
+        self.report["added_files"] = failed
+        self.report.backup = path
+        return failed
+
+    def restore_file(self, filename, entry_id=None):
+        """Put a quarantined file back in the backup folder.
+
+        Return the restored path.
+        """
+        quarantine = self.open_quarantine()
+        try:
+            return quarantine.restore(filename, entry_id=entry_id)
+        finally:
+            quarantine.close()
+
     def copy_files_from_source_to_backup(self, filenames, overwrite=False):
         """Copy files from source folder to backup folder.
 
@@ -72,12 +440,18 @@ class BackupManager:
         # os.path.abspath(os.path.join(self.backup_directory,
         # filename)))
         # abs_filenames.append(abs_filename)
-        failed = copy_files_from_a_to_b(
-            self.source_directory,
-            self.backup_directory,
-            filenames,
-            overwrite=overwrite,
-        )
+        if self.use_store:
+            failed = self._apply_to_store(COPY, filenames)
+        else:
+            with self._sync_options() as (options, _):
+                failed = copy_files_from_a_to_b(
+                    self.source_directory,
+                    self.backup_directory,
+                    filenames,
+                    overwrite=overwrite,
+                    **options,
+                )
+            failed += self._uncommitted(filenames, failed)
 
         failed_set = set(failed)
         copied_set = set(filenames) - failed_set
@@ -100,11 +474,17 @@ class BackupManager:
 
         Return filenames that were not copied.
         """
-        failed = copy_files_from_a_to_b(
-            self.source_directory,
-            self.backup_directory,
-            self.report["added_files"],
-        )
+        if self.use_store:
+            failed = self._apply_to_store(COPY, self.report["added_files"])
+        else:
+            with self._sync_options() as (options, _):
+                failed = copy_files_from_a_to_b(
+                    self.source_directory,
+                    self.backup_directory,
+                    self.report["added_files"],
+                    **options,
+                )
+            failed += self._uncommitted(self.report["added_files"], failed)
         self.report["added_files"] = failed
         return failed
 
@@ -113,14 +493,46 @@ class BackupManager:
 
         Return filenames that were not updated.
         """
-        failed = update_files_a_to_b(
-            self.source_directory,
-            self.backup_directory,
-            self.report["mismatched_files"],
-        )
+        if self.use_store:
+            failed = self._apply_to_store(
+                UPDATE, self.report["mismatched_files"]
+            )
+        else:
+            with self._sync_options() as (options, _):
+                failed = update_files_a_to_b(
+                    self.source_directory,
+                    self.backup_directory,
+                    self.report["mismatched_files"],
+                    **options,
+                )
+            failed += self._uncommitted(
+                self.report["mismatched_files"], failed
+            )
         self.report["mismatched_files"] = failed
         return failed
 
+    def sync_attributes(self, files_to_sync=None):
+        """Copy the attributes of files whose contents already match.
+
+        Return filenames whose attributes were not copied.
+        """
+        if files_to_sync is None:
+            files_to_sync = self.report["attribute_files"]
+        if self.use_store:
+            failed = self._apply_to_store(METADATA, files_to_sync)
+        else:
+            failed = sync_attributes_a_to_b(
+                self.source_directory,
+                self.backup_directory,
+                files_to_sync,
+            )
+
+        failed_set = set(failed)
+        synced_set = set(files_to_sync) - failed_set
+        for file in synced_set:
+            self.report["attribute_files"].remove(file)
+        return failed
+
     def delete_files(self, files_to_delete=None):
         """Delete files that were removed from the source directory.
 
@@ -128,7 +540,15 @@ class BackupManager:
         """
         if files_to_delete is None:
             files_to_delete = self.report["removed_files"]
-        failed = delete_files_from_b(self.backup_directory, files_to_delete)
+        if self.use_store:
+            failed = self._apply_to_store(DELETE, files_to_delete)
+        else:
+            with self._sync_options() as (options, _):
+                failed = delete_files_from_b(
+                    self.backup_directory,
+                    files_to_delete,
+                    remove_function=options["remove_function"],
+                )
 
         failed_set = set(failed)
         deleted_set = set(files_to_delete) - failed_set
@@ -143,7 +563,11 @@ class BackupManager:
         """
         if files_to_move is None:
             files_to_move = self.report["moved_files"]
-        failed = move_files_in_b(files_to_move)
+        if self.use_store:
+            failed = self._apply_to_store(MOVE, files_to_move)
+        else:
+            with self._sync_options() as (_, move_function):
+                failed = move_files_in_b(files_to_move, move_function)
 
         failed_set = set(failed)
         moved_set = set(files_to_move) - failed_set
@@ -151,61 +575,281 @@ class BackupManager:
             self.report["moved_files"].remove(file)
         return failed
 
+    def plan(self):
+        """Return the SyncPlan that would apply the report to the backup."""
+        return plan_sync(self.report, self.backup_directory)
+
+    def dry_run(self):
+        """Return a PlanEstimate of what sync would do, changing nothing.
+
+        The estimated time uses the throughput and per-file overhead
+        measured in earlier syncs to the same backup folder.
+        """
+        model = CostModel.for_backup(self.backup_directory)
+        estimate = model.estimate(self.plan(), self.source_directory)
+        self.logger.info("Dry run:\n%s", estimate.summary())
+        return estimate
+
+    def sync(self):
+        """Apply the whole report to the backup folder in one planned pass.
+
+        Independent operations run on up to self.copy_workers threads. The
+        time taken is recorded to calibrate later dry runs. In snapshot
+        mode, a new snapshot is taken instead.
+        Return the operations that failed or were skipped.
+        """
+        if self.use_snapshots:
+            return [Operation(COPY, relpath) for relpath in self.snapshot()]
+        plan = self.plan()
+        model = CostModel.for_backup(self.backup_directory)
+        estimate = model.estimate(plan, self.source_directory)
+        start = time.monotonic()
+        if self.use_store:
+            store = self.open_store()
+            try:
+                handlers = store_handlers(
+                    self.source_directory, self.backup_directory, store
+                )
+                failed = set(run_plan(plan, handlers, self.copy_workers))
+                self._collect_garbage(store)
+            finally:
+                store.close()
+        else:
+            with self._sync_options() as (options, move_function):
+                handlers = filesystem_handlers(
+                    self.source_directory,
+                    self.backup_directory,
+                    move_function,
+                    **dict(options, workers=1),
+                )
+                failed = set(run_plan(plan, handlers, self.copy_workers))
+            for index, operation in enumerate(plan):
+                if operation.kind in (COPY, UPDATE):
+                    if self._uncommitted([operation.path]):
+                        failed.add(index)
+        if len(plan):
+            model.record(
+                estimate.bytes, estimate.files, time.monotonic() - start
+            )
+            model.save()
+        keys = {
+            COPY: "added_files",
+            UPDATE: "mismatched_files",
+            METADATA: "attribute_files",
+            DELETE: "removed_files",
+        }
+        for index, operation in enumerate(plan):
+            if index in failed:
+                continue
+            if operation.kind == MOVE:
+                self.report["moved_files"].discard(
+                    (operation.path, operation.target)
+                )
+            elif operation.kind in keys:
+                self.report[keys[operation.kind]].discard(operation.path)
+        for relpath, move in plan.dropped:
+            if move not in failed:
+                self.report["added_files"].discard(relpath)
+        return [plan.operations[index] for index in sorted(failed)]
+
+    def scrub(self, time_budget=None, byte_budget=None):
+        """Check the next part of the backup folder for corrupt files.
+
+        Files are re-read and compared with the digests recorded when they
+        were copied or scanned, until the time or byte budget is spent;
+        the next call continues from there. Reads are limited by
+        self.throttle, if set. Corrupt and unreadable files are added to
+        the errors of the report, and corrupt files still in the source
+        folder to mismatched_files, so update_files copies them again.
+        Return the ScrubResult.
+        """
+        hash_cache = HashCache.for_backup(self.backup_directory)
+        try:
+            result = Scrubber(
+                self.backup_directory,
+                hash_cache,
+                time_budget,
+                byte_budget,
+                self.throttle,
+            ).run()
+        finally:
+            hash_cache.close()
+        for key in ("errors", "mismatched_files"):
+            if key not in self.report:
+                self.report[key] = []
+        for relpath, problem in result.problems:
+            if relpath not in self.report["errors"]:
+                self.report["errors"].append(relpath)
+            source = os.path.join(self.source_directory, relpath)
+            if problem == CORRUPT and os.path.isfile(source):
+                if relpath not in self.report["mismatched_files"]:
+                    self.report["mismatched_files"].append(relpath)
+        return result
+
+    def watch(self):
+        """Return a started Watcher that keeps self.report up to date."""
+        return Watcher(self).start()
+
+    @contextmanager
+    def _scan_caches(self):
+        """Open the scan index and hash cache this manager is set up for."""
+        index = None
+        hash_cache = None
+        if self.use_index:
+            index = ScanIndex.for_backup(self.backup_directory)
+        if not self.shallow:
+            hash_cache = HashCache.for_backup(self.backup_directory)
+        try:
+            yield index, hash_cache
+        finally:
+            if self.throttle is not None:
+                self._log_throttle()
+            self.logger.info("Compare cache: %s", self.compare_cache.stats())
+            if hash_cache is not None:
+                self.logger.info("Hash cache: %s", hash_cache.stats())
+                hash_cache.close()
+            if index is not None:
+                self.logger.info(
+                    "Index reused %d of %d directories",
+                    index.hits,
+                    index.hits + index.misses,
+                )
+                index.close()
+
     def scan(self, srcdir, bakdir):
-        """Scan the source and backup directories and display results."""
-        self.source_directory = srcdir
-        self.backup_directory = bakdir
-        self.report = self.compare_directories(
-            self.source_directory, self.backup_directory
-        ).examine()
+        """Scan the source and backup directories and display results.
+
+        In snapshot mode, the source is compared with the newest snapshot.
+        With the journal on, operations a crash left unfinished are
+        recovered first, so their temporary files are not listed.
+        """
+        self.set_directories(srcdir, bakdir)
+        self._recover_once()
+        with self._scan_caches() as (index, hash_cache):
+            if self.use_store:
+                self.report = self._scan_store(hash_cache)
+            else:
+                backup = self.backup_directory
+                if self.use_snapshots:
+                    backup = self.open_history().base()
+                self.report = self.compare_directories(
+                    self.source_directory,
+                    backup,
+                    shallow=self.shallow,
+                    index=index,
+                    hash_cache=hash_cache,
+                ).examine()
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(
+                "Apparent and allocated bytes: %s",
+                self.report.size_summary(),
+            )
+        self.log(self.report, True)
+
+    def _scan_store(self, hash_cache=None):
+        """Compare the source folder with the manifest of the content store.
+
+        Files are compared by the digest recorded in the manifest, so the
+        stored chunks are never read. Moves are not looked for: the chunks
+        of a moved file are already stored, so copying it again only adds a
+        manifest entry.
+        """
+        self.logger.info(
+            "Comparing %s with the content store of %s",
+            self.source_directory,
+            self.backup_directory,
+        )
+        store = self.open_store()
+        try:
+            report = build_report(
+                walk_diff(
+                    self.source_directory,
+                    store,
+                    shallow=self.shallow,
+                    workers=self.scan_workers,
+                    hash_cache=hash_cache,
+                    throttle=self.throttle,
+                ),
+                self.source_directory,
+                self.backup_directory,
+            )
+        finally:
+            store.close()
+        report["moved_files"] = []
+        return report
+
+    def scan_and_copy(self, srcdir, bakdir):
+        """Scan the directories and copy added files as they are found.
+
+        Added files are copied without waiting for move detection, so a
+        moved file is copied to its new location and its old copy is left
+        under removed_files. Only files that failed to copy are left under
+        added_files.
+        """
+        self.set_directories(srcdir, bakdir)
+        self._recover_once()
+        with self._sync_options() as (options, _):
+            copier = StreamingCopier(srcdir, bakdir, **options)
+            with self._scan_caches() as (index, hash_cache):
+                events = walk_diff(
+                    srcdir,
+                    bakdir,
+                    shallow=self.shallow,
+                    index=index,
+                    workers=self.scan_workers,
+                    hash_cache=hash_cache,
+                    throttle=self.throttle,
+                    compare_cache=self.compare_cache,
+                )
+                self.report = build_report(
+                    copier.filter(events), srcdir, bakdir
+                )
+        self.report["added_files"] = copier.failed + [
+            relpath
+            for relpath in self.uncommitted
+            if relpath not in copier.failed
+        ]
+        self.report.examine()
+        self.logger.info("Copied %d files while scanning", copier.copied)
         self.log(self.report, True)
 
-    def compare_directories(self, dira, dirb, recursing=False, shallow=True):
-        """Compare source and backup directories."""
+    def compare_directories(
+        self,
+        dira,
+        dirb,
+        recursing=False,
+        shallow=True,
+        index=None,
+        hash_cache=None,
+    ):
+        """Compare source and backup directories.
+
+        If an index is given, directories that did not change since the
+        last indexed scan are not listed or compared again. Subtrees are
+        compared by up to self.scan_workers threads. In deep mode, a hash
+        cache lets unchanged files be compared without reading them, and
+        self.compare_cache keeps the results of earlier comparisons. Reads
+        are limited by self.throttle, if set.
+        """
         if not dira or not dirb:
             self.logger.error("Invalid comparison directories")
             return None
-        simple_report = Report({}, source=dira, backup=dirb)
-        # compare directories (This uses shallow comparison!!)
-        dirs_cmp = filecmp.dircmp(dira, dirb)
-        # Identify files that are only in dira
-        simple_report["added_files"] = dirs_cmp.left_only[:]
-        # Identify files that are only in dirb
-        simple_report["removed_files"] = dirs_cmp.right_only[:]
-        # For files in both, do a deep comparison using filecmp
-        (
-            simple_report["matched_files"],
-            simple_report["mismatched_files"],
-            simple_report["errors"],
-        ) = filecmp.cmpfiles(
-            dira, dirb, dirs_cmp.common_files, shallow=shallow
+        if not recursing:
+            self.logger.info("Comparing %s with %s", dira, dirb)
+        return compare_trees(
+            dira,
+            dirb,
+            shallow=shallow,
+            index=index,
+            workers=self.scan_workers,
+            hash_cache=hash_cache,
+            throttle=self.throttle,
+            compare_cache=self.compare_cache,
         )
 
-        # Check subfolders
-        sub_report = self.check_subfolders(
-            dira, dirb, dirs_cmp.common_dirs, recursing
-        )
-        keys = (
-            "added_files",
-            "removed_files",
-            "matched_files",
-            "mismatched_files",
-            "errors",
-        )
-        for key in keys:
-            for item in sub_report[key]:
-                simple_report[key].append(item)
-        return simple_report
-
     def check_subfolders(self, dira, dirb, common_dirs, recursing=False):
         """Check subfolders of common directories."""
-        report = {
-            "added_files": [],
-            "removed_files": [],
-            "matched_files": [],
-            "mismatched_files": [],
-            "errors": [],
-        }
+        report = {key: [] for key in KEYS}
         for common_dir in common_dirs:
             new_dira = os.path.join(dira, common_dir)
             new_dirb = os.path.join(dirb, common_dir)
@@ -216,18 +860,7 @@ class BackupManager:
                 self.logger.info("Checking subfolder: %s", new_dira)
 
             # add sub report to overall report
-            for key in (
-                "added_files",
-                "removed_files",
-                "matched_files",
-                "mismatched_files",
-                "errors",
-            ):
+            for key in KEYS:
                 for item in sub_report[key]:
                     report[key].append(os.path.join(common_dir, item))
-
-        #    for adir in dirs_cmp.left_only:
-        #        if os.path.isdir(adir):
-        #            for sub in [x[0] for x in os.walk(adir)]:
-        #                report['added_files'].append(sub)
         return report
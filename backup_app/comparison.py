@@ -0,0 +1,95 @@
+"""This script caches the results of file comparisons in memory
+
+Results are keyed on the paths and stat signatures of both files (inode,
+size and mtime_ns), so a result is only reused while neither file changed.
+The cache holds a bounded number of results and evicts the least recently
+used one first, unlike the module-level cache of filecmp, which grows for
+as long as the process runs. Modification times are compared with the
+tolerance shared by the scanner and the tree fingerprints.
+"""
+
+import threading
+from collections import OrderedDict
+
+MAX_ENTRIES = 65536
+# FAT keeps modification times to 2 seconds, so a backup on it can never
+# reproduce the exact mtime of the source
+MTIME_TOLERANCE_NS = 2 * 10**9
+
+
+def mtimes_match(mtime_a_ns, mtime_b_ns):
+    """Return True if two modification times count as equal.
+
+    Times within MTIME_TOLERANCE_NS of each other match, as filesystems
+    store them with different precision.
+    """
+    return abs(mtime_a_ns - mtime_b_ns) < MTIME_TOLERANCE_NS
+
+
+def stat_key(stat_result):
+    """Return the part of a stat result a cached comparison depends on."""
+    return (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+
+
+class CompareCache:
+    """A bounded LRU cache of file comparison results.
+
+    Arguments:
+    max_entries -- number of results kept before the oldest are evicted
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(path_a, stat_a, path_b, stat_b):
+        """Return the key of the comparison of two files."""
+        return (path_a, stat_key(stat_a), path_b, stat_key(stat_b))
+
+    def lookup(self, key):
+        """Return the cached result for a key, or None."""
+        with self.lock:
+            result = self.results.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self.results.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def store(self, key, result):
+        """Cache a result, evicting the least recently used if full."""
+        with self.lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            while len(self.results) > self.max_entries:
+                self.results.popitem(last=False)
+                self.evictions += 1
+
+    def compare(self, key, function):
+        """Return the cached result for a key, or call function for it."""
+        result = self.lookup(key)
+        if result is None:
+            result = function()
+            self.store(key, result)
+        return result
+
+    def clear(self):
+        """Forget every cached result, keeping the counters."""
+        with self.lock:
+            self.results.clear()
+
+    def stats(self):
+        """Return the hit, miss and eviction counters and the size."""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.results),
+            }
@@ -0,0 +1,164 @@
+"""This script copies file data with as little userspace work as possible
+
+Each copy first tries a reflink clone (FICLONE), which shares the data
+blocks on btrfs and XFS, then os.copy_file_range, then os.sendfile, and
+finally a large-buffer read/write loop. Metadata is copied as shutil.copy2
+does.
+"""
+
+import errno
+import logging
+import os
+import shutil
+import threading
+from collections import Counter
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None  # type: ignore
+
+FICLONE = 0x40049409
+BUFFER_SIZE = 1024 * 1024
+METHODS = ("reflink", "copy_file_range", "sendfile", "readwrite")
+# errors that mean a method is not supported for this pair of files
+UNSUPPORTED = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSOCK,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EXDEV,
+    errno.ETXTBSY,
+}
+
+
+def _reflink(src_fd, dst_fd, size, progress=None):
+    # a clone shares the data blocks, so no bytes count as copied
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflink is not available")
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _copy_file_range(src_fd, dst_fd, size, progress=None):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    step = size if progress is None else BUFFER_SIZE
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(src_fd, dst_fd, min(step, size - copied))
+        if count == 0:
+            break
+        copied += count
+        if progress is not None:
+            progress(count)
+
+
+def _sendfile(src_fd, dst_fd, size, progress=None):
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "sendfile is not available")
+    step = size if progress is None else BUFFER_SIZE
+    copied = 0
+    while copied < size:
+        count = os.sendfile(dst_fd, src_fd, copied, min(step, size - copied))
+        if count == 0:
+            break
+        copied += count
+        if progress is not None:
+            progress(count)
+
+
+def _readwrite(src_fd, dst_fd, size, progress=None):
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(src_fd, "rb", buffering=0, closefd=False) as src:
+        while count := src.readinto(buffer):
+            written = 0
+            while written < count:
+                written += os.write(dst_fd, view[written:count])
+            if progress is not None:
+                progress(count)
+
+
+COPIERS = {
+    "reflink": _reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _sendfile,
+    "readwrite": _readwrite,
+}
+
+
+def _preallocate(dst_fd, size):
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(dst_fd, 0, size)
+        except OSError:
+            pass
+
+
+def _rewind(src_fd, dst_fd):
+    os.lseek(src_fd, 0, os.SEEK_SET)
+    os.lseek(dst_fd, 0, os.SEEK_SET)
+    os.ftruncate(dst_fd, 0)
+
+
+def copy_data(src, dst, methods=METHODS, progress=None):
+    """Copy the contents of src to dst with the first method that works.
+
+    The destination is preallocated before any method that writes data.
+    If progress is given, methods that move data do so in chunks and call
+    it with the number of bytes of each. Return the name of the method used.
+    """
+    src_fd = os.open(src, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(
+            dst,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+            0o666,
+        )
+        try:
+            for method in methods:
+                if method != "reflink":
+                    _preallocate(dst_fd, size)
+                try:
+                    COPIERS[method](src_fd, dst_fd, size, progress)
+                except OSError as error:
+                    if error.errno not in UNSUPPORTED:
+                        raise
+                    _rewind(src_fd, dst_fd)
+                    continue
+                return method
+            raise OSError(errno.ENOSYS, "no copy method worked", src)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+class FastCopier:
+    """Copies files with kernel offloading and records the method used."""
+
+    def __init__(self, methods=METHODS):
+        self.methods = methods
+        self.used = {}
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(f"{__name__}.{type(self).__name__}")
+
+    def copy2(self, src, dst, progress=None):
+        """Copy a file and its metadata, like shutil.copy2.
+
+        progress is passed on to copy_data.
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        method = copy_data(src, dst, self.methods, progress)
+        shutil.copystat(src, dst)
+        self.logger.debug("%s copied with %s", dst, method)
+        with self.lock:
+            self.used[dst] = method
+            self.counts[method] += 1
+        return dst
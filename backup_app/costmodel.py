@@ -0,0 +1,162 @@
+"""This script estimates how long a sync plan will take to run
+
+A plan is summarised by the bytes it transfers, the number of operations
+of each kind and a histogram of file sizes. The time is estimated as
+bytes / throughput + files * overhead. Both parameters are fitted by least
+squares to the runs recorded for the backup folder, which are kept in a
+JSON file in its metadata folder.
+"""
+
+import json
+import os
+from collections import Counter
+from datetime import timedelta
+
+from .filesystem import file_sizes
+from .metadata import metadata_path
+from .planner import COPY, KINDS, UPDATE
+
+MODEL_NAME = "cost_model.json"
+THROUGHPUT = 100 * 1024 * 1024
+OVERHEAD = 0.005
+MAX_RUNS = 50
+HISTOGRAM = (
+    ("< 4 KiB", 4 * 1024),
+    ("< 64 KiB", 64 * 1024),
+    ("< 1 MiB", 1024 * 1024),
+    ("< 16 MiB", 16 * 1024 * 1024),
+    ("< 256 MiB", 256 * 1024 * 1024),
+    (">= 256 MiB", None),
+)
+
+
+def _size_bucket(size):
+    for label, limit in HISTOGRAM:
+        if limit is None or size < limit:
+            return label
+    return None
+
+
+class PlanEstimate:
+    """The size and expected duration of a sync plan."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.files = 0
+        self.counts = Counter({kind: 0 for kind in KINDS})
+        self.histogram = {label: 0 for label, _ in HISTOGRAM}
+        self.seconds = 0.0
+
+    @property
+    def eta(self):
+        """The estimated wall time as a timedelta."""
+        return timedelta(seconds=round(self.seconds))
+
+    def summary(self):
+        """Return a few lines describing the plan."""
+        counts = ", ".join(
+            f"{count} {kind}" for kind, count in self.counts.items() if count
+        )
+        histogram = ", ".join(
+            f"{label}: {count}"
+            for label, count in self.histogram.items()
+            if count
+        )
+        return (
+            f"{counts or 'nothing to do'}\n"
+            f"{self.bytes} bytes in {self.files} files ({histogram})\n"
+            f"estimated time: {self.eta}"
+        )
+
+    def __repr__(self):
+        return (
+            f"PlanEstimate(bytes={self.bytes}, files={self.files}, "
+            f"seconds={self.seconds:.1f})"
+        )
+
+
+class CostModel:
+    """Predicts sync times from the runs recorded for one backup folder.
+
+    Arguments:
+    path -- JSON file the runs are kept in, or None to keep them in memory
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.runs = []
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as filein:
+                    self.runs = json.load(filein)["runs"]
+            except (OSError, ValueError, KeyError):
+                self.runs = []
+        self.throughput, self.overhead = self.fit()
+
+    @classmethod
+    def for_backup(cls, backup_root):
+        """Open the cost model stored in a backup folder."""
+        return cls(metadata_path(backup_root, MODEL_NAME))
+
+    def fit(self):
+        """Return (throughput, overhead) fitted to the recorded runs.
+
+        seconds = bytes * a + files * b is solved by least squares for a
+        and b. The defaults are used where the runs cannot tell them apart.
+        """
+        sbb = sum(run["bytes"] ** 2 for run in self.runs)
+        sff = sum(run["files"] ** 2 for run in self.runs)
+        sbf = sum(run["bytes"] * run["files"] for run in self.runs)
+        sbt = sum(run["bytes"] * run["seconds"] for run in self.runs)
+        sft = sum(run["files"] * run["seconds"] for run in self.runs)
+        det = sbb * sff - sbf * sbf
+        if det > 1e-9 * sbb * sff:
+            per_byte = (sbt * sff - sft * sbf) / det
+            per_file = (sbb * sft - sbf * sbt) / det
+            if per_byte > 0 and per_file >= 0:
+                return 1 / per_byte, per_file
+        if sbb:
+            remaining = sbt - OVERHEAD * sbf
+            if remaining > 0:
+                return sbb / remaining, OVERHEAD
+        return THROUGHPUT, OVERHEAD
+
+    def predict(self, nbytes, files):
+        """Return the expected seconds to transfer nbytes in files."""
+        return nbytes / self.throughput + files * self.overhead
+
+    def estimate(self, plan, source):
+        """Return a PlanEstimate of a SyncPlan.
+
+        Copies and updates are sized from the source folder. Every other
+        operation only counts towards the per-file overhead.
+        """
+        estimate = PlanEstimate()
+        for operation in plan:
+            estimate.counts[operation.kind] += 1
+            if operation.kind not in (COPY, UPDATE):
+                estimate.files += 1
+                continue
+            try:
+                sizes = list(file_sizes(os.path.join(source, operation.path)))
+            except OSError:
+                sizes = []
+            for size in sizes:
+                estimate.histogram[_size_bucket(size)] += 1
+            estimate.bytes += sum(sizes)
+            estimate.files += max(1, len(sizes))
+        estimate.seconds = self.predict(estimate.bytes, estimate.files)
+        return estimate
+
+    def record(self, nbytes, files, seconds):
+        """Add a finished run and fit the model again."""
+        self.runs.append({"bytes": nbytes, "files": files, "seconds": seconds})
+        del self.runs[:-MAX_RUNS]
+        self.throughput, self.overhead = self.fit()
+
+    def save(self):
+        """Write the recorded runs to the JSON file."""
+        if self.path is None:
+            return
+        with open(self.path, "w", encoding="utf-8") as out:
+            json.dump({"runs": self.runs}, out)
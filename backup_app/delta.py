@@ -0,0 +1,216 @@
+"""This script rewrites only the changed blocks of a large file
+
+The backup copy is split into fixed-size blocks, each signed with a weak
+Adler-32 checksum and a strong BLAKE2b digest, as rsync does. The source
+is searched for those blocks with a rolling checksum. If every block that
+is still present sits at its old offset, only the other data is written,
+in place. Otherwise the new file is assembled in a temporary file that is
+renamed over the backup copy.
+"""
+
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import zlib
+
+BLOCK_SIZE = 64 * 1024
+MAX_LITERAL_RATIO = 0.5
+ADLER_MOD = 65521
+COPY = "copy"
+LITERAL = "literal"
+
+
+def use_delta(src, dst, threshold):
+    """Return True if dst should be updated from src with a delta."""
+    if threshold is None:
+        return False
+    try:
+        smallest = min(os.path.getsize(src), os.path.getsize(dst))
+    except OSError:
+        return False
+    return smallest >= threshold
+
+
+def _strong(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def block_signatures(path, block_size=BLOCK_SIZE):
+    """Return {weak checksum: {strong digest: [block indexes]}} for a file.
+
+    A block repeated in the file, such as a run of zeros, lists every
+    index it is found at.
+    """
+    signatures = {}
+    with open(path, "rb") as filein:
+        index = 0
+        while block := filein.read(block_size):
+            strong = signatures.setdefault(zlib.adler32(block), {})
+            strong.setdefault(_strong(block), []).append(index)
+            index += 1
+    return signatures
+
+
+def _match(data, start, end, signatures, weak=None, block_size=None):
+    candidates = signatures.get(
+        zlib.adler32(data[start:end]) if weak is None else weak
+    )
+    if not candidates:
+        return None
+    indexes = candidates.get(_strong(data[start:end]))
+    if not indexes:
+        return None
+    # a block found at its own offset keeps the update in place
+    if block_size and not start % block_size:
+        if start // block_size in indexes:
+            return start // block_size
+    return indexes[0]
+
+
+def compute_delta(data, signatures, block_size, tail_size, max_literal):
+    """Return the operations that rebuild data from the signed blocks.
+
+    Arguments:
+    data -- contents of the source file
+    signatures -- block signatures of the backup copy
+    block_size -- size of the signed blocks
+    tail_size -- size of the last, short block of the backup copy, if any
+    max_literal -- give up once more than this many bytes are not found
+
+    Operations are (COPY, block index, length) and (LITERAL, source offset,
+    length) tuples. Return None if too little of the data was found.
+    """
+    ops = []
+    size = len(data)
+    literal = 0
+    literal_start = 0
+    pos = 0
+    weak = None
+
+    def flush(end):
+        if end > literal_start:
+            ops.append((LITERAL, literal_start, end - literal_start))
+
+    while pos + block_size <= size:
+        if weak is None:
+            weak = zlib.adler32(data[pos : pos + block_size])
+        index = _match(
+            data, pos, pos + block_size, signatures, weak, block_size
+        )
+        if index is not None:
+            flush(pos)
+            ops.append((COPY, index, block_size))
+            pos += block_size
+            literal_start = pos
+            weak = None
+            continue
+        literal += 1
+        if literal > max_literal:
+            return None
+        if pos + block_size == size:
+            pos += 1
+            break
+        # roll the Adler-32 checksum one byte forward
+        out_byte, in_byte = data[pos], data[pos + block_size]
+        low = (weak & 0xFFFF) - out_byte + in_byte
+        high = (weak >> 16) - block_size * out_byte + low - 1
+        weak = ((high % ADLER_MOD) << 16) | (low % ADLER_MOD)
+        pos += 1
+    tail_start = size - tail_size
+    index = None
+    if tail_size and tail_start >= literal_start:
+        index = _match(
+            data, tail_start, size, signatures, block_size=block_size
+        )
+    if index is not None:
+        flush(tail_start)
+        ops.append((COPY, index, tail_size))
+    else:
+        flush(size)
+    if sum(op[2] for op in ops if op[0] == LITERAL) > max_literal:
+        return None
+    return ops
+
+
+def _aligned(ops, block_size):
+    offset = 0
+    for kind, start, length in ops:
+        if kind == COPY and start * block_size != offset:
+            return False
+        offset += length
+    return True
+
+
+def _apply_in_place(data, ops, dst):
+    written = 0
+    offset = 0
+    with open(dst, "r+b") as out:
+        for kind, start, length in ops:
+            if kind == LITERAL:
+                out.seek(offset)
+                out.write(data[start : start + length])
+                written += length
+            offset += length
+        out.truncate(len(data))
+    return written
+
+
+def _apply_to_temp(data, ops, dst, block_size):
+    folder, name = os.path.split(dst)
+    with tempfile.NamedTemporaryFile(
+        dir=folder or None, prefix=f".{name}.", delete=False
+    ) as out:
+        try:
+            with open(dst, "rb") as old:
+                for kind, start, length in ops:
+                    if kind == COPY:
+                        old.seek(start * block_size)
+                        out.write(old.read(length))
+                    else:
+                        out.write(data[start : start + length])
+        except BaseException:
+            out.close()
+            os.remove(out.name)
+            raise
+    os.replace(out.name, dst)
+    return len(data)
+
+
+def delta_update(
+    src, dst, block_size=BLOCK_SIZE, max_literal_ratio=MAX_LITERAL_RATIO
+):
+    """Update dst to match src, writing only data that changed.
+
+    Arguments:
+    src -- path of the new version
+    dst -- path of the old version, which is updated
+    block_size -- size of the compared blocks
+    max_literal_ratio -- give up if more than this share of src is new
+
+    Return the number of bytes written, or None if dst was left alone
+    because too much changed for a delta to pay off.
+    """
+    signatures = block_signatures(dst, block_size)
+    tail_size = os.path.getsize(dst) % block_size
+    with open(src, "rb") as filein:
+        size = os.fstat(filein.fileno()).st_size
+        if not size:
+            return None
+        with mmap.mmap(filein.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            ops = compute_delta(
+                data,
+                signatures,
+                block_size,
+                tail_size,
+                int(size * max_literal_ratio),
+            )
+            if ops is None:
+                return None
+            if _aligned(ops, block_size):
+                written = _apply_in_place(data, ops, dst)
+            else:
+                written = _apply_to_temp(data, ops, dst, block_size)
+    shutil.copystat(src, dst)
+    return written
@@ -0,0 +1,251 @@
+"""This script makes files written to the backup folder durable
+
+Copies are written to a temporary file next to their destination. In
+batched mode, the data of a group of files is fsynced together once the
+group holds batch_files files or is batch_ms milliseconds old. The files
+are then renamed into place and every directory touched is fsynced once.
+Strict mode does the same for each file on its own, and none mode only
+copies. A file that cannot be committed has its temporary file removed
+and is listed in failed, without holding up the rest of its batch.
+"""
+
+import itertools
+import logging
+import os
+import shutil
+import threading
+import time
+
+NONE, BATCHED, STRICT = "none", "batched", "strict"
+MODES = (NONE, BATCHED, STRICT)
+BATCH_FILES = 64
+BATCH_MS = 200
+
+
+def fsync_path(path):
+    """Flush a file or directory to disk, if the platform allows it."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _replace(temp, dst, remove_function=None):
+    if remove_function is not None and os.path.lexists(dst):
+        remove_function(dst)
+    os.replace(temp, dst)
+
+
+def _folder(path):
+    return os.path.dirname(os.path.abspath(path))
+
+
+class DurableWriter:
+    """Commits copied files to disk in groups of fsyncs.
+
+    Arguments:
+    mode -- NONE, BATCHED or STRICT
+    copy_function -- function writing the data, shutil.copy2 by default
+    batch_files -- number of files fsynced together in batched mode
+    batch_ms -- age in milliseconds after which a batch is fsynced
+    """
+
+    def __init__(
+        self,
+        mode=BATCHED,
+        copy_function=shutil.copy2,
+        batch_files=BATCH_FILES,
+        batch_ms=BATCH_MS,
+    ):
+        if mode not in MODES:
+            raise ValueError(f"unknown durability mode: {mode}")
+        self.mode = mode
+        self.copy_function = copy_function
+        self.batch_files = batch_files
+        self.batch_ms = batch_ms
+        self.pending = []
+        self.failed = []
+        self.folders = set()
+        self.started = None
+        self.latencies = []
+        self.counter = itertools.count()
+        self.lock = threading.RLock()
+        self.logger = logging.getLogger(f"{__name__}.{type(self).__name__}")
+
+    def stage(self, temp, dst, on_done=None, remove_function=None):
+        """Rename temp over dst once its data is on disk.
+
+        on_done is called once the rename and directory fsync are done, or
+        once the rename failed and temp was removed; in batched mode that
+        may be after this returns. If remove_function is given, the file
+        temp replaces is handed to it right before the rename.
+        """
+        if self.mode == NONE:
+            try:
+                _replace(temp, dst, remove_function)
+            finally:
+                if on_done is not None:
+                    on_done()
+            return
+        with self.lock:
+            if not self.pending:
+                self.started = time.monotonic()
+            self.pending.append((temp, dst, on_done, remove_function))
+            if self.mode == STRICT or self._batch_full():
+                self.flush()
+
+    def _batch_full(self):
+        age_ms = (time.monotonic() - self.started) * 1000
+        return len(self.pending) >= self.batch_files or age_ms >= self.batch_ms
+
+    def touched(self, *paths):
+        """Have the directories holding paths fsynced with the next batch."""
+        if self.mode == NONE:
+            return
+        with self.lock:
+            self.folders.update(_folder(path) for path in paths)
+            if self.mode == STRICT:
+                self.flush()
+
+    def _commit(self, temp, dst, remove_function):
+        try:
+            _replace(temp, dst, remove_function)
+        except OSError:
+            self.logger.exception("Could not commit %s", dst)
+            _discard(temp)
+            self.failed.append(dst)
+        else:
+            self.folders.add(_folder(dst))
+
+    def flush(self):
+        """Fsync, rename and commit every staged file now.
+
+        Files that fail are added to self.failed; the others are still
+        committed.
+        """
+        with self.lock:
+            if not self.pending and not self.folders:
+                return
+            start = time.monotonic()
+            pending, self.pending = self.pending, []
+            for temp, _, _, _ in pending:
+                fsync_path(temp)
+            for temp, dst, _, remove_function in pending:
+                self._commit(temp, dst, remove_function)
+            for folder in self.folders:
+                fsync_path(folder)
+            self.folders.clear()
+            for _, _, on_done, _ in pending:
+                if on_done is not None:
+                    on_done()
+            elapsed = time.monotonic() - start
+            self.latencies.append((len(pending), elapsed))
+            self.logger.debug(
+                "Committed %d files in %.1f ms", len(pending), elapsed * 1000
+            )
+
+    def temp_path(self, dst):
+        """Return the temporary name dst is written to."""
+        folder, name = os.path.split(dst)
+        return os.path.join(folder, f".{name}.{next(self.counter)}.tmp")
+
+    def copy2(self, src, dst, remove_function=None):
+        """Copy a file like shutil.copy2, durably.
+
+        If remove_function is given, the file the copy replaces is handed
+        to it once the copy is on disk, right before the rename.
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        if self.mode == NONE and remove_function is None:
+            return self.copy_function(src, dst)
+        temp = self.temp_path(dst)
+        try:
+            self.copy_function(src, temp)
+        except OSError:
+            _discard(temp)
+            raise
+        self.stage(temp, dst, remove_function=remove_function)
+        return dst
+
+    def replacing(self, remove_function):
+        """Return a copy function that replaces files durably.
+
+        The old file is only handed to remove_function once its
+        replacement is on disk.
+        """
+
+        def replace(src, dst):
+            return self.copy2(src, dst, remove_function)
+
+        return replace
+
+    def updating(self, update_function):
+        """Return an update function whose changes are made durable.
+
+        A file updated in place is fsynced before the update returns; the
+        folder of a file rebuilt and renamed over its old copy is fsynced
+        with the next batch.
+        """
+
+        def update(src, dst):
+            written = update_function(src, dst)
+            if written is not None and self.mode != NONE:
+                fsync_path(dst)
+                self.touched(dst)
+            return written
+
+        return update
+
+    def moving(self, move_function=shutil.move):
+        """Return a move function whose renames are made durable."""
+
+        def move(src, dst):
+            result = move_function(src, dst)
+            self.touched(src, dst)
+            return result
+
+        return move
+
+    def removing(self, remove_function):
+        """Return a remove function whose removals are made durable."""
+
+        def remove(path):
+            remove_function(path)
+            self.touched(path)
+
+        return remove
+
+    def stats(self):
+        """Return the number of batches and files and the batch latencies."""
+        with self.lock:
+            times = [elapsed for _, elapsed in self.latencies]
+            return {
+                "batches": len(times),
+                "files": sum(count for count, _ in self.latencies),
+                "mean_ms": 1000 * sum(times) / len(times) if times else 0.0,
+                "max_ms": 1000 * max(times, default=0.0),
+            }
+
+    def take_failed(self):
+        """Return the destinations that failed to commit and forget them."""
+        with self.lock:
+            failed, self.failed = self.failed, []
+        return failed
+
+    def close(self):
+        """Commit whatever is still staged."""
+        self.flush()
@@ -1,65 +1,257 @@
 """This script contains functions to move, copy, and delete files"""
 
+import functools
 import logging
 import os
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import send2trash  # type: ignore
 
+from .delta import delta_update, use_delta
+from .sparse import copy2 as sparse_copy2
 
-def copy_files_from_a_to_b(dira, dirb, files, overwrite=False):
+MAX_OPEN_FILES = 64
+MAX_BYTES_IN_FLIGHT = 256 * 1024 * 1024
+
+
+class ByteBudget:
+    """Limits the number of bytes being copied at the same time."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        """Wait until size bytes fit in the budget and take them.
+
+        A file larger than the whole budget waits until nothing else is in
+        flight. Return the number of bytes taken.
+        """
+        size = min(size, self.limit)
+        with self.condition:
+            while self.in_flight and self.in_flight + size > self.limit:
+                self.condition.wait()
+            self.in_flight += size
+        return size
+
+    def release(self, size):
+        """Give bytes back to the budget."""
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+def file_sizes(path):
+    """Yield the size of a file, or of every file inside a folder."""
+    if not os.path.isdir(path) or os.path.islink(path):
+        yield os.lstat(path).st_size
+        return
+    for folder, _, files in os.walk(path):
+        for name in files:
+            try:
+                yield os.lstat(os.path.join(folder, name)).st_size
+            except OSError:
+                pass
+
+
+def replacement_path(dst):
+    """Return the temporary name a file replacing dst is written to."""
+    folder, name = os.path.split(dst)
+    return os.path.join(folder, f".{name}.replace")
+
+
+def replacing(
+    copy_function=sparse_copy2, remove_function=send2trash.send2trash
+):
+    """Return a function copying a file over an existing one.
+
+    The copy is written to a temporary name next to the old file, which is
+    only handed to remove_function once the copy is complete, right before
+    the copy is renamed into its place.
+    """
+
+    def replace(src, dst):
+        temp = replacement_path(dst)
+        try:
+            copy_function(src, temp)
+        except OSError:
+            if os.path.lexists(temp):
+                os.remove(temp)
+            raise
+        remove_function(dst)
+        os.replace(temp, dst)
+        return dst
+
+    return replace
+
+
+def _copy_one(
+    filename,
+    dira,
+    dirb,
+    logger,
+    overwrite=False,
+    copy_function=sparse_copy2,
+    delta_threshold=None,
+    remove_function=send2trash.send2trash,
+    replace_function=None,
+    update_function=delta_update,
+):
+    """Copy one file or folder. Return True if it was copied."""
+    old_path = os.path.join(dira, filename)
+    new_path = os.path.join(dirb, filename)
+    if os.path.isdir(old_path):
+        if not os.path.exists(new_path):
+            logger.info("%s --> %s", old_path, new_path)
+            #                os.mkdir(new_path)
+            shutil.copytree(old_path, new_path, copy_function=copy_function)
+            logger.info("Copied!")
+            return True
+        return False
+
+    if os.path.isfile(old_path):
+        logger.info("%s --> %s", old_path, new_path)
+        if os.path.exists(new_path):
+            logger.warning("File already exists!")
+            if overwrite:
+                if use_delta(old_path, new_path, delta_threshold):
+                    written = update_function(old_path, new_path)
+                    if written is not None:
+                        logger.warning("Updated changed blocks only!")
+                        logger.info("Wrote %d bytes\n", written)
+                        return True
+                logger.warning("Overwriting!")
+                if replace_function is None:
+                    replace_function = replacing(
+                        copy_function, remove_function
+                    )
+                replace_function(old_path, new_path)
+                logger.info("Copied!\n")
+                return True
+            return False
+        logger.info("%s --> %s", old_path, new_path)
+        copy_function(old_path, new_path)
+        logger.info("Copied!")
+        return True
+    logger.info("%s --> %s", old_path, new_path)
+    logger.warning("Warning! No file found!")
+    return False
+
+
+def _copy_logged(copy_one, filename, logger):
+    """Copy one file, logging an error instead of raising it."""
+    try:
+        return copy_one(filename)
+    except OSError:
+        logger.exception("Could not copy %s", filename)
+        return False
+
+
+def _copy_limited(copy_one, filename, dira, limits, logger):
+    """Copy one file within the open file and bytes in flight limits."""
+    open_files, budget = limits
+    try:
+        size = os.path.getsize(os.path.join(dira, filename))
+    except OSError:
+        size = 0
+    with open_files:
+        taken = budget.acquire(size)
+        try:
+            return _copy_logged(copy_one, filename, logger)
+        finally:
+            budget.release(taken)
+
+
+def copy_files_from_a_to_b(
+    dira,
+    dirb,
+    files,
+    overwrite=False,
+    workers=1,
+    max_open_files=MAX_OPEN_FILES,
+    max_bytes_in_flight=MAX_BYTES_IN_FLIGHT,
+    copy_function=sparse_copy2,
+    delta_threshold=None,
+    remove_function=send2trash.send2trash,
+    replace_function=None,
+    update_function=delta_update,
+):
     """Copy files from source directory to backup directory.
 
     Arguments:
     dira -- source folder path
     dirb -- backup folder path
-    files -- a list of relative filepaths for files to delete
+    files -- a list of relative filepaths for files to copy
+    overwrite -- replace files that already exist in the backup folder
+    workers -- number of files copied at the same time
+    max_open_files -- limit on files held open by the workers, two per copy
+    max_bytes_in_flight -- limit on the total size of files being copied
+    copy_function -- function copying one file; by default shutil.copy2,
+                     keeping the holes of sparse files
+    delta_threshold -- when overwriting, files at least this large on both
+                       sides only get their changed blocks rewritten; None
+                       always copies whole files
+    remove_function -- function removing a file once the copy replacing it
+                       is written, send2trash by default
+    replace_function -- function copying a file over its older copy; by
+                        default the new copy is written next to the old
+                        one, then the old one is removed and the new one
+                        renamed into its place
+    update_function -- function rewriting the changed blocks of a file
+                       over delta_threshold, delta_update by default
 
-    Return list of files that were not copied.
+    Return list of files that were not copied, in the order they were given.
+    A file whose copy raises OSError is logged and listed there, whatever
+    the number of workers.
     """
     logger = logging.getLogger(f"{__name__}.{copy_files_from_a_to_b.__name__}")
-    failed = []
-    for filename in files:
-        old_path = os.path.join(dira, filename)
-        new_path = os.path.join(dirb, filename)
-        if os.path.isdir(old_path):
-            if not os.path.exists(new_path):
-                logger.info("%s --> %s", old_path, new_path)
-                #                os.mkdir(new_path)
-                shutil.copytree(old_path, new_path)
-                logger.info("Copied!")
-            else:
-                failed.append(filename)
-
-        elif os.path.isfile(old_path):
-            logger.info("%s --> %s", old_path, new_path)
-            if os.path.exists(new_path):
-                logger.warning("File already exists!")
-                if overwrite:
-                    logger.warning("Overwriting!")
-                    send2trash.send2trash(new_path)
-                    shutil.copy2(old_path, new_path)
-                    logger.info("Copied!\n")
-                else:
-                    failed.append(filename)
-            else:
-                logger.info("%s --> %s", old_path, new_path)
-                shutil.copy2(old_path, new_path)
-                logger.info("Copied!")
-        else:
-            logger.info("%s --> %s", old_path, new_path)
-            logger.warning("Warning! No file found!")
-            failed.append(filename)
+    copy_one = functools.partial(
+        _copy_one,
+        dira=dira,
+        dirb=dirb,
+        logger=logger,
+        overwrite=overwrite,
+        copy_function=copy_function,
+        delta_threshold=delta_threshold,
+        remove_function=remove_function,
+        replace_function=replace_function,
+        update_function=update_function,
+    )
+    if workers > 1:
+        limits = (
+            threading.BoundedSemaphore(max(1, max_open_files // 2)),
+            ByteBudget(max_bytes_in_flight),
+        )
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            copied = list(
+                pool.map(
+                    lambda filename: _copy_limited(
+                        copy_one, filename, dira, limits, logger
+                    ),
+                    files,
+                )
+            )
+        failed = [filename for filename, ok in zip(files, copied) if not ok]
+    else:
+        failed = [
+            filename
+            for filename in files
+            if not _copy_logged(copy_one, filename, logger)
+        ]
     logger.info("done copying files")
     return failed
 
 
-def delete_files_from_b(dirb, files):
+def delete_files_from_b(dirb, files, remove_function=send2trash.send2trash):
     """Delete files in a given folder.
 
     Arguments:
     dirb -- folder path
     files -- a list of relative filepaths for files to delete
+    remove_function -- function removing one file, send2trash by default
     """
     logger = logging.getLogger(f"{__name__}.{delete_files_from_b.__name__}")
     failed = []
@@ -68,19 +260,20 @@ def delete_files_from_b(dirb, files):
         if os.path.exists(path):
             logger.info("deleting %s", path)
             logger.info(path := os.path.normpath(path))
-            send2trash.send2trash(path)
+            remove_function(path)
         else:
             failed.append(filepath)
     logger.info("Done deleting")
     return failed
 
 
-def move_files_in_b(file_sets):
+def move_files_in_b(file_sets, move_function=shutil.move):
     """Move files from one location to another.
 
     Arguments:
     file_sets -- a list of tuples of abs filepaths
                  (source_path, destination_path)
+    move_function -- function moving one file, shutil.move by default
     """
     logger = logging.getLogger(f"{__name__}.{move_files_in_b.__name__}")
     failed = []
@@ -92,14 +285,60 @@ def move_files_in_b(file_sets):
             failed.append(file_set)
         else:
             logger.info("moving FROM:\n%s\nTO:\n%s\n\n\n", src, dest)
-            shutil.move(src, dest)
+            move_function(src, dest)
     logger.info("done moving")
     return failed
 
 
-def update_files_a_to_b(dira, dirb, files):
-    """Copy files from source directory to backup directory."""
+def update_files_a_to_b(dira, dirb, files, **options):
+    """Copy files from source directory to backup directory.
+
+    Takes the same keyword options as copy_files_from_a_to_b.
+    """
     logger = logging.getLogger(f"{__name__}.{update_files_a_to_b.__name__}")
-    failed = copy_files_from_a_to_b(dira, dirb, files, overwrite=True)
+    failed = copy_files_from_a_to_b(
+        dira, dirb, files, overwrite=True, **options
+    )
     logger.info("Done updating")
     return failed
+
+
+def copy_attributes(src, dst):
+    """Copy the times, permissions and, if allowed, owner of src to dst."""
+    shutil.copystat(src, dst)
+    if hasattr(os, "chown"):
+        stat_result = os.stat(src)
+        try:
+            os.chown(dst, stat_result.st_uid, stat_result.st_gid)
+        except PermissionError:
+            pass
+
+
+def sync_attributes_a_to_b(
+    dira, dirb, files, attribute_function=copy_attributes
+):
+    """Copy file attributes from source directory to backup directory.
+
+    Only metadata is written; the contents of the files are left alone.
+
+    Arguments:
+    dira -- source folder path
+    dirb -- backup folder path
+    files -- a list of relative filepaths whose attributes differ
+    attribute_function -- function copying the attributes of one file,
+                          copy_attributes by default
+
+    Return list of files whose attributes were not copied.
+    """
+    logger = logging.getLogger(f"{__name__}.{sync_attributes_a_to_b.__name__}")
+    failed = []
+    for filename in files:
+        try:
+            attribute_function(
+                os.path.join(dira, filename), os.path.join(dirb, filename)
+            )
+        except OSError:
+            logger.exception("Could not copy the attributes of %s", filename)
+            failed.append(filename)
+    logger.info("Done copying attributes")
+    return failed
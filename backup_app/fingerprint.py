@@ -0,0 +1,93 @@
+"""This script computes Merkle fingerprints of directory trees
+
+A directory's fingerprint is a hash over its sorted child names and the
+fingerprints of its subfolders or the sizes of its files, computed bottom
+up. Two trees with the same fingerprint have the same layout and file
+sizes, so a renamed or moved folder can be found with one dict lookup.
+The modification time of every file is kept beside the fingerprint and
+compared within the tolerance the scanner uses, as backups on filesystems
+with coarse timestamps never hold the exact times of the source.
+"""
+
+import hashlib
+import os
+
+from .comparison import mtimes_match
+
+
+class TreeFingerprint:
+    """Fingerprint of a directory tree and the files it contains.
+
+    leaves maps the (path inside the tree, size) of every file to its
+    modification time in nanoseconds.
+    """
+
+    __slots__ = ("digest", "leaves")
+
+    def __init__(self, digest, leaves):
+        self.digest = digest
+        self.leaves = leaves
+
+    def matches(self, leaf, other):
+        """Return True if other holds a file matching one of the leaves."""
+        mtime_ns = other.leaves.get(leaf)
+        if mtime_ns is None:
+            return False
+        return mtimes_match(self.leaves[leaf], mtime_ns)
+
+    def shared(self, other):
+        """Return the number of files two trees have in common."""
+        return sum(self.matches(leaf, other) for leaf in self.leaves)
+
+    def same_files(self, other):
+        """Return True if two trees hold the same files."""
+        count = len(self.leaves)
+        return count == len(other.leaves) and self.shared(other) == count
+
+    def unmatched(self, other):
+        """Return the sorted paths of the files other does not hold."""
+        return sorted(
+            relpath
+            for relpath, size in self.leaves
+            if not self.matches((relpath, size), other)
+        )
+
+    def similarity(self, other):
+        """Return the share of files two trees have in common, from 0 to 1.
+
+        Files are compared by their path inside the tree, size and
+        modification time.
+        """
+        return self.share(self.shared(other), other)
+
+    def share(self, shared, other):
+        """Return the similarity of two trees with shared leaves in common."""
+        union = len(self.leaves) + len(other.leaves) - shared
+        if not union:
+            return 1.0
+        return shared / union
+
+
+def _fingerprint_dir(path, prefix, leaves):
+    hasher = hashlib.blake2b()
+    with os.scandir(path) as entries:
+        listing = sorted(entries, key=lambda entry: entry.name)
+    for entry in listing:
+        name = entry.name
+        relpath = os.path.join(prefix, name) if prefix else name
+        if entry.is_dir(follow_symlinks=False):
+            child = _fingerprint_dir(entry.path, relpath, leaves)
+            hasher.update(b"d\0" + os.fsencode(name) + b"\0" + child)
+        else:
+            stat_result = entry.stat(follow_symlinks=False)
+            size = stat_result.st_size
+            leaves[(relpath, size)] = stat_result.st_mtime_ns
+            hasher.update(b"f\0" + os.fsencode(name) + b"\0%d\0" % size)
+    return hasher.digest()
+
+
+def fingerprint_tree(path):
+    """Return the TreeFingerprint of the directory tree at path."""
+    leaves = {}
+    digest = _fingerprint_dir(path, "", leaves)
+    return TreeFingerprint(digest, leaves)
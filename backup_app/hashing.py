@@ -0,0 +1,157 @@
+"""This script computes and caches content hashes of files
+
+Digests are chunked BLAKE2b hashes. The cache is keyed on the stat
+signature of a file (device, inode, size and mtime_ns), so a file is only
+read again once its signature changes.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+
+from .metadata import metadata_path
+
+CHUNK_SIZE = 1024 * 1024
+PARTIAL_SIZE = 64 * 1024
+CACHE_NAME = "hash_cache.sqlite"
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    """Return the hex BLAKE2b digest of a file, read in chunks."""
+    digest = hashlib.blake2b()
+    with open(path, "rb") as filein:
+        while chunk := filein.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_identity(path, stat_result):
+    """Return the key identifying a file in the hash cache.
+
+    Falls back to the absolute path where the platform reports no inode
+    number, as DirEntry does on Windows.
+    """
+    if stat_result.st_ino:
+        return f"{stat_result.st_dev}:{stat_result.st_ino}"
+    return os.path.abspath(path)
+
+
+class ContentDigests:
+    """Computes partial and full digests of files, reading each byte once.
+
+    The partial digest covers the first partial_size bytes. The full digest
+    resumes hashing from there, so asking for both reads a file only once.
+    """
+
+    def __init__(self, partial_size=PARTIAL_SIZE):
+        self.partial_size = partial_size
+        self._partial = {}
+        self._heads = {}
+        self._full = {}
+
+    def partial(self, path):
+        """Return the digest of the head of a file."""
+        if path not in self._partial:
+            hasher = hashlib.blake2b()
+            with open(path, "rb") as filein:
+                hasher.update(filein.read(self.partial_size))
+            self._heads[path] = hasher
+            self._partial[path] = hasher.hexdigest()
+        return self._partial[path]
+
+    def full(self, path):
+        """Return the digest of a whole file, as file_digest would."""
+        if path not in self._full:
+            self.partial(path)
+            hasher = self._heads.pop(path)
+            with open(path, "rb") as filein:
+                filein.seek(self.partial_size)
+                while chunk := filein.read(CHUNK_SIZE):
+                    hasher.update(chunk)
+            self._full[path] = hasher.hexdigest()
+        return self._full[path]
+
+    def same_contents(self, path_a, path_b):
+        """Return True if two files of equal size have the same contents."""
+        try:
+            return self.partial(path_a) == self.partial(path_b) and (
+                self.full(path_a) == self.full(path_b)
+            )
+        except OSError:
+            return False
+
+
+class HashCache:
+    """Caches file digests keyed on their stat signature."""
+
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS hashes (
+                identity TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                digest TEXT
+            )"""
+        )
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_backup(cls, backup_root):
+        """Open the hash cache stored in a backup folder."""
+        return cls(metadata_path(backup_root, CACHE_NAME))
+
+    def lookup(self, path, stat_result):
+        """Return the cached digest of a file or None."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT digest FROM hashes"
+                " WHERE identity = ? AND size = ? AND mtime_ns = ?",
+                (
+                    file_identity(path, stat_result),
+                    stat_result.st_size,
+                    stat_result.st_mtime_ns,
+                ),
+            ).fetchone()
+        return row[0] if row else None
+
+    def store(self, path, stat_result, digest):
+        """Record the digest of a file."""
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)",
+                (
+                    file_identity(path, stat_result),
+                    stat_result.st_size,
+                    stat_result.st_mtime_ns,
+                    digest,
+                ),
+            )
+
+    def digest(self, path, stat_result=None):
+        """Return the digest of a file, reading it only on a cache miss."""
+        if stat_result is None:
+            stat_result = os.stat(path)
+        digest = self.lookup(path, stat_result)
+        if digest is not None:
+            with self.lock:
+                self.hits += 1
+            return digest
+        with self.lock:
+            self.misses += 1
+        digest = file_digest(path)
+        self.store(path, stat_result, digest)
+        return digest
+
+    def stats(self):
+        """Return the hit and miss counters."""
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        """Save and close the cache."""
+        self.connection.commit()
+        self.connection.close()
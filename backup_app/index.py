@@ -0,0 +1,211 @@
+"""This script keeps a persistent index of the last scan
+
+The index is a SQLite database stored in the metadata folder of the backup
+folder. It records every entry of both trees together with the result of
+its comparison, so a later scan can skip directories whose mtime did not
+change on either side.
+
+A directory's mtime only changes when entries are added, removed or renamed
+inside it, so the files of an unchanged directory are stat-ed again and
+checked against their stored size, mtime and inode before its results are
+reused. Files rewritten in place or given new attributes are then compared
+again.
+"""
+
+import os
+import sqlite3
+import stat
+import threading
+
+from .metadata import metadata_path
+
+INDEX_NAME = "scan_index.sqlite"
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS directories (
+        path TEXT PRIMARY KEY,
+        mtime_a INTEGER,
+        mtime_b INTEGER
+    )""",
+    """CREATE TABLE IF NOT EXISTS entries (
+        parent TEXT,
+        name TEXT,
+        side TEXT,
+        is_dir INTEGER,
+        size INTEGER,
+        mtime_ns INTEGER,
+        inode INTEGER,
+        digest TEXT,
+        category TEXT,
+        PRIMARY KEY (parent, name, side)
+    )""",
+)
+
+
+class ScanIndex:
+    """Stores the entries and comparison results of the last scan."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.visited = set()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_backup(cls, backup_root):
+        """Open the index stored in a backup folder."""
+        return cls(metadata_path(backup_root, INDEX_NAME))
+
+    def _setting(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM settings WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def start(self, source, shallow=True):
+        """Prepare the index for a scan of source.
+
+        The index is cleared if it was built for another source folder or
+        comparison mode.
+        """
+        settings = {
+            "source": os.path.abspath(source),
+            "shallow": str(bool(shallow)),
+        }
+        if any(self._setting(key) != value for key, value in settings.items()):
+            self.clear()
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                settings.items(),
+            )
+        self.visited = set()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """Forget every directory and entry."""
+        for table in ("settings", "directories", "entries"):
+            self.connection.execute(f"DELETE FROM {table}")  # nosec
+
+    def load_level(self, relpath, mtimes, dirs=None):
+        """Return the stored entries of a directory if it is unchanged.
+
+        Arguments:
+        relpath -- directory path relative to the scan roots
+        mtimes -- (source mtime_ns, backup mtime_ns) of the directory
+        dirs -- optional (source path, backup path) of the directory, whose
+                files are stat-ed again and checked against the index
+
+        Return a list of (name, category) tuples or None if the directory
+        or one of its files changed since it was indexed.
+        """
+        with self.lock:
+            self.visited.add(relpath)
+            row = self.connection.execute(
+                "SELECT mtime_a, mtime_b FROM directories WHERE path = ?",
+                (relpath,),
+            ).fetchone()
+            if row is None or tuple(row) != tuple(mtimes):
+                self.misses += 1
+                return None
+            stored = self.connection.execute(
+                "SELECT name, side, is_dir, size, mtime_ns, inode"
+                " FROM entries WHERE parent = ?",
+                (relpath,),
+            ).fetchall()
+        if dirs is not None and not _entries_unchanged(dirs, stored):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            return self.connection.execute(
+                "SELECT name, category FROM entries"
+                " WHERE parent = ? AND category IS NOT NULL ORDER BY rowid",
+                (relpath,),
+            ).fetchall()
+
+    def store_level(self, relpath, mtimes, rows):
+        """Replace the stored entries of a directory.
+
+        Arguments:
+        relpath -- directory path relative to the scan roots
+        mtimes -- (source mtime_ns, backup mtime_ns) of the directory
+        rows -- (name, side, stat_result, category) tuples, where
+                stat_result may be None if the entry could not be stat-ed
+        """
+        rows = [
+            (relpath, name, side, *_stat_columns(stat_result), category)
+            for name, side, stat_result, category in rows
+        ]
+        with self.lock:
+            self.visited.add(relpath)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)",
+                (relpath, *mtimes),
+            )
+            self.connection.execute(
+                "DELETE FROM entries WHERE parent = ?", (relpath,)
+            )
+            self.connection.executemany(
+                "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def finish(self):
+        """Drop directories that were not seen and save the index."""
+        stale = [
+            (path,)
+            for (path,) in self.connection.execute(
+                "SELECT path FROM directories"
+            )
+            if path not in self.visited
+        ]
+        self.connection.executemany(
+            "DELETE FROM directories WHERE path = ?", stale
+        )
+        self.connection.executemany(
+            "DELETE FROM entries WHERE parent = ?", stale
+        )
+        self.connection.commit()
+
+    def close(self):
+        """Save and close the index."""
+        self.connection.commit()
+        self.connection.close()
+
+
+def _entries_unchanged(dirs, stored):
+    paths = dict(zip("ab", dirs))
+    for name, side, is_dir, size, mtime_ns, inode in stored:
+        if is_dir:
+            continue
+        try:
+            stat_result = os.stat(os.path.join(paths[side], name))
+        except OSError:
+            stat_result = None
+        current = _stat_columns(stat_result)
+        if current[:3] != (is_dir, size, mtime_ns):
+            return False
+        # DirEntry.stat() leaves st_ino at 0 on Windows
+        if inode and current[3] != inode:
+            return False
+    return True
+
+
+def _stat_columns(stat_result):
+    if stat_result is None:
+        return (None, None, None, None, None)
+    return (
+        int(stat.S_ISDIR(stat_result.st_mode)),
+        stat_result.st_size,
+        stat_result.st_mtime_ns,
+        stat_result.st_ino,
+        None,
+    )
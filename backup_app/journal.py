@@ -0,0 +1,307 @@
+"""This script keeps a write-ahead journal of the changes made to a backup
+
+Every copy, move and delete is recorded in a SQLite journal in the
+metadata folder before it starts, and removed from it once it is done.
+Files are copied to a temporary name next to their destination with the
+copy function they were given, so verification and throttling still
+apply, and renamed into place, so a backup file is never left half
+written. A copy is marked written once its temporary file is complete;
+large files are fsynced and checkpointed at that point too.
+
+After a crash, recover() finishes or undoes the operations still in the
+journal. Large copies that were checkpointed are only renamed into place
+instead of being copied again.
+"""
+
+import os
+import shutil
+import sqlite3
+import threading
+
+import send2trash  # type: ignore
+
+from .durability import fsync_path
+from .metadata import metadata_path
+
+JOURNAL_NAME = "journal.sqlite"
+CHECKPOINT_BYTES = 64 * 1024 * 1024
+COPY, MOVE, DELETE = "copy", "move", "delete"
+STARTED, WRITTEN = "started", "written"
+DONE, REPLAYED, ROLLED_BACK = "done", "replayed", "rolled back"
+
+
+def _discard(path):
+    if os.path.lexists(path):
+        os.remove(path)
+
+
+class Journal:
+    """Records backup operations before they run so they survive a crash.
+
+    Arguments:
+    path -- path of the journal database
+    checkpoint_bytes -- files at least this large are fsynced and
+                        checkpointed once copied, so a crash before their
+                        rename does not copy them again
+    """
+
+    def __init__(self, path, checkpoint_bytes=CHECKPOINT_BYTES):
+        self.path = path
+        self.checkpoint_bytes = checkpoint_bytes
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS operations (
+                id INTEGER PRIMARY KEY,
+                kind TEXT,
+                src TEXT,
+                dst TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                offset INTEGER DEFAULT 0,
+                state TEXT DEFAULT 'started'
+            )"""
+        )
+        columns = [
+            row[1]
+            for row in self.connection.execute("PRAGMA table_info(operations)")
+        ]
+        if "state" not in columns:
+            # journals written before copies recorded their state
+            self.connection.execute(
+                "ALTER TABLE operations"
+                " ADD COLUMN state TEXT DEFAULT 'started'"
+            )
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_backup(cls, backup_root, **options):
+        """Open the journal stored in a backup folder."""
+        return cls(metadata_path(backup_root, JOURNAL_NAME), **options)
+
+    def _write(self, query, params):
+        with self.lock:
+            cursor = self.connection.execute(query, params)
+            self.connection.commit()
+        return cursor.lastrowid
+
+    def plan(self, kind, src, dst=None):
+        """Record an operation about to start and return its id."""
+        try:
+            stat_result = os.stat(src)
+            size, mtime_ns = stat_result.st_size, stat_result.st_mtime_ns
+        except OSError:
+            size, mtime_ns = None, None
+        return self._write(
+            "INSERT INTO operations (kind, src, dst, size, mtime_ns)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (kind, src, dst, size, mtime_ns),
+        )
+
+    def checkpoint(self, op_id, offset, state=STARTED):
+        """Record how many bytes of a copy are safely written.
+
+        state is WRITTEN once the temporary file of the copy is complete.
+        """
+        self._write(
+            "UPDATE operations SET offset = ?, state = ? WHERE id = ?",
+            (offset, state, op_id),
+        )
+
+    def complete(self, op_id):
+        """Remove a finished operation from the journal."""
+        self._write("DELETE FROM operations WHERE id = ?", (op_id,))
+
+    def unfinished(self):
+        """Return the operations still in the journal, oldest first.
+
+        Rows are (id, kind, src, dst, size, mtime_ns, offset, state) tuples.
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT id, kind, src, dst, size, mtime_ns, offset, state"
+                " FROM operations ORDER BY id"
+            ).fetchall()
+
+    @staticmethod
+    def temp_path(dst, op_id):
+        """Return the name a file is written to before it is renamed."""
+        folder, name = os.path.split(dst)
+        return os.path.join(folder, f".{name}.{op_id}.part")
+
+    def _written(self, op_id, temp, size):
+        """Mark a copy written, checkpointing large files first."""
+        offset = 0
+        if size >= self.checkpoint_bytes:
+            fsync_path(temp)
+            offset = size
+        self.checkpoint(op_id, offset, WRITTEN)
+
+    def _rename(self, op_id, temp, dst, writer=None, remove_function=None):
+        if writer is None:
+            if remove_function is not None and os.path.lexists(dst):
+                remove_function(dst)
+            os.replace(temp, dst)
+            self.complete(op_id)
+        else:
+            writer.stage(
+                temp, dst, lambda: self.complete(op_id), remove_function
+            )
+
+    def _copy(
+        self,
+        op_id,
+        src,
+        dst,
+        copy_function,
+        writer=None,
+        remove_function=None,
+    ):
+        temp = self.temp_path(dst, op_id)
+        copy_function(src, temp)
+        self._written(op_id, temp, os.path.getsize(temp))
+        self._rename(op_id, temp, dst, writer, remove_function)
+
+    def copying(
+        self, copy_function=shutil.copy2, writer=None, remove_function=None
+    ):
+        """Return a journaled version of a copy function.
+
+        If a DurableWriter is given, it renames each copy into place and
+        the operation is only completed once the copy is on disk, or once
+        the writer gave up on it and removed its temporary file. If
+        remove_function is given, a file the copy replaces is handed to it
+        once the copy is complete, right before the rename; a crash in
+        between is recovered by replaying the copy.
+        """
+
+        def copy(src, dst):
+            if os.path.isdir(dst):
+                dst = os.path.join(dst, os.path.basename(src))
+            op_id = self.plan(COPY, src, dst)
+            try:
+                self._copy(
+                    op_id,
+                    src,
+                    dst,
+                    copy_function,
+                    writer=writer,
+                    remove_function=remove_function,
+                )
+            except OSError:
+                _discard(self.temp_path(dst, op_id))
+                self.complete(op_id)
+                raise
+            return dst
+
+        return copy
+
+    def updating(self, update_function):
+        """Return a journaled version of an update function.
+
+        A file updated in place is left part old, part new if the update
+        is cut short, so the operation is recorded as a copy and only
+        completed once the update returns. Recovery then copies the whole
+        file again.
+        """
+
+        def update(src, dst):
+            op_id = self.plan(COPY, src, dst)
+            written = update_function(src, dst)
+            self.complete(op_id)
+            return written
+
+        return update
+
+    def removing(self, remove_function=send2trash.send2trash):
+        """Return a journaled version of a remove function."""
+
+        def remove(path):
+            op_id = self.plan(DELETE, path)
+            remove_function(path)
+            self.complete(op_id)
+
+        return remove
+
+    def moving(self, move_function=shutil.move):
+        """Return a journaled version of a move function."""
+
+        def move(src, dst):
+            op_id = self.plan(MOVE, src, dst)
+            result = move_function(src, dst)
+            self.complete(op_id)
+            return result
+
+        return move
+
+    def _recover_copy(self, op_id, src, dst, row, copy, remove):
+        size, mtime_ns, offset, state = row
+        temp = self.temp_path(dst, op_id)
+        if not os.path.isfile(src):
+            _discard(temp)
+            return ROLLED_BACK
+        if not os.path.lexists(temp):
+            # without its temporary file, a written copy was renamed
+            if state == WRITTEN and os.path.lexists(dst):
+                return DONE
+        elif state == WRITTEN and offset:
+            stat_result = os.stat(src)
+            unchanged = (stat_result.st_size, stat_result.st_mtime_ns) == (
+                size,
+                mtime_ns,
+            )
+            if unchanged and os.path.getsize(temp) == offset:
+                self._rename(op_id, temp, dst, remove_function=remove)
+                return REPLAYED
+        _discard(temp)
+        self._copy(op_id, src, dst, copy, remove_function=remove)
+        return REPLAYED
+
+    def recover(
+        self,
+        copy_function=shutil.copy2,
+        remove_function=send2trash.send2trash,
+        move_function=shutil.move,
+    ):
+        """Finish or undo the operations left in the journal by a crash.
+
+        Copies are made again, or only renamed into place if they were
+        checkpointed once written, and dropped if their source is gone; a
+        file a recovered copy replaces is handed to remove_function. Deletes
+        and moves are run again unless they already happened. A move whose
+        destination was taken meanwhile is dropped.
+
+        Return a list of (kind, src, dst, outcome) tuples, where outcome is
+        DONE, REPLAYED or ROLLED_BACK.
+        """
+        results = []
+        for op_id, kind, src, dst, *row in self.unfinished():
+            try:
+                if kind == COPY:
+                    outcome = self._recover_copy(
+                        op_id, src, dst, row, copy_function, remove_function
+                    )
+                elif kind == DELETE and os.path.lexists(src):
+                    remove_function(src)
+                    outcome = REPLAYED
+                elif kind == MOVE and os.path.lexists(src):
+                    if os.path.lexists(dst):
+                        outcome = ROLLED_BACK
+                    else:
+                        move_function(src, dst)
+                        outcome = REPLAYED
+                else:
+                    outcome = DONE
+            except OSError:
+                if kind == COPY:
+                    _discard(self.temp_path(dst, op_id))
+                outcome = ROLLED_BACK
+            self.complete(op_id)
+            results.append((kind, src, dst, outcome))
+        return results
+
+    def close(self):
+        """Save and close the journal."""
+        self.connection.commit()
+        self.connection.close()
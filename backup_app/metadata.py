@@ -0,0 +1,19 @@
+"""This script locates the folder where the app keeps its own files
+
+The metadata folder lives inside the backup folder and is skipped when the
+backup folder is scanned.
+"""
+
+import os
+
+METADATA_DIR = ".backup_app"
+
+
+def metadata_path(backup_root, *parts):
+    """Return a path inside the metadata folder of a backup folder.
+
+    The metadata folder and any parent folders of the path are created.
+    """
+    path = os.path.join(backup_root, METADATA_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
@@ -0,0 +1,279 @@
+"""This script plans and runs a whole sync of a backup folder at once
+
+A Report is turned into a graph of operations. Moves run before the
+copies that go into the folders they create or the names they free, and
+after the moves that free their own target. Missing parent folders are
+created once. Deletes wait for every operation below the deleted path.
+Copies of files that a move already brings into place are dropped. Files
+whose contents match but whose attributes differ only get their metadata
+copied.
+Operations whose dependencies are done run in parallel.
+"""
+
+import os
+import shutil
+from collections import Counter, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .filesystem import (
+    copy_files_from_a_to_b,
+    delete_files_from_b,
+    move_files_in_b,
+    sync_attributes_a_to_b,
+    update_files_a_to_b,
+)
+
+MKDIR, MOVE, COPY, UPDATE, DELETE = "mkdir", "move", "copy", "update", "delete"
+METADATA = "metadata"
+KINDS = (MKDIR, MOVE, COPY, UPDATE, METADATA, DELETE)
+
+Operation = namedtuple(
+    "Operation", ("kind", "path", "target"), defaults=(None,)
+)
+Operation.__doc__ = """One step of a sync plan.
+
+path is relative to the backup folder, except for moves, whose path and
+target are the absolute backup paths listed in moved_files. Folders to
+create are given by their absolute backup path.
+"""
+
+
+def _ancestors(path):
+    """Yield a normalised path and each of its parent folders."""
+    while True:
+        yield path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return
+        path = parent
+
+
+class SyncPlan:
+    """A graph of sync operations and the operations each one waits for."""
+
+    def __init__(self):
+        self.operations = []
+        self.depends = []
+        self.dropped = []
+
+    def add(self, operation, after=()):
+        """Add an operation and return its index."""
+        self.operations.append(operation)
+        self.depends.append(set(after))
+        return len(self.operations) - 1
+
+    def counts(self):
+        """Return the number of operations of each kind."""
+        return Counter(operation.kind for operation in self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+
+def plan_sync(report, backup):
+    """Return a SyncPlan bringing a backup folder in line with a report.
+
+    Arguments:
+    report -- an examined Report
+    backup -- backup folder path the report is relative to
+    """
+    plan = SyncPlan()
+    backup = os.path.normpath(backup)
+    moves_by_source = {}
+    moves_by_target = {}
+    folders = {}
+
+    def backup_path(relpath):
+        return os.path.normpath(os.path.join(backup, relpath))
+
+    def moves_over(path, moves):
+        return {moves[p] for p in _ancestors(path) if p in moves}
+
+    def folder_op(folder):
+        """Return the operations a file in folder must wait for."""
+        if folder in folders:
+            return folders[folder]
+        made_by = moves_over(folder, moves_by_target)
+        if made_by or folder == backup or os.path.isdir(folder):
+            folders[folder] = made_by
+            return made_by
+        index = plan.add(
+            Operation(MKDIR, folder), folder_op(os.path.dirname(folder))
+        )
+        folders[folder] = {index}
+        return folders[folder]
+
+    for old, new in report["moved_files"]:
+        index = plan.add(Operation(MOVE, old, new))
+        moves_by_source[os.path.normpath(old)] = index
+        moves_by_target[os.path.normpath(new)] = index
+    for index, operation in enumerate(list(plan.operations)):
+        target = os.path.normpath(operation.target)
+        plan.depends[index] |= folder_op(os.path.dirname(target))
+        plan.depends[index] |= moves_over(target, moves_by_source)
+        plan.depends[index].discard(index)
+
+    for kind, key in ((COPY, "added_files"), (UPDATE, "mismatched_files")):
+        for relpath in report[key]:
+            path = backup_path(relpath)
+            covering = moves_over(path, moves_by_target)
+            if kind == COPY and covering:
+                plan.dropped.append((relpath, min(covering)))
+                continue
+            after = folder_op(os.path.dirname(path))
+            plan.add(
+                Operation(kind, relpath),
+                after | moves_over(path, moves_by_source),
+            )
+    if "attribute_files" in report:
+        for relpath in report["attribute_files"]:
+            plan.add(Operation(METADATA, relpath))
+
+    deletes = {}
+    for relpath in report["removed_files"]:
+        deletes[backup_path(relpath)] = plan.add(Operation(DELETE, relpath))
+    for index, operation in enumerate(plan.operations):
+        if operation.kind == DELETE:
+            continue
+        if operation.kind == MOVE:
+            paths = (operation.path, operation.target)
+        elif operation.kind == MKDIR:
+            paths = (operation.path,)
+        else:
+            paths = (backup_path(operation.path),)
+        for path in paths:
+            for folder in _ancestors(os.path.normpath(path)):
+                if folder in deletes:
+                    plan.depends[deletes[folder]].add(index)
+    return plan
+
+
+def run_plan(plan, handlers, workers=1):
+    """Run every operation of a plan once the ones it waits for are done.
+
+    Arguments:
+    plan -- a SyncPlan
+    handlers -- dict mapping each kind to a function that takes an
+                Operation and returns True if it succeeded
+    workers -- number of operations run at the same time
+
+    Operations waiting for one that failed are skipped. If operations wait
+    for each other in a cycle, the earliest one is run to break it.
+    Return the indexes of the operations that failed or were skipped.
+    """
+    waiting = {index: set(after) for index, after in enumerate(plan.depends)}
+    dependents = {index: [] for index in waiting}
+    for index, after in waiting.items():
+        for other in after:
+            dependents[other].append(index)
+    failed = set()
+
+    def skip(index):
+        for other in dependents[index]:
+            if other in waiting:
+                del waiting[other]
+                failed.add(other)
+                skip(other)
+
+    def run(index):
+        try:
+            return handlers[plan.operations[index].kind](
+                plan.operations[index]
+            )
+        except OSError:
+            return False
+
+    ready = [index for index, after in waiting.items() if not after]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        running = {}
+        while waiting or running:
+            if not ready and not running:
+                ready = [min(waiting)]
+            for index in ready:
+                if index not in waiting:
+                    continue
+                del waiting[index]
+                running[pool.submit(run, index)] = index
+            ready = []
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                if future.result():
+                    for other in dependents[index]:
+                        if other in waiting:
+                            waiting[other].discard(index)
+                            if not waiting[other]:
+                                ready.append(other)
+                else:
+                    failed.add(index)
+                    skip(index)
+    return sorted(failed)
+
+
+def filesystem_handlers(source, backup, move_function=shutil.move, **options):
+    """Return handlers running plan operations with the filesystem functions.
+
+    Keyword options are passed on to the copy and update functions.
+    """
+    remove_function = options.get("remove_function")
+    removal = (
+        {} if remove_function is None else {"remove_function": remove_function}
+    )
+
+    def mkdir(operation):
+        os.makedirs(operation.path, exist_ok=True)
+        return True
+
+    return {
+        MKDIR: mkdir,
+        MOVE: lambda operation: not move_files_in_b(
+            [(operation.path, operation.target)], move_function
+        ),
+        COPY: lambda operation: not copy_files_from_a_to_b(
+            source, backup, [operation.path], **options
+        ),
+        UPDATE: lambda operation: not update_files_a_to_b(
+            source, backup, [operation.path], **options
+        ),
+        METADATA: lambda operation: not sync_attributes_a_to_b(
+            source, backup, [operation.path]
+        ),
+        DELETE: lambda operation: not delete_files_from_b(
+            backup, [operation.path], **removal
+        ),
+    }
+
+
+def store_handlers(source, backup, store):
+    """Return handlers running plan operations against a ContentStore.
+
+    Arguments:
+    source -- source folder path
+    backup -- backup folder path the plan was made for
+    store -- ContentStore of the backup folder
+    """
+
+    def relative(path):
+        return os.path.relpath(path, backup)
+
+    def mkdir(operation):
+        store.mkdir(relative(operation.path))
+        return True
+
+    def add(operation):
+        store.add(os.path.join(source, operation.path), operation.path)
+        return True
+
+    return {
+        MKDIR: mkdir,
+        MOVE: lambda operation: store.move(
+            relative(operation.path), relative(operation.target)
+        ),
+        COPY: add,
+        UPDATE: add,
+        METADATA: add,
+        DELETE: lambda operation: store.remove(operation.path),
+    }
@@ -0,0 +1,305 @@
+"""This script keeps deleted and replaced backup files in a quarantine
+
+Files are renamed into a folder inside the metadata folder of the backup
+folder, so removing a file is a single rename on the same filesystem. A
+SQLite manifest records where each file came from. Entries added inside a
+batch are committed together; each row is written before its file is
+moved. If the quarantine was not closed cleanly, it is reconciled with its
+folder when opened again: files moved in a batch that was never committed
+get their rows back, and rows whose files are gone are dropped. Old
+entries are purged by age and by total size, oldest first, and any entry
+can be restored to its old place.
+"""
+
+import errno
+import itertools
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from .filesystem import file_sizes
+from .metadata import metadata_path
+
+QUARANTINE_DIR = "quarantine"
+MANIFEST_NAME = "quarantine.sqlite"
+OPEN_MARKER = "quarantine.open"
+MAX_AGE = 30 * 24 * 60 * 60
+
+
+def _rename(src, dst):
+    """Rename src to dst, moving the data only across filesystems."""
+    try:
+        os.rename(src, dst)
+    except OSError as error:
+        if error.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class Quarantine:
+    """Holds files removed from a backup folder until they are purged.
+
+    Arguments:
+    backup_root -- backup folder whose files are quarantined
+    max_age -- seconds an entry is kept; None keeps entries forever
+    max_bytes -- total size kept; None sets no limit
+    """
+
+    def __init__(self, backup_root, max_age=MAX_AGE, max_bytes=None):
+        self.backup_root = backup_root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.folder = metadata_path(backup_root, QUARANTINE_DIR)
+        os.makedirs(self.folder, exist_ok=True)
+        self.connection = sqlite3.connect(
+            metadata_path(backup_root, MANIFEST_NAME), check_same_thread=False
+        )
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY,
+                batch TEXT,
+                original TEXT,
+                stored TEXT,
+                size INTEGER,
+                quarantined REAL
+            )"""
+        )
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.batch_name = None
+        self.depth = 0
+        self.counter = itertools.count()
+        self.marker = metadata_path(backup_root, OPEN_MARKER)
+        # a marker left by an earlier session means it did not close, and
+        # may have moved files whose rows were never committed
+        if os.path.exists(self.marker):
+            self.reconcile()
+        with open(self.marker, "w", encoding="utf-8"):
+            pass
+
+    def _stored_paths(self):
+        """Yield the stored path of every file and link in the folder."""
+        for folder, dirnames, filenames in os.walk(self.folder):
+            stored = os.path.relpath(folder, self.folder)
+            links = [
+                name
+                for name in dirnames
+                if os.path.islink(os.path.join(folder, name))
+            ]
+            for name in filenames + links:
+                yield os.path.normpath(os.path.join(stored, name))
+
+    def reconcile(self):
+        """Match the manifest with the files in the quarantine folder.
+
+        Rows whose files are gone are dropped, and every file without a
+        row gets one, as its own entry. Return the number of rows added.
+        """
+        added = 0
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, stored FROM entries"
+            ).fetchall()
+            known = set()
+            for entry_id, stored in rows:
+                if os.path.lexists(os.path.join(self.folder, stored)):
+                    known.add(stored)
+                else:
+                    self._drop(entry_id, stored)
+            for stored in self._stored_paths():
+                parts = stored.split(os.sep)
+                if len(parts) < 2 or any(
+                    os.path.join(*parts[:i]) in known
+                    for i in range(1, len(parts) + 1)
+                ):
+                    continue
+                path = os.path.join(self.folder, stored)
+                batch_name = parts[0]
+                try:
+                    quarantined = int(batch_name.split("-")[0]) / 10**9
+                except ValueError:
+                    quarantined = os.lstat(path).st_mtime
+                self.connection.execute(
+                    "INSERT INTO entries (batch, original, stored, size,"
+                    " quarantined) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        batch_name,
+                        os.path.join(*parts[1:]),
+                        stored,
+                        os.lstat(path).st_size,
+                        quarantined,
+                    ),
+                )
+                added += 1
+            self.connection.commit()
+        return added
+
+    @contextmanager
+    def batch(self):
+        """Group the entries added inside the block into one commit."""
+        with self.lock:
+            if not self.depth:
+                self.batch_name = str(time.time_ns())
+            self.depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.depth -= 1
+                if not self.depth:
+                    self.connection.commit()
+                    self.batch_name = None
+
+    def _stored_path(self, batch_name, original):
+        # the original path is everything after the first folder, so
+        # reconcile can tell it back from the stored path
+        stored = os.path.join(batch_name, original)
+        while os.path.lexists(os.path.join(self.folder, stored)):
+            stored = os.path.join(
+                f"{batch_name}-{next(self.counter)}", original
+            )
+        return stored
+
+    def put(self, path):
+        """Move a file or folder of the backup folder into the quarantine.
+
+        Return the id of the new manifest entry.
+        """
+        original = os.path.relpath(path, self.backup_root)
+        size = sum(file_sizes(path))
+        with self.lock:
+            batch_name = self.batch_name or str(time.time_ns())
+            stored = self._stored_path(batch_name, original)
+            target = os.path.join(self.folder, stored)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            cursor = self.connection.execute(
+                "INSERT INTO entries (batch, original, stored, size,"
+                " quarantined) VALUES (?, ?, ?, ?, ?)",
+                (batch_name, original, stored, size, time.time()),
+            )
+            try:
+                _rename(path, target)
+            except OSError:
+                self.connection.execute(
+                    "DELETE FROM entries WHERE id = ?", (cursor.lastrowid,)
+                )
+                raise
+            if not self.depth:
+                self.connection.commit()
+        return cursor.lastrowid
+
+    def entries(self, original=None):
+        """Return (id, original, size, quarantined) rows, newest first.
+
+        Only the entries of one original path are returned if it is given.
+        """
+        query = "SELECT id, original, size, quarantined FROM entries"
+        params = ()
+        if original is not None:
+            query += " WHERE original = ?"
+            params = (os.path.normpath(original),)
+        with self.lock:
+            return self.connection.execute(
+                query + " ORDER BY quarantined DESC, id DESC", params
+            ).fetchall()
+
+    def total_size(self):
+        """Return the total size of the quarantined files."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        return row[0]
+
+    def _drop(self, entry_id, stored):
+        self.connection.execute(
+            "DELETE FROM entries WHERE id = ?", (entry_id,)
+        )
+        folder = os.path.dirname(os.path.join(self.folder, stored))
+        while folder != self.folder:
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+    def restore(self, original, dest=None, entry_id=None):
+        """Move a quarantined file back into the backup folder.
+
+        Arguments:
+        original -- path the file had, relative to the backup folder
+        dest -- where to put it, its original path by default
+        entry_id -- entry to restore, the newest one of original by default
+
+        Return the path the file was restored to. Raise KeyError if there
+        is no such entry and FileExistsError if dest is taken.
+        """
+        original = os.path.normpath(original)
+        query = "SELECT id, stored FROM entries WHERE original = ?"
+        params = (original,)
+        if entry_id is not None:
+            query += " AND id = ?"
+            params += (entry_id,)
+        with self.lock:
+            row = self.connection.execute(
+                query + " ORDER BY quarantined DESC, id DESC", params
+            ).fetchone()
+            if row is None:
+                raise KeyError(original)
+            if dest is None:
+                dest = os.path.join(self.backup_root, original)
+            if os.path.lexists(dest):
+                raise FileExistsError(errno.EEXIST, "File exists", dest)
+            folder = os.path.dirname(dest)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            _rename(os.path.join(self.folder, row[1]), dest)
+            self._drop(*row)
+            self.connection.commit()
+        return dest
+
+    def purge(self, now=None):
+        """Delete entries past the age limit, then the oldest ones until the
+        quarantine fits the size limit.
+
+        Return the number of entries deleted.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, stored, size, quarantined FROM entries"
+                " ORDER BY quarantined, id"
+            ).fetchall()
+            total = sum(row[2] for row in rows)
+            purged = 0
+            for entry_id, stored, size, quarantined in rows:
+                age = now - quarantined
+                if self.max_age is None or age <= self.max_age:
+                    if self.max_bytes is None or total <= self.max_bytes:
+                        break
+                _remove(os.path.join(self.folder, stored))
+                self._drop(entry_id, stored)
+                total -= size
+                purged += 1
+            self.connection.commit()
+        return purged
+
+    def close(self):
+        """Save and close the manifest."""
+        self.connection.commit()
+        self.connection.close()
+        try:
+            os.remove(self.marker)
+        except FileNotFoundError:
+            pass
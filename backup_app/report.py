@@ -4,8 +4,125 @@ Compare the current state of a source folder with the current state of the
 backup folder.
 """
 
-import filecmp
 import os
+import stat
+from collections import Counter
+
+from .fingerprint import fingerprint_tree
+from .hashing import ContentDigests
+from .sparse import allocated_size
+
+DIR_SIMILARITY = 0.5
+SIZED_KEYS = ("added_files", "mismatched_files", "removed_files")
+
+
+class Entry:
+    """One file, folder or moved pair listed in a report category."""
+
+    __slots__ = ("key", "size", "mtime_ns", "pair")
+
+    def __init__(self, key, size=None, mtime_ns=None, pair=None):
+        self.key = key
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.pair = pair
+
+
+class EntryList:
+    """Insertion-ordered report category with O(1) membership and removal.
+
+    Behaves like the list it replaces: iterating yields the listed paths,
+    or (old, new) pairs for moved files, and it compares equal to a list
+    holding the same items in the same order. Indexing goes through a list
+    of the keys, built on first use and dropped whenever the category
+    changes, so a loop reading it by position stays linear.
+    """
+
+    __hash__ = None  # type: ignore
+
+    def __init__(self, keys=()):
+        self._entries = {}
+        self._keys = None
+        self.extend(keys)
+
+    def _key_list(self):
+        if self._keys is None:
+            self._keys = list(self._entries)
+        return self._keys
+
+    def add(self, key, stat_result=None):
+        """Add a path or pair, with its stat result if known.
+
+        Return its Entry.
+        """
+        entry = Entry(key, pair=key if isinstance(key, tuple) else None)
+        if stat_result is not None:
+            entry.size = stat_result.st_size
+            entry.mtime_ns = stat_result.st_mtime_ns
+        self._entries[key] = entry
+        self._keys = None
+        return entry
+
+    def append(self, key):
+        """Add a path or pair."""
+        self.add(key)
+
+    def extend(self, keys):
+        """Add several paths or pairs."""
+        for key in keys:
+            self.add(key)
+
+    def remove(self, key):
+        """Remove a path or pair, raising ValueError if it is not listed."""
+        try:
+            del self._entries[key]
+        except KeyError as error:
+            raise ValueError(f"{key!r} is not in the report") from error
+        self._keys = None
+
+    def discard(self, key):
+        """Remove a path or pair if it is listed."""
+        if self._entries.pop(key, None) is not None:
+            self._keys = None
+
+    def entry(self, key):
+        """Return the Entry of a path or pair."""
+        return self._entries[key]
+
+    def entries(self):
+        """Return the Entry records in order."""
+        return self._entries.values()
+
+    def index(self, key):
+        """Return the position of a path or pair."""
+        if key not in self._entries:
+            raise ValueError(f"{key!r} is not in the report")
+        return self._key_list().index(key)
+
+    def clear(self):
+        """Remove every path or pair."""
+        self._entries.clear()
+        self._keys = None
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        return self._key_list()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, (EntryList, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 class Report:
@@ -15,81 +132,245 @@ class Report:
         if not report_dict:
             report_dict = {}
         self.items = report_dict
+        for key, value in self.items.items():
+            self[key] = value
         self.source = source
         self.backup = backup
+        self.stats = {}
+        self.move_scores = {}
 
     def __getitem__(self, key):
         return self.items[key]
 
     def __setitem__(self, key, value):
+        if not isinstance(value, EntryList):
+            value = EntryList(value)
         self.items[key] = value
 
     def __contains__(self, key):
         return key in self.items
 
-    def _file_already_in_moved_files(self, filename):
-        for file_pair in self.items["moved_files"]:
-            if filename == file_pair[0]:
-                return True
-        return False
+    def _stat(self, path):
+        """Return the stat result for path, reusing the one from the scan."""
+        if path not in self.stats:
+            try:
+                self.stats[path] = os.stat(path)
+            except OSError:
+                self.stats[path] = None
+        return self.stats[path]
+
+    def _tree_stats(self, path):
+        """Yield the stat result of a file, or of every file in a folder."""
+        stat_result = self._stat(path)
+        if stat_result is None:
+            return
+        if not stat.S_ISDIR(stat_result.st_mode):
+            yield stat_result
+            return
+        for folder, _, files in os.walk(path):
+            for name in files:
+                file_stat = self._stat(os.path.join(folder, name))
+                if file_stat is not None:
+                    yield file_stat
+
+    def disk_usage(self, key):
+        """Return the apparent and allocated bytes of a category.
+
+        Added and mismatched files are measured in the source folder, the
+        others in the backup folder. Folders count the files inside them.
+        Stat results from the scan are reused. A sparse file is larger than
+        the space it takes on disk.
+        """
+        root = (
+            self.source
+            if key in ("added_files", "mismatched_files")
+            else self.backup
+        )
+        apparent = allocated = 0
+        for entry in self.items[key].entries():
+            if entry.pair is not None:
+                continue
+            for stat_result in self._tree_stats(os.path.join(root, entry.key)):
+                apparent += stat_result.st_size
+                allocated += allocated_size(stat_result)
+        return apparent, allocated
+
+    def size_summary(self, keys=SIZED_KEYS):
+        """Return {key: (apparent bytes, allocated bytes)} for categories."""
+        return {key: self.disk_usage(key) for key in keys if key in self.items}
+
+    def _isfile(self, path):
+        stat_result = self._stat(path)
+        return stat_result is not None and stat.S_ISREG(stat_result.st_mode)
+
+    def _isdir(self, path):
+        stat_result = self._stat(path)
+        return stat_result is not None and stat.S_ISDIR(stat_result.st_mode)
+
+    def _removed_files_by_size(self):
+        """Group removed files by size, keeping their report order."""
+        buckets = {}
+        for removed in self.items["removed_files"]:
+            old_file = os.path.join(self.backup, removed)
+            if self._isfile(old_file):
+                size = self._stat(old_file).st_size
+                buckets.setdefault(size, []).append(removed)
+        return buckets
+
+    def _find_moved_file(self, new_file, removed_by_size, digests):
+        """Return the removed file with the same contents as new_file.
+
+        Only regular files are looked for; broken links and special files
+        are skipped.
+        """
+        if not self._isfile(new_file):
+            return None
+        bucket = removed_by_size.get(self._stat(new_file).st_size, [])
+        for removed in bucket:
+            old_file = os.path.join(self.backup, removed)
+            if digests.same_contents(new_file, old_file):
+                bucket.remove(removed)
+                return removed
+        return None
+
+    def _find_moved_dir(
+        self, new_print, removed_by_fingerprint, leaf_index, fingerprints
+    ):
+        """Return the removed folder a new folder was most likely moved from.
+
+        Folders with the same fingerprint are found by lookup, and used if
+        their files have the same modification times. Otherwise the most
+        similar removed folder is used if it shares more than DIR_SIMILARITY
+        of its files; only the folders sharing a file with the new one,
+        found through leaf_index, are scored.
+        Return (removed, score) or (None, 0).
+        """
+        same = removed_by_fingerprint.get(new_print.digest, {})
+        for removed, old_print in same.items():
+            if new_print.same_files(old_print):
+                return removed, 1.0
+        shared = Counter()
+        for leaf in new_print.leaves:
+            for removed in leaf_index.get(leaf, ()):
+                if new_print.matches(leaf, fingerprints[removed][0]):
+                    shared[removed] += 1
+        best, best_rank = None, (DIR_SIMILARITY, 0)
+        for removed, count in shared.items():
+            old_print, position = fingerprints[removed]
+            rank = (new_print.share(count, old_print), -position)
+            if rank > best_rank:
+                best, best_rank = removed, rank
+        if best is None:
+            return None, 0
+        return best, best_rank[0]
+
+    @staticmethod
+    def _leaf_index(fingerprints):
+        """Map each file path and size to the removed folders holding it."""
+        index = {}
+        for removed, (old_print, _) in fingerprints.items():
+            for leaf in old_print.leaves:
+                index.setdefault(leaf, set()).add(removed)
+        return index
+
+    def _removed_dirs_by_fingerprint(self):
+        """Group removed folders by the digest of their fingerprint."""
+        fingerprints = {}
+        for removed in self.items["removed_files"]:
+            old_file = os.path.join(self.backup, removed)
+            if self._isdir(old_file):
+                try:
+                    old_print = fingerprint_tree(old_file)
+                except OSError:
+                    continue
+                fingerprints.setdefault(old_print.digest, {})[
+                    removed
+                ] = old_print
+        return fingerprints
 
     def examine(self):
         """Return examined report as dictionary
 
         Look for files that were moved from one location to another.
+        Candidate files are bucketed by size, then compared by a partial
+        and a full digest, so each file is read at most once. Folders are
+        matched by their tree fingerprint, or failing that by the share of
+        files they have in common; the score of each folder move is kept in
+        self.move_scores.
         Update report and return self.items.
         """
-        self.items["moved_files"] = []
-        to_delete_ad = []
-        to_delete_rm = []
-        to_delete_rm_val = []
+        self["moved_files"] = EntryList()
+        self.move_scores = {}
+        digests = ContentDigests()
+        removed_by_size = self._removed_files_by_size()
+        removed_by_fingerprint = self._removed_dirs_by_fingerprint()
+        # report order breaks ties between equally similar folders
+        positions = {
+            removed: position
+            for position, removed in enumerate(self.items["removed_files"])
+        }
+        fingerprints = {
+            removed: (old_print, positions[removed])
+            for candidates in removed_by_fingerprint.values()
+            for removed, old_print in candidates.items()
+        }
+        leaf_index = self._leaf_index(fingerprints)
+        moved_added = set()
+        moved_removed = set()
 
-        # for every file that's only in a, compare to files only in b
-        for i, added in enumerate(self.items["added_files"]):
+        for added in self.items["added_files"]:
             new_file = os.path.join(self.source, added)
             new_path = os.path.join(self.backup, added)
-            for j, removed in enumerate(self.items["removed_files"]):
+            # if file is a file, look for an identical file of the same size
+            if self._isfile(new_file):
+                removed = self._find_moved_file(
+                    new_file, removed_by_size, digests
+                )
+                if removed is not None:
+                    self.items["moved_files"].append(
+                        (os.path.join(self.backup, removed), new_path)
+                    )
+                    moved_added.add(added)
+                    moved_removed.add(removed)
+            # If file is a dir, look for the same or a similar dir
+            elif self._isdir(new_file):
+                try:
+                    new_print = fingerprint_tree(new_file)
+                except OSError:
+                    continue
+                removed, score = self._find_moved_dir(
+                    new_print, removed_by_fingerprint, leaf_index, fingerprints
+                )
+                if removed is None:
+                    continue
+                old_print = fingerprints[removed][0]
+                del removed_by_fingerprint[old_print.digest][removed]
+                for leaf in old_print.leaves:
+                    leaf_index[leaf].discard(removed)
                 old_file = os.path.join(self.backup, removed)
-                # if file is a file, check for identical files
-                if os.path.isfile(new_file) and os.path.isfile(old_file):
-                    if filecmp.cmp(new_file, old_file, shallow=False):
-                        if not self._file_already_in_moved_files(old_file):
-                            self.items["moved_files"].append(
-                                (old_file, new_path)
-                            )
-                            to_delete_ad.append(i)
-                            to_delete_rm.append(j)
-                # If file is a dir, check for similar dirs
-                elif os.path.isdir(new_file) and os.path.isdir(old_file):
-                    temp_report = filecmp.dircmp(new_file, old_file)
-                    length = len(temp_report.left_only) + len(
-                        temp_report.right_only
+                self.items["moved_files"].append((old_file, new_path))
+                self.move_scores[(old_file, new_path)] = score
+                moved_added.add(added)
+                moved_removed.add(removed)
+                # files that only exist in the new dir may have been moved
+                # into it from elsewhere
+                for leaf in new_print.unmatched(old_print):
+                    leaf_file = os.path.join(new_file, leaf)
+                    if not self._isfile(leaf_file):
+                        continue
+                    found = self._find_moved_file(
+                        leaf_file, removed_by_size, digests
                     )
-                    if len(temp_report.common) > length:
-                        self.items["moved_files"].append((old_file, new_path))
-                        for new_find in (
-                            n
-                            for n in temp_report.left_only
-                            if n in self.items["removed_files"]
-                        ):
-                            to_delete_rm_val.append(new_find)
-                            self.items["moved_files"].append(
-                                (
-                                    os.path.join(self.backup, new_find),
-                                    os.path.join(new_path, new_find),
-                                )
+                    if found is not None:
+                        self.items["moved_files"].append(
+                            (
+                                os.path.join(self.backup, found),
+                                os.path.join(new_path, leaf),
                             )
-                        to_delete_ad.append(i)
-                        to_delete_rm.append(j)
-        to_delete_ad = list(set(to_delete_ad))
-        to_delete_ad.sort(reverse=True)
-        to_delete_rm = list(set(to_delete_rm))
-        to_delete_rm.sort(reverse=True)
-        for del_index in to_delete_rm:
-            del self.items["removed_files"][del_index]
-        for del_index in to_delete_ad:
-            del self.items["added_files"][del_index]
-        self.items["removed_files"] = [
-            x for x in self.items["removed_files"] if x not in to_delete_rm_val
-        ]
+                        )
+                        moved_removed.add(found)
+        for added in moved_added:
+            self.items["added_files"].remove(added)
+        for removed in moved_removed:
+            self.items["removed_files"].remove(removed)
         return self
@@ -0,0 +1,579 @@
+"""This script walks a source folder and a backup folder together
+
+Both trees are listed with os.scandir and the entries of each pair of
+directories are merge-joined by name. The stat results cached on each
+DirEntry are reused, so every path is stat-ed at most once per scan.
+"""
+
+import filecmp
+import os
+import stat
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .comparison import mtimes_match
+from .hashing import file_digest
+from .metadata import METADATA_DIR
+from .report import Report
+from .sparse import extents_equal, is_sparse
+
+BUFSIZE = 8 * 1024
+IGNORE = frozenset(filecmp.DEFAULT_IGNORES + [METADATA_DIR])
+COMMON_DIR = "common_dir"
+# directories a parallel walk lists ahead of it, per worker
+LOOKAHEAD = 4
+KEYS = (
+    "added_files",
+    "removed_files",
+    "matched_files",
+    "mismatched_files",
+    "errors",
+    "attribute_files",
+)
+ADDED, REMOVED, MATCHED, MISMATCHED, ERROR, ATTRIBUTES = KEYS
+
+DiffEvent = namedtuple("DiffEvent", ("kind", "path", "stat"), defaults=(None,))
+DiffEvent.__doc__ = """A difference found between the source and backup trees.
+
+kind is one of the Report keys, path is relative to the scan roots and stat
+is the stat result of added and removed entries.
+"""
+
+
+def list_directory(path):
+    """Return the entries of a directory sorted by their normalised name."""
+    with os.scandir(path) as entries:
+        listing = [
+            (os.path.normcase(entry.name), entry)
+            for entry in entries
+            if entry.name not in IGNORE
+        ]
+    listing.sort(key=lambda pair: pair[0])
+    return listing
+
+
+def is_store(root):
+    """Return True if a scan root is a ContentStore rather than a path."""
+    return hasattr(root, "list_directory")
+
+
+def list_level(root, relpath):
+    """Return the sorted entries of a directory below a scan root."""
+    if is_store(root):
+        return root.list_directory(relpath)
+    return list_directory(os.path.join(root, relpath))
+
+
+def signature(stat_result):
+    """Return the shallow comparison signature used by filecmp."""
+    return (
+        stat.S_IFMT(stat_result.st_mode),
+        stat_result.st_size,
+        stat_result.st_mtime,
+    )
+
+
+def contents_equal(path_a, path_b):
+    """Compare two files byte by byte."""
+    with open(path_a, "rb") as file_a, open(path_b, "rb") as file_b:
+        while True:
+            chunk_a = file_a.read(BUFSIZE)
+            chunk_b = file_b.read(BUFSIZE)
+            if chunk_a != chunk_b:
+                return False
+            if not chunk_a:
+                return True
+
+
+def _compare_contents(
+    path_a, stat_a, path_b, stat_b, hash_cache=None, throttle=None
+):
+    if throttle is not None:
+        throttle.read(stat_a.st_size + stat_b.st_size, ops=2)
+    if hash_cache is not None:
+        return hash_cache.digest(path_a, stat_a) == hash_cache.digest(
+            path_b, stat_b
+        )
+    if is_sparse(stat_a, path_a) or is_sparse(stat_b, path_b):
+        return extents_equal(path_a, path_b)
+    return contents_equal(path_a, path_b)
+
+
+def compare_stats(
+    path_a,
+    stat_a,
+    path_b,
+    stat_b,
+    shallow=True,
+    hash_cache=None,
+    throttle=None,
+    digest_b=None,
+    compare_cache=None,
+):
+    """Compare two files given their stat results.
+
+    If a hash cache is given, contents are compared by digest, so files
+    whose stat signature did not change since they were hashed are not read.
+    If a throttle is given, reading contents waits for its read budget.
+    If the digest of the second file is known, only the first one is read.
+    Sparse files are compared over their data extents only.
+    If a compare cache is given, the result of comparing the contents of
+    two files is reused while neither of them changes.
+
+    Return True if the files match, False if they do not. Raise OSError if
+    either file cannot be read.
+    """
+    if not stat.S_ISREG(stat_a.st_mode) or not stat.S_ISREG(stat_b.st_mode):
+        return False
+    if shallow and signature(stat_a) == signature(stat_b):
+        return True
+    if stat_a.st_size != stat_b.st_size:
+        return False
+    if digest_b is not None:
+        if throttle is not None:
+            throttle.read(stat_a.st_size)
+        if hash_cache is not None:
+            return hash_cache.digest(path_a, stat_a) == digest_b
+        return file_digest(path_a) == digest_b
+    if compare_cache is None:
+        return _compare_contents(
+            path_a, stat_a, path_b, stat_b, hash_cache, throttle
+        )
+    return compare_cache.compare(
+        compare_cache.key(path_a, stat_a, path_b, stat_b),
+        lambda: _compare_contents(
+            path_a, stat_a, path_b, stat_b, hash_cache, throttle
+        ),
+    )
+
+
+def attributes_differ(stat_a, stat_b):
+    """Return True if two files differ in modification time or permissions.
+
+    Modification times are compared with comparison.mtimes_match, as
+    filesystems store them with different precision. Owners are compared
+    too when running as root, which can change them.
+    """
+    if not mtimes_match(stat_a.st_mtime_ns, stat_b.st_mtime_ns):
+        return True
+    if stat.S_IMODE(stat_a.st_mode) != stat.S_IMODE(stat_b.st_mode):
+        return True
+    if hasattr(os, "geteuid") and os.geteuid() == 0:
+        return (stat_a.st_uid, stat_a.st_gid) != (stat_b.st_uid, stat_b.st_gid)
+    return False
+
+
+def compare_category(
+    path_a,
+    stat_a,
+    path_b,
+    stat_b,
+    shallow=True,
+    hash_cache=None,
+    throttle=None,
+    digest_b=None,
+    compare_cache=None,
+):
+    """Return the Report key two files belong under.
+
+    Files whose contents match but whose attributes differ are listed
+    under ATTRIBUTES, so only their metadata needs to be copied. Takes the
+    same arguments as compare_stats.
+    """
+    if not compare_stats(
+        path_a,
+        stat_a,
+        path_b,
+        stat_b,
+        shallow,
+        hash_cache,
+        throttle,
+        digest_b,
+        compare_cache,
+    ):
+        return MISMATCHED
+    if digest_b is None and attributes_differ(stat_a, stat_b):
+        return ATTRIBUTES
+    return MATCHED
+
+
+def compare_entries(
+    entry_a, entry_b, shallow=True, hash_cache=None, throttle=None
+):
+    """Compare two common files using their cached stat results.
+
+    Entries listed from a ContentStore are compared by their stored digest.
+    """
+    return compare_stats(
+        entry_a.path,
+        entry_a.stat(),
+        entry_b.path,
+        entry_b.stat(),
+        shallow,
+        hash_cache,
+        throttle,
+        getattr(entry_b, "digest", None),
+    )
+
+
+def compare_paths(path_a, path_b, shallow=True, hash_cache=None):
+    """Compare two files by path."""
+    return compare_stats(
+        path_a, os.stat(path_a), path_b, os.stat(path_b), shallow, hash_cache
+    )
+
+
+def merge_entries(listing_a, listing_b):
+    """Merge-join two sorted listings.
+
+    Yield (entry_a, entry_b) pairs where either side is None if the name only
+    exists in one of the listings.
+    """
+    i, j = 0, 0
+    while i < len(listing_a) and j < len(listing_b):
+        key_a, entry_a = listing_a[i]
+        key_b, entry_b = listing_b[j]
+        if key_a == key_b:
+            yield entry_a, entry_b
+            i += 1
+            j += 1
+        elif key_a < key_b:
+            yield entry_a, None
+            i += 1
+        else:
+            yield None, entry_b
+            j += 1
+    for _, entry_a in listing_a[i:]:
+        yield entry_a, None
+    for _, entry_b in listing_b[j:]:
+        yield None, entry_b
+
+
+def _stat_or_none(entry):
+    try:
+        return entry.stat()
+    except OSError:
+        return None
+
+
+def _directory_mtimes(path_a, path_b):
+    try:
+        return (os.stat(path_a).st_mtime_ns, os.stat(path_b).st_mtime_ns)
+    except OSError:
+        return None
+
+
+def replay_level(relpath, rows):
+    """Yield the stored results of an unchanged directory as events."""
+    for name, category in rows:
+        yield DiffEvent(category, os.path.join(relpath, name))
+
+
+def diff_level(
+    dira,
+    dirb,
+    relpath,
+    shallow=True,
+    index=None,
+    mtimes=None,
+    hash_cache=None,
+    throttle=None,
+    compare_cache=None,
+):
+    """Compare the direct children of one pair of directories.
+
+    Yield a DiffEvent per child, with paths relative to the scan roots.
+    dirb may be a ContentStore, whose manifest is listed instead.
+    Directories found on both sides are yielded as COMMON_DIR events.
+    If an index is given, the results of a directory whose mtimes match the
+    indexed ones, and whose files still have their indexed stat signatures,
+    are taken from the index instead.
+    """
+    if index is not None and mtimes is not None:
+        rows = index.load_level(
+            relpath,
+            mtimes,
+            (os.path.join(dira, relpath), os.path.join(dirb, relpath)),
+        )
+        if rows is not None:
+            yield from replay_level(relpath, rows)
+            return
+    if throttle is not None:
+        throttle.read(ops=2)
+    try:
+        listing_a = list_level(dira, relpath)
+        listing_b = list_level(dirb, relpath)
+    except OSError:
+        yield DiffEvent(ERROR, relpath)
+        return
+    rows = []
+    for entry_a, entry_b in merge_entries(listing_a, listing_b):
+        name = entry_a.name if entry_a is not None else entry_b.name
+        stat_result = None
+        try:
+            if entry_b is None:
+                category = ADDED
+                stat_result = entry_a.stat()
+            elif entry_a is None:
+                category = REMOVED
+                stat_result = entry_b.stat()
+            elif entry_a.is_dir() and entry_b.is_dir():
+                category = COMMON_DIR
+            elif entry_a.is_dir() or entry_b.is_dir():
+                category = ERROR
+            else:
+                category = compare_category(
+                    entry_a.path,
+                    entry_a.stat(),
+                    entry_b.path,
+                    entry_b.stat(),
+                    shallow,
+                    hash_cache,
+                    throttle,
+                    getattr(entry_b, "digest", None),
+                    compare_cache,
+                )
+        except OSError:
+            category = ERROR
+        yield DiffEvent(category, os.path.join(relpath, name), stat_result)
+        if index is not None:
+            if entry_a is not None:
+                rows.append((name, "a", _stat_or_none(entry_a), category))
+            if entry_b is not None:
+                rows.append(
+                    (
+                        name,
+                        "b",
+                        _stat_or_none(entry_b),
+                        category if entry_a is None else None,
+                    )
+                )
+    if index is not None and mtimes is not None:
+        index.store_level(relpath, mtimes, rows)
+
+
+def _level_mtimes(dira, dirb, relpath, index):
+    if index is None or is_store(dirb):
+        return None
+    return _directory_mtimes(
+        os.path.join(dira, relpath), os.path.join(dirb, relpath)
+    )
+
+
+def _diff_level_apart(
+    dira, dirb, relpath, shallow, index, hash_cache, throttle, compare_cache
+):
+    mtimes = _level_mtimes(dira, dirb, relpath, index)
+    return list(
+        diff_level(
+            dira,
+            dirb,
+            relpath,
+            shallow,
+            index,
+            mtimes,
+            hash_cache,
+            throttle,
+            compare_cache,
+        )
+    )
+
+
+def _split_level(events):
+    children = []
+    for event in events:
+        if event.kind == COMMON_DIR:
+            children.append(event.path)
+        else:
+            yield event
+    return children
+
+
+def _walk_parallel(
+    dira,
+    dirb,
+    shallow,
+    index,
+    hash_cache,
+    workers,
+    throttle=None,
+    compare_cache=None,
+):
+    """Yield the events of both trees, listing subtrees in a thread pool.
+
+    Every pair of common directories is listed and compared by a worker,
+    which submits the common subdirectories it finds before it returns, so
+    the pool works ahead on every level at once. At most LOOKAHEAD times
+    workers directories are listed ahead of the walk; once that many are
+    waiting, the walk submits the ones it is about to reach as it drains
+    them. Events are yielded in the serial visiting order, so the stream
+    is identical to the one of a serial scan.
+    """
+    window = LOOKAHEAD * workers
+    futures = {}
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def visit(relpath):
+        events = _diff_level_apart(
+            dira,
+            dirb,
+            relpath,
+            shallow,
+            index,
+            hash_cache,
+            throttle,
+            compare_cache,
+        )
+        for event in events:
+            if event.kind == COMMON_DIR and not submit(event.path):
+                break
+        return events
+
+    def submit(relpath):
+        """Submit a directory unless the window is full; return False if
+        it is.
+        """
+        with lock:
+            if relpath in futures:
+                return True
+            if stopped.is_set() or len(futures) >= window:
+                return False
+            futures[relpath] = pool.submit(visit, relpath)
+            return True
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        order = [""]
+        while order:
+            relpath = order.pop()
+            with lock:
+                future = futures.pop(relpath, None)
+            if future is None:
+                future = pool.submit(visit, relpath)
+            events = future.result()
+            children = [e.path for e in events if e.kind == COMMON_DIR]
+            order.extend(reversed(children))
+            for upcoming in reversed(order):
+                if not submit(upcoming):
+                    break
+            for event in events:
+                if event.kind != COMMON_DIR:
+                    yield event
+    finally:
+        stopped.set()
+        pool.shutdown(cancel_futures=True)
+
+
+def walk_diff(
+    dira,
+    dirb,
+    shallow=True,
+    index=None,
+    workers=1,
+    hash_cache=None,
+    throttle=None,
+    compare_cache=None,
+):
+    """Compare a source tree with a backup tree, yielding DiffEvents.
+
+    Arguments:
+    dira -- source folder path
+    dirb -- backup folder path, or a ContentStore to diff against
+    shallow -- trust matching stat signatures instead of reading contents
+    index -- optional ScanIndex used to skip unchanged directories
+    workers -- number of threads listing directories at the same time
+    hash_cache -- optional HashCache used to compare contents by digest
+    throttle -- optional Throttle limiting the reads of the walk
+    compare_cache -- optional CompareCache reusing earlier comparisons
+
+    Events are yielded as the walk goes, in the order of a recursive
+    filecmp.dircmp comparison: the entries of a directory come before those
+    of its subdirectories, which are visited in name order.
+    """
+    if index is not None:
+        index.start(dira, shallow)
+    if workers > 1:
+        yield from _walk_parallel(
+            dira,
+            dirb,
+            shallow,
+            index,
+            hash_cache,
+            workers,
+            throttle,
+            compare_cache,
+        )
+    else:
+        pending = [""]
+        while pending:
+            relpath = pending.pop()
+            mtimes = _level_mtimes(dira, dirb, relpath, index)
+            children = yield from _split_level(
+                diff_level(
+                    dira,
+                    dirb,
+                    relpath,
+                    shallow,
+                    index,
+                    mtimes,
+                    hash_cache,
+                    throttle,
+                    compare_cache,
+                )
+            )
+            pending.extend(reversed(children))
+    if index is not None:
+        index.finish()
+
+
+def build_report(events, source, backup, keep_matched=True):
+    """Build a Report from a stream of DiffEvents.
+
+    Arguments:
+    events -- iterable of DiffEvents
+    source -- source folder path the events are relative to
+    backup -- backup folder path the events are relative to
+    keep_matched -- also list matched files, which are usually the bulk of
+                    a scan and are not needed to sync
+    """
+    report = Report({key: [] for key in KEYS}, source=source, backup=backup)
+    for event in events:
+        if event.kind == MATCHED and not keep_matched:
+            continue
+        report[event.kind].add(event.path, event.stat)
+        if event.stat is not None:
+            root = source if event.kind == ADDED else backup
+            report.stats[os.path.join(root, event.path)] = event.stat
+    return report
+
+
+def compare_trees(
+    dira,
+    dirb,
+    shallow=True,
+    index=None,
+    workers=1,
+    hash_cache=None,
+    throttle=None,
+    compare_cache=None,
+):
+    """Compare a source tree with a backup tree and return a Report.
+
+    Takes the same arguments as walk_diff.
+    """
+    return build_report(
+        walk_diff(
+            dira,
+            dirb,
+            shallow,
+            index,
+            workers,
+            hash_cache,
+            throttle,
+            compare_cache,
+        ),
+        dira,
+        dirb,
+    )
@@ -0,0 +1,169 @@
+"""This script scrubs a backup folder for silent corruption
+
+Each session re-reads files of the backup folder in a fixed order and
+compares their digests with the ones recorded in the hash cache when they
+were copied or last scanned. A session stops once its time or byte budget
+is spent, and saves a cursor in the metadata folder so the next session
+continues after the last file checked. Files with no recorded digest get
+one, so they can be checked on the next pass. Reads are read from disk
+rather than the page cache and may be limited by a Throttle.
+"""
+
+import json
+import logging
+import os
+import time
+
+from .metadata import METADATA_DIR, metadata_path
+from .verify import disk_digest
+
+CURSOR_NAME = "scrub_cursor.json"
+CORRUPT, UNREADABLE = "corrupt", "unreadable"
+
+
+class ScrubResult:
+    """The files checked by one scrub session and the problems found."""
+
+    def __init__(self):
+        self.checked = 0
+        self.recorded = 0
+        self.bytes = 0
+        self.problems = []
+        self.finished_pass = False
+
+    def summary(self):
+        """Return a line describing the session."""
+        return (
+            f"checked {self.checked} files ({self.bytes} bytes), recorded "
+            f"{self.recorded} new digests, found {len(self.problems)} "
+            f"problems{', finished a pass' if self.finished_pass else ''}"
+        )
+
+
+class Scrubber:
+    """Checks the files of a backup folder against their recorded digests.
+
+    Arguments:
+    backup_root -- backup folder to scrub
+    hash_cache -- HashCache holding the recorded digests
+    time_budget -- seconds a session may run for, or None
+    byte_budget -- bytes a session may read, or None
+    throttle -- optional Throttle limiting the reads
+    """
+
+    def __init__(
+        self,
+        backup_root,
+        hash_cache,
+        time_budget=None,
+        byte_budget=None,
+        throttle=None,
+        clock=time.monotonic,
+    ):
+        self.backup_root = backup_root
+        self.hash_cache = hash_cache
+        self.time_budget = time_budget
+        self.byte_budget = byte_budget
+        self.throttle = throttle
+        self.clock = clock
+        self.path = metadata_path(backup_root, CURSOR_NAME)
+        self.logger = logging.getLogger(f"{__name__}.{type(self).__name__}")
+        self.cursor = ""
+        self.passes = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as filein:
+                state = json.load(filein)
+            self.cursor = state["cursor"]
+            self.passes = state["passes"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        """Write the cursor to the metadata folder."""
+        with open(self.path, "w", encoding="utf-8") as out:
+            json.dump({"cursor": self.cursor, "passes": self.passes}, out)
+
+    def files(self, after=""):
+        """Yield the relative paths of the backup files, in name order.
+
+        Only paths that sort after the given one are yielded; folders that
+        come before it are not listed.
+        """
+        bound = after.split(os.sep) if after else None
+        yield from self._files("", bound)
+
+    def _files(self, relpath, bound):
+        try:
+            with os.scandir(os.path.join(self.backup_root, relpath)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return
+        for entry in entries:
+            if not relpath and entry.name == METADATA_DIR:
+                continue
+            child = os.path.join(relpath, entry.name)
+            child_bound = None
+            if bound is not None:
+                if entry.name < bound[0]:
+                    continue
+                if entry.name == bound[0]:
+                    child_bound = bound[1:]
+                    if not child_bound:
+                        continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from self._files(child, child_bound)
+            elif entry.is_file(follow_symlinks=False):
+                yield child
+
+    def _spent(self, result, start):
+        if self.time_budget is not None:
+            if self.clock() - start >= self.time_budget:
+                return True
+        if self.byte_budget is not None:
+            return result.bytes >= self.byte_budget
+        return False
+
+    def check(self, relpath, result):
+        """Check one file against its recorded digest."""
+        path = os.path.join(self.backup_root, relpath)
+        try:
+            stat_result = os.stat(path)
+            if self.throttle is not None:
+                self.throttle.read(stat_result.st_size)
+            expected = self.hash_cache.lookup(path, stat_result)
+            digest = disk_digest(path)
+        except OSError:
+            self.logger.error("Could not read %s", path)
+            result.problems.append((relpath, UNREADABLE))
+            return
+        result.checked += 1
+        result.bytes += stat_result.st_size
+        if expected is None:
+            self.hash_cache.store(path, stat_result, digest)
+            result.recorded += 1
+        elif digest != expected:
+            self.logger.error("%s does not match its recorded digest", path)
+            result.problems.append((relpath, CORRUPT))
+
+    def run(self):
+        """Run one session from the saved cursor and return a ScrubResult.
+
+        When the end of the backup folder is reached, the cursor goes back
+        to the start for the next pass.
+        """
+        result = ScrubResult()
+        start = self.clock()
+        finished = True
+        for relpath in self.files(self.cursor):
+            if self._spent(result, start):
+                finished = False
+                break
+            self.check(relpath, result)
+            self.cursor = relpath
+        if finished:
+            self.cursor = ""
+            self.passes += 1
+            result.finished_pass = True
+        self.save()
+        self.logger.info("Scrub: %s", result.summary())
+        return result
@@ -0,0 +1,208 @@
+"""This script keeps a history of dated snapshots of the source folder
+
+Each snapshot is a full tree in the backup folder, named after the time it
+was taken. Files that did not change since the previous snapshot are hard
+links into it, so they are neither read nor stored again; only added and
+changed files are copied. Old snapshots are thinned out, keeping the
+newest snapshot of each of the last few hours, days and weeks.
+"""
+
+import logging
+import os
+import shutil
+from datetime import datetime
+
+from .metadata import metadata_path
+
+STAMP_FORMAT = "%Y-%m-%d_%H%M%S.%f"
+PARTIAL_SUFFIX = ".partial"
+EMPTY_DIR = "empty_snapshot"
+RETENTION = {"recent": 10, "hourly": 24, "daily": 7, "weekly": 4}
+PERIODS = {
+    "recent": STAMP_FORMAT,
+    "hourly": "%Y-%m-%d %H",
+    "daily": "%Y-%m-%d",
+    "weekly": "%G-%V",
+}
+
+
+def snapshot_time(name):
+    """Return the time a snapshot folder name stands for, or None."""
+    try:
+        return datetime.strptime(name, STAMP_FORMAT)
+    except ValueError:
+        return None
+
+
+def _relative(path, root):
+    return os.path.normpath(os.path.relpath(path, root))
+
+
+class SnapshotHistory:
+    """The dated snapshots kept in a backup folder.
+
+    Arguments:
+    backup_root -- backup folder the snapshots are kept in
+    retention -- dict with the number of recent, hourly, daily and weekly
+                 snapshots to keep; RETENTION by default
+    """
+
+    def __init__(self, backup_root, retention=None, now=datetime.now):
+        self.backup_root = backup_root
+        self.retention = dict(RETENTION if retention is None else retention)
+        self.now = now
+        self.logger = logging.getLogger(f"{__name__}.{type(self).__name__}")
+
+    def snapshots(self):
+        """Return (time, path) pairs of every snapshot, oldest first."""
+        found = []
+        with os.scandir(self.backup_root) as entries:
+            for entry in entries:
+                taken = snapshot_time(entry.name)
+                if taken is not None and entry.is_dir():
+                    found.append((taken, entry.path))
+        found.sort()
+        return found
+
+    def latest(self):
+        """Return the path of the newest snapshot, or None."""
+        snapshots = self.snapshots()
+        return snapshots[-1][1] if snapshots else None
+
+    def base(self):
+        """Return the folder the next snapshot is compared with.
+
+        That is the newest snapshot, or an empty folder if there is none.
+        """
+        latest = self.latest()
+        if latest is not None:
+            return latest
+        empty = metadata_path(self.backup_root, EMPTY_DIR)
+        os.makedirs(empty, exist_ok=True)
+        return empty
+
+    def _link_tree(self, old, new, skip, relpath=""):
+        """Hard-link every file below old into new, except skipped paths."""
+        os.makedirs(os.path.join(new, relpath), exist_ok=True)
+        with os.scandir(os.path.join(old, relpath)) as entries:
+            for entry in entries:
+                child = os.path.join(relpath, entry.name)
+                if os.path.normpath(child) in skip:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    self._link_tree(old, new, skip, child)
+                else:
+                    os.link(
+                        entry.path,
+                        os.path.join(new, child),
+                        follow_symlinks=False,
+                    )
+        shutil.copystat(os.path.join(old, relpath), os.path.join(new, relpath))
+
+    def _clear_partial(self):
+        with os.scandir(self.backup_root) as entries:
+            for entry in entries:
+                if entry.name.endswith(PARTIAL_SUFFIX) and snapshot_time(
+                    entry.name[: -len(PARTIAL_SUFFIX)]
+                ):
+                    shutil.rmtree(entry.path)
+
+    def create(self, report, source, copy_function=shutil.copy2):
+        """Take a snapshot of the source folder.
+
+        Arguments:
+        report -- examined Report comparing source with the folder
+                  returned by base()
+        source -- source folder path
+        copy_function -- function copying the added and changed files
+
+        Unchanged files and the new locations of moved files are hard
+        links into the previous snapshot. The snapshot is built under a
+        temporary name and renamed once complete.
+        Return (snapshot path, relative paths that failed to copy).
+        """
+        previous = report.backup
+        name = self.now().strftime(STAMP_FORMAT)
+        final = os.path.join(self.backup_root, name)
+        partial = final + PARTIAL_SUFFIX
+        self._clear_partial()
+        # files whose attributes changed are copied too, as a hard link
+        # shares its attributes with the previous snapshot
+        changed = [
+            relpath
+            for key in ("added_files", "mismatched_files", "attribute_files")
+            if key in report
+            for relpath in report[key]
+        ]
+        skip = {os.path.normpath(relpath) for relpath in changed}
+        skip.update(
+            os.path.normpath(relpath) for relpath in report["removed_files"]
+        )
+        moves = [
+            (_relative(old, previous), _relative(new, previous))
+            for old, new in report["moved_files"]
+        ]
+        skip.update(old for old, _ in moves)
+        self._link_tree(previous, partial, skip)
+        failed = []
+        for old, new in moves:
+            try:
+                self._link_move(previous, partial, old, new)
+            except OSError:
+                self.logger.exception("Could not link moved file %s", new)
+                failed.append(new)
+        for relpath in changed:
+            src = os.path.join(source, relpath)
+            dst = os.path.join(partial, relpath)
+            try:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if os.path.isdir(src):
+                    shutil.copytree(
+                        src,
+                        dst,
+                        copy_function=copy_function,
+                        dirs_exist_ok=True,
+                    )
+                else:
+                    copy_function(src, dst)
+            except OSError:
+                self.logger.exception("Could not copy %s", src)
+                failed.append(relpath)
+        os.rename(partial, final)
+        self.logger.info("Took snapshot %s", name)
+        return final, failed
+
+    def _link_move(self, previous, partial, old, new):
+        src = os.path.join(previous, old)
+        dst = os.path.join(partial, new)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.isdir(src):
+            self._link_tree(src, dst, set())
+        else:
+            os.link(src, dst, follow_symlinks=False)
+
+    def thin(self):
+        """Delete the snapshots the retention policy no longer keeps.
+
+        The newest snapshots are kept, along with the newest snapshot of
+        each of the last hours, days and weeks, as many of each as the
+        policy asks for. The newest snapshot is always kept.
+        Return the paths deleted.
+        """
+        snapshots = self.snapshots()[::-1]
+        keep = {path for _, path in snapshots[:1]}
+        for period, count in self.retention.items():
+            periods = set()
+            for taken, path in snapshots:
+                key = taken.strftime(PERIODS[period])
+                if key not in periods and len(periods) < count:
+                    periods.add(key)
+                    keep.add(path)
+        deleted = []
+        for _, path in snapshots:
+            if path not in keep:
+                shutil.rmtree(path)
+                deleted.append(path)
+        if deleted:
+            self.logger.info("Thinned out %d snapshots", len(deleted))
+        return deleted
@@ -0,0 +1,192 @@
+"""This script copies and compares sparse files without filling their holes
+
+The data extents of a file are found with lseek SEEK_DATA and SEEK_HOLE.
+Only those extents are copied, and the destination is truncated to the
+full size so the holes are recreated. Two files are compared over the
+union of their data extents, as a region that is a hole on both sides
+reads as zeros on both. Where the platform cannot report holes, the whole
+file is treated as one extent.
+"""
+
+import errno
+import os
+import shutil
+import stat
+
+BUFFER_SIZE = 1024 * 1024
+BLOCK_SIZE = 512
+
+
+def allocated_size(stat_result):
+    """Return the bytes a file takes on disk, or its size if unknown."""
+    blocks = getattr(stat_result, "st_blocks", None)
+    if blocks is None:
+        return stat_result.st_size
+    return blocks * BLOCK_SIZE
+
+
+def has_hole(path, size):
+    """Return True if lseek SEEK_HOLE finds a hole before the end of a file."""
+    if not size or not hasattr(os, "SEEK_HOLE"):
+        return False
+    try:
+        fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    except OSError:
+        return False
+    try:
+        return os.lseek(fd, 0, os.SEEK_HOLE) < size
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+
+
+def is_sparse(stat_result, path=None):
+    """Return True if a regular file takes less space than its size.
+
+    Compressed files take less space than their size too, so if the path is
+    given, the file must also have a hole that lseek reports.
+    """
+    if not stat.S_ISREG(stat_result.st_mode):
+        return False
+    if allocated_size(stat_result) >= stat_result.st_size:
+        return False
+    return path is None or has_hole(path, stat_result.st_size)
+
+
+def data_extents(fd, size):
+    """Yield the (start, end) offsets of the data regions of a file."""
+    if not hasattr(os, "SEEK_DATA"):
+        if size:
+            yield 0, size
+        return
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as error:
+            if error.errno == errno.ENXIO:
+                return
+            if error.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                yield offset, size
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        if start >= end:
+            return
+        yield start, end
+        offset = end
+
+
+def _copy_range(src_fd, dst_fd, start, end, progress=None):
+    offset = start
+    while offset < end:
+        count = min(BUFFER_SIZE, end - offset)
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                copied = os.copy_file_range(
+                    src_fd, dst_fd, count, offset, offset
+                )
+            except OSError as error:
+                if error.errno not in (errno.EXDEV, errno.ENOSYS):
+                    raise
+        if not copied:
+            data = os.pread(src_fd, count, offset)
+            if not data:
+                return
+            copied = os.pwrite(dst_fd, data, offset)
+        offset += copied
+        if progress is not None:
+            progress(copied)
+
+
+def sparse_copy(src, dst, progress=None):
+    """Copy the data extents of src to dst, leaving holes between them.
+
+    Metadata is copied as shutil.copy2 does. If progress is given, it is
+    called with the number of bytes of each chunk copied. Return dst.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    src_fd = os.open(src, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(
+            dst,
+            os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+            0o666,
+        )
+        try:
+            for start, end in data_extents(src_fd, size):
+                _copy_range(src_fd, dst_fd, start, end, progress)
+            os.ftruncate(dst_fd, size)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def sparse_copying(copy_function=shutil.copy2):
+    """Return a copy function that copies sparse files with sparse_copy.
+
+    Other files are copied with copy_function, which must take a progress
+    keyword if the returned function is given one.
+    """
+
+    def copy(src, dst, progress=None):
+        if is_sparse(os.stat(src), src):
+            return sparse_copy(src, dst, progress)
+        if progress is None:
+            return copy_function(src, dst)
+        return copy_function(src, dst, progress=progress)
+
+    return copy
+
+
+def copy2(src, dst, progress=None):
+    """Copy a file like shutil.copy2, keeping the holes of sparse files.
+
+    If progress is given, the file is copied in chunks and progress is
+    called with the number of bytes of each.
+    """
+    if progress is not None or is_sparse(os.stat(src), src):
+        return sparse_copy(src, dst, progress)
+    return shutil.copy2(src, dst)
+
+
+def _merge(extents):
+    merged = []
+    for start, end in sorted(extents):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def extents_equal(path_a, path_b):
+    """Compare two files of the same size, skipping shared holes."""
+    fd_a = os.open(path_a, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        fd_b = os.open(path_b, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            size = os.fstat(fd_a).st_size
+            if os.fstat(fd_b).st_size != size:
+                return False
+            extents = list(data_extents(fd_a, size))
+            extents += data_extents(fd_b, size)
+            for start, end in _merge(extents):
+                for offset in range(start, end, BUFFER_SIZE):
+                    count = min(BUFFER_SIZE, end - offset)
+                    if os.pread(fd_a, count, offset) != os.pread(
+                        fd_b, count, offset
+                    ):
+                        return False
+            return True
+        finally:
+            os.close(fd_b)
+    finally:
+        os.close(fd_a)
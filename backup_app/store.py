@@ -0,0 +1,520 @@
+"""This script keeps a deduplicating, content-addressed backup store
+
+Files are split into chunks with content-defined chunking (a Gear rolling
+hash), so an insert in a file only changes the chunks around it. Each
+unique chunk is stored once under its BLAKE2b digest in the metadata
+folder of the backup folder. A SQLite manifest records the folder tree
+and the chunks of every file, and a chunk index counts the references to
+each chunk. A Bloom filter built from the chunk index answers most
+lookups of new chunks without touching the disk.
+
+The manifest can be listed like a folder, so the scanner diffs a source
+folder against it as it would against a plain backup folder.
+
+Chunk objects are written before their row in the chunk index is
+committed. If the store was not closed cleanly, or an add was rolled back,
+the next garbage collection also sweeps object files the index does not
+know about.
+"""
+
+import hashlib
+import math
+import mmap
+import os
+import sqlite3
+import stat
+import threading
+
+from .metadata import metadata_path
+
+STORE_DIR = "store"
+MANIFEST_NAME = "manifest.sqlite"
+OBJECTS_DIR = "objects"
+OPEN_MARKER = "open"
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+# a boundary is cut when the top 16 bits of the hash are zero, giving
+# chunks of about 64 KiB on top of MIN_CHUNK
+CUT_MASK = 0xFFFF << 48
+HASH_MASK = (1 << 64) - 1
+GEAR = [
+    int.from_bytes(
+        hashlib.blake2b(bytes([value]), digest_size=8).digest(), "little"
+    )
+    for value in range(256)
+]
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        parent TEXT,
+        name TEXT,
+        is_dir INTEGER,
+        size INTEGER,
+        mtime_ns INTEGER,
+        mode INTEGER,
+        digest TEXT,
+        chunks TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS files_parent ON files (parent)",
+    """CREATE TABLE IF NOT EXISTS chunks (
+        digest TEXT PRIMARY KEY,
+        size INTEGER,
+        refs INTEGER
+    )""",
+)
+
+
+def chunk_boundaries(data, min_size=MIN_CHUNK, max_size=MAX_CHUNK):
+    """Yield the end offset of each content-defined chunk of data."""
+    size = len(data)
+    start = 0
+    while start < size:
+        end = min(start + max_size, size)
+        pos = start + min_size
+        if pos < end:
+            fingerprint = 0
+            while pos < end:
+                fingerprint = (
+                    (fingerprint << 1) + GEAR[data[pos]]
+                ) & HASH_MASK
+                pos += 1
+                if not fingerprint & CUT_MASK:
+                    break
+        else:
+            pos = end
+        yield pos
+        start = pos
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter over hex digests."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.size = max(
+            8,
+            math.ceil(
+                -self.capacity * math.log(error_rate) / math.log(2) ** 2
+            ),
+        )
+        self.hashes = max(
+            1, min(8, round(self.size / self.capacity * math.log(2)))
+        )
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, digest):
+        raw = bytes.fromhex(digest)
+        for i in range(self.hashes):
+            word = raw[(4 * i) % len(raw) :][:4]
+            yield int.from_bytes(word, "little") % self.size
+
+    def add(self, digest):
+        """Add a digest to the filter."""
+        for position in self._positions(digest):
+            self.bits[position // 8] |= 1 << (position % 8)
+        self.count += 1
+
+    def __contains__(self, digest):
+        return all(
+            self.bits[position // 8] & (1 << (position % 8))
+            for position in self._positions(digest)
+        )
+
+
+def _stat_result(mode, size, mtime_ns):
+    """Build a stat result like the ones os.stat returns."""
+    seconds, nanoseconds = divmod(mtime_ns, 10**9)
+    mtime = float(seconds) + nanoseconds * 1e-9
+    return os.stat_result(
+        (mode, 0, 0, 1, 0, 0, size, mtime, mtime, mtime),
+        {"st_mtime_ns": mtime_ns},
+    )
+
+
+class ManifestEntry:
+    """An entry of the manifest, listed like an os.DirEntry."""
+
+    __slots__ = ("name", "path", "digest", "_stat")
+
+    def __init__(self, path, name, mode, size, mtime_ns, digest):
+        self.name = name
+        self.path = path
+        self.digest = digest
+        self._stat = _stat_result(mode, size, mtime_ns)
+
+    def is_dir(self):
+        """Return True if the entry is a folder."""
+        return stat.S_ISDIR(self._stat.st_mode)
+
+    def stat(self):
+        """Return the stat result recorded in the manifest."""
+        return self._stat
+
+
+class ContentStore:
+    """Stores backed up files as deduplicated chunks plus a manifest."""
+
+    def __init__(self, backup_root):
+        self.backup_root = backup_root
+        self.folder = metadata_path(backup_root, STORE_DIR, OBJECTS_DIR)
+        os.makedirs(self.folder, exist_ok=True)
+        self.marker = metadata_path(backup_root, STORE_DIR, OPEN_MARKER)
+        # a marker left by an earlier session means it did not close, and
+        # may have written objects whose rows were never committed
+        self.unclean = os.path.exists(self.marker)
+        with open(self.marker, "w", encoding="utf-8"):
+            pass
+        self.connection = sqlite3.connect(
+            metadata_path(backup_root, STORE_DIR, MANIFEST_NAME),
+            check_same_thread=False,
+        )
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.connection.commit()
+        self.lock = threading.RLock()
+        self.bloom_skips = 0
+        self.index_lookups = 0
+        self.stored_bytes = 0
+        self.deduplicated_bytes = 0
+        self._load_bloom()
+
+    def _load_bloom(self, capacity=None):
+        count = self.connection.execute(
+            "SELECT COUNT(*) FROM chunks"
+        ).fetchone()[0]
+        self.bloom = BloomFilter(capacity or max(100_000, 2 * count))
+        for (digest,) in self.connection.execute("SELECT digest FROM chunks"):
+            self.bloom.add(digest)
+
+    def _object_path(self, digest):
+        return os.path.join(self.folder, digest[:2], digest[2:])
+
+    def has_chunk(self, digest):
+        """Return True if a chunk is stored.
+
+        Chunks missing from the Bloom filter are known to be absent without
+        a lookup in the chunk index.
+        """
+        if digest not in self.bloom:
+            self.bloom_skips += 1
+            return False
+        self.index_lookups += 1
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM chunks WHERE digest = ?", (digest,)
+            ).fetchone()
+            is not None
+        )
+
+    def _put_chunk(self, data):
+        digest = hashlib.blake2b(data, digest_size=32).hexdigest()
+        if self.has_chunk(digest):
+            self.connection.execute(
+                "UPDATE chunks SET refs = refs + 1 WHERE digest = ?", (digest,)
+            )
+            self.deduplicated_bytes += len(data)
+            return digest
+        path = self._object_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = path + ".tmp"
+        with open(temp, "wb") as out:
+            out.write(data)
+        os.replace(temp, path)
+        self.connection.execute(
+            "INSERT INTO chunks VALUES (?, ?, 1)", (digest, len(data))
+        )
+        self.bloom.add(digest)
+        if self.bloom.count > self.bloom.capacity:
+            self._load_bloom(2 * self.bloom.capacity)
+        self.stored_bytes += len(data)
+        return digest
+
+    def _put_file(self, src):
+        """Store the chunks of a file and return (digest, chunk digests)."""
+        file_hash = hashlib.blake2b()
+        chunks = []
+        with open(src, "rb") as filein:
+            if not os.fstat(filein.fileno()).st_size:
+                return file_hash.hexdigest(), chunks
+            with mmap.mmap(
+                filein.fileno(), 0, access=mmap.ACCESS_READ
+            ) as data:
+                start = 0
+                for end in chunk_boundaries(data):
+                    chunk = data[start:end]
+                    file_hash.update(chunk)
+                    chunks.append(self._put_chunk(chunk))
+                    start = end
+        return file_hash.hexdigest(), chunks
+
+    @staticmethod
+    def _key(relpath):
+        relpath = os.path.normpath(relpath)
+        return "" if relpath == os.curdir else relpath
+
+    def _row(self, key):
+        return self.connection.execute(
+            "SELECT is_dir, chunks FROM files WHERE path = ?", (key,)
+        ).fetchone()
+
+    def mkdir(self, relpath, stat_result=None):
+        """Add a folder and any missing parent folders to the manifest."""
+        key = self._key(relpath)
+        with self.lock:
+            if not key or self._row(key) is not None:
+                return
+            parent = os.path.dirname(key)
+            self.mkdir(parent)
+            mode = stat_result.st_mode if stat_result else stat.S_IFDIR | 0o755
+            mtime_ns = stat_result.st_mtime_ns if stat_result else 0
+            self.connection.execute(
+                "INSERT INTO files VALUES (?, ?, ?, 1, 0, ?, ?, NULL, NULL)",
+                (key, parent, os.path.basename(key), mtime_ns, mode),
+            )
+
+    def add(self, src, relpath):
+        """Store a file or folder of the source under relpath.
+
+        Anything already stored under relpath is replaced. The new chunks
+        are stored before the old version is released, and the manifest is
+        only committed once everything was stored, so a file that cannot be
+        read leaves the old version in place.
+        """
+        key = self._key(relpath)
+        with self.lock:
+            try:
+                self._add(src, key, frozenset())
+            except BaseException:
+                self.connection.rollback()
+                # objects of the rolled back chunks are left on disk
+                self.unclean = True
+                raise
+            self.connection.commit()
+
+    def _add(self, src, key, parents):
+        stat_result = os.stat(src, follow_symlinks=False)
+        if stat.S_ISLNK(stat_result.st_mode):
+            # links are stored as what they point to, as the scanner sees them
+            stat_result = os.stat(src)
+        if stat.S_ISDIR(stat_result.st_mode):
+            folder = (stat_result.st_dev, stat_result.st_ino)
+            if folder in parents:
+                # a link back to a parent folder would recurse forever
+                return
+            self._remove(key)
+            self.mkdir(key, stat_result)
+            with os.scandir(src) as entries:
+                for entry in entries:
+                    self._add(
+                        entry.path,
+                        os.path.join(key, entry.name),
+                        parents | {folder},
+                    )
+            return
+        digest, chunks = self._put_file(src)
+        self._remove(key)
+        self.mkdir(os.path.dirname(key))
+        self.connection.execute(
+            "INSERT INTO files VALUES (?, ?, ?, 0, ?, ?, ?, ?, ?)",
+            (
+                key,
+                os.path.dirname(key),
+                os.path.basename(key),
+                stat_result.st_size,
+                stat_result.st_mtime_ns,
+                stat_result.st_mode,
+                digest,
+                ",".join(chunks),
+            ),
+        )
+
+    def _release(self, chunks):
+        for digest in filter(None, (chunks or "").split(",")):
+            self.connection.execute(
+                "UPDATE chunks SET refs = refs - 1 WHERE digest = ?", (digest,)
+            )
+
+    def _remove(self, key):
+        if self._row(key) is None:
+            return False
+        prefix = key + os.sep
+        for (chunks,) in self.connection.execute(
+            "SELECT chunks FROM files"
+            " WHERE path = ? OR substr(path, 1, ?) = ?",
+            (key, len(prefix), prefix),
+        ).fetchall():
+            self._release(chunks)
+        self.connection.execute(
+            "DELETE FROM files WHERE path = ? OR substr(path, 1, ?) = ?",
+            (key, len(prefix), prefix),
+        )
+        return True
+
+    def remove(self, relpath):
+        """Remove a file or folder from the manifest.
+
+        Return True if something was removed. The chunks are only deleted
+        by collect_garbage.
+        """
+        key = self._key(relpath)
+        with self.lock:
+            removed = self._remove(key)
+            self.connection.commit()
+        return removed
+
+    def move(self, old, new):
+        """Rename a file or folder in the manifest."""
+        old, new = self._key(old), self._key(new)
+        with self.lock:
+            if self._row(old) is None or self._row(new) is not None:
+                return False
+            self.mkdir(os.path.dirname(new))
+            prefix = old + os.sep
+            rows = self.connection.execute(
+                "SELECT path FROM files"
+                " WHERE path = ? OR substr(path, 1, ?) = ?",
+                (old, len(prefix), prefix),
+            ).fetchall()
+            for (path,) in rows:
+                moved = new + path[len(old) :]
+                self.connection.execute(
+                    "UPDATE files SET path = ?, parent = ?, name = ?"
+                    " WHERE path = ?",
+                    (
+                        moved,
+                        os.path.dirname(moved),
+                        os.path.basename(moved),
+                        path,
+                    ),
+                )
+            self.connection.commit()
+        return True
+
+    def exists(self, relpath):
+        """Return True if relpath is in the manifest."""
+        key = self._key(relpath)
+        with self.lock:
+            return not key or self._row(key) is not None
+
+    def list_directory(self, relpath):
+        """Return the entries of a stored folder, like scanner.list_directory.
+
+        Raise FileNotFoundError if the folder is not in the manifest.
+        """
+        key = self._key(relpath)
+        with self.lock:
+            if key and self._row(key) is None:
+                raise FileNotFoundError(relpath)
+            rows = self.connection.execute(
+                "SELECT path, name, mode, size, mtime_ns, digest FROM files"
+                " WHERE parent = ? AND path != ''",
+                (key,),
+            ).fetchall()
+        listing = [
+            (os.path.normcase(row[1]), ManifestEntry(*row)) for row in rows
+        ]
+        listing.sort(key=lambda pair: pair[0])
+        return listing
+
+    def restore(self, relpath, dest):
+        """Write a stored file or folder back out to dest."""
+        key = self._key(relpath)
+        prefix = key + os.sep if key else ""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT path, is_dir, mtime_ns, mode, chunks FROM files"
+                " WHERE path = ? OR substr(path, 1, ?) = ? ORDER BY path",
+                (key, len(prefix), prefix),
+            ).fetchall()
+        if not rows:
+            raise FileNotFoundError(relpath)
+        folders = []
+        for path, is_dir, mtime_ns, mode, chunks in rows:
+            inner = path[len(key) :].lstrip(os.sep)
+            target = os.path.join(dest, inner) if inner else dest
+            if is_dir:
+                os.makedirs(target, exist_ok=True)
+                folders.append((target, mtime_ns, mode))
+                continue
+            os.makedirs(os.path.dirname(target) or os.curdir, exist_ok=True)
+            with open(target, "wb") as out:
+                for digest in filter(None, chunks.split(",")):
+                    with open(self._object_path(digest), "rb") as chunk:
+                        out.write(chunk.read())
+            os.chmod(target, stat.S_IMODE(mode))
+            os.utime(target, ns=(mtime_ns, mtime_ns))
+        for target, mtime_ns, mode in reversed(folders):
+            os.chmod(target, stat.S_IMODE(mode))
+            os.utime(target, ns=(mtime_ns, mtime_ns))
+        return dest
+
+    def sweep_orphans(self):
+        """Delete object files with no row in the chunk index.
+
+        Return the bytes freed.
+        """
+        freed = 0
+        with self.lock:
+            self.connection.commit()
+            for folder, _, names in os.walk(self.folder):
+                prefix = os.path.basename(folder)
+                for name in names:
+                    if not name.endswith(".tmp"):
+                        row = self.connection.execute(
+                            "SELECT 1 FROM chunks WHERE digest = ?",
+                            (prefix + name,),
+                        ).fetchone()
+                        if row is not None:
+                            continue
+                    path = os.path.join(folder, name)
+                    try:
+                        freed += os.path.getsize(path)
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            self.unclean = False
+        return freed
+
+    def collect_garbage(self, sweep=None):
+        """Delete chunks no file refers to. Return the bytes freed.
+
+        Object files missing from the chunk index are swept too if sweep
+        is True, or by default if the previous session did not close.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT digest, size FROM chunks WHERE refs <= 0"
+            ).fetchall()
+            for digest, _ in rows:
+                try:
+                    os.remove(self._object_path(digest))
+                except FileNotFoundError:
+                    pass
+            self.connection.execute("DELETE FROM chunks WHERE refs <= 0")
+            self.connection.commit()
+            freed = sum(size for _, size in rows)
+            if sweep or (sweep is None and self.unclean):
+                freed += self.sweep_orphans()
+        return freed
+
+    def stats(self):
+        """Return the bytes stored and deduplicated and the lookup counts."""
+        return {
+            "stored_bytes": self.stored_bytes,
+            "deduplicated_bytes": self.deduplicated_bytes,
+            "bloom_skips": self.bloom_skips,
+            "index_lookups": self.index_lookups,
+        }
+
+    def close(self):
+        """Save and close the manifest."""
+        self.connection.commit()
+        self.connection.close()
+        if self.unclean:
+            # leave the marker so the next session sweeps the orphans
+            return
+        try:
+            os.remove(self.marker)
+        except FileNotFoundError:
+            pass
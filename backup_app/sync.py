@@ -0,0 +1,66 @@
+"""This script syncs the backup folder while a scan is still running
+
+Scan events are streamed through a copier that copies added files in a
+background thread as soon as they are found, instead of waiting for the
+whole report.
+"""
+
+import logging
+import queue
+import threading
+
+from .filesystem import copy_files_from_a_to_b
+from .scanner import ADDED
+
+QUEUE_SIZE = 256
+
+
+class StreamingCopier:
+    """Copies added files to the backup folder while a scan is running.
+
+    Keyword options are passed on to copy_files_from_a_to_b.
+    """
+
+    def __init__(self, source, backup, queue_size=QUEUE_SIZE, **options):
+        self.source = source
+        self.backup = backup
+        self.queue_size = queue_size
+        self.options = options
+        self.copied = 0
+        self.failed = []
+        self.logger = logging.getLogger(f"{__name__}.{type(self).__name__}")
+
+    def filter(self, events):
+        """Yield every event except added files, which are copied instead.
+
+        Files that could not be copied are collected in self.failed once the
+        stream is exhausted.
+        """
+        pending = queue.Queue(maxsize=self.queue_size)
+        worker = threading.Thread(
+            target=self._copy_worker, args=(pending,), daemon=True
+        )
+        worker.start()
+        try:
+            for event in events:
+                if event.kind == ADDED:
+                    pending.put(event.path)
+                else:
+                    yield event
+        finally:
+            pending.put(None)
+            worker.join()
+
+    def _copy_worker(self, pending):
+        while (path := pending.get()) is not None:
+            try:
+                failed = copy_files_from_a_to_b(
+                    self.source, self.backup, [path], **self.options
+                )
+            except OSError:
+                self.logger.exception("Could not copy %s", path)
+                failed = [path]
+            if failed:
+                self.failed.extend(failed)
+            else:
+                self.copied += 1
@@ -0,0 +1,238 @@
+"""This script limits how fast the app reads and writes files
+
+Reads and writes each have a bytes per second and an operations per
+second budget, enforced with token buckets. Time-of-day profiles replace
+the limits during given hours, so a sync can run slowly during business
+hours and at full speed at night. The time spent waiting is recorded for
+each kind of operation. Copies wait for the budget chunk by chunk as the
+copy function reports its progress, waiting for reads and writes at once.
+"""
+
+import inspect
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from .sparse import allocated_size
+from .sparse import copy2 as sparse_copy2
+from .sparse import is_sparse
+
+READ, WRITE = "read", "write"
+LIMIT_KEYS = ("read_bytes", "write_bytes", "read_ops", "write_ops")
+
+
+class TokenBucket:
+    """Hands out tokens at a steady rate, allowing bursts up to burst."""
+
+    def __init__(self, rate=None, burst=None, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate; None removes the limit."""
+        with self.lock:
+            self.rate = rate
+            self.burst = burst if burst is not None else rate
+            self.tokens = self.burst or 0
+            self.updated = self.clock()
+
+    def reserve(self, amount):
+        """Take amount tokens and return how long to wait before using them.
+
+        Tokens may be borrowed from the future, so a request larger than the
+        burst waits for as long as it takes to earn it.
+        """
+        with self.lock:
+            if not self.rate or not amount:
+                return 0.0
+            now = self.clock()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+def _takes_progress(function):
+    try:
+        parameters = inspect.signature(function).parameters
+    except (TypeError, ValueError):
+        return False
+    return "progress" in parameters
+
+
+def _in_profile(start, end, clock_time):
+    if start <= end:
+        return start <= clock_time < end
+    return clock_time >= start or clock_time < end
+
+
+class Throttle:
+    """Limits the bytes and operations per second of reads and writes.
+
+    Arguments:
+    limits -- dict with read_bytes, write_bytes, read_ops and write_ops per
+              second; a missing or None value sets no limit
+    profiles -- list of (start, end, limits) tuples, with start and end
+                given as "HH:MM"; the first profile containing the time of
+                day is used instead of limits
+    """
+
+    def __init__(
+        self,
+        limits=None,
+        profiles=(),
+        clock=time.monotonic,
+        sleep=time.sleep,
+        now=datetime.now,
+    ):
+        self.limits = dict(limits or {})
+        self.profiles = list(profiles)
+        self.sleep = sleep
+        self.now = now
+        self.buckets = {key: TokenBucket(clock=clock) for key in LIMIT_KEYS}
+        self.active = None
+        self.waited = Counter()
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def current_limits(self):
+        """Return the limits that apply at this time of day."""
+        clock_time = self.now().strftime("%H:%M")
+        for start, end, limits in self.profiles:
+            if _in_profile(start, end, clock_time):
+                return limits
+        return self.limits
+
+    def _refresh(self):
+        limits = self.current_limits()
+        with self.lock:
+            if limits is self.active:
+                return
+            self.active = limits
+        for key, bucket in self.buckets.items():
+            bucket.set_rate(limits.get(key))
+
+    def _reserve(self, kind, nbytes, ops):
+        return max(
+            self.buckets[f"{kind}_bytes"].reserve(nbytes),
+            self.buckets[f"{kind}_ops"].reserve(ops),
+        )
+
+    def _record(self, kind, delay, nbytes, ops):
+        with self.lock:
+            self.waited[kind] += delay
+            self.counts[f"{kind}_bytes"] += nbytes
+            self.counts[f"{kind}_ops"] += ops
+
+    def wait(self, kind, nbytes=0, ops=1):
+        """Wait until a read or write of nbytes in ops operations fits the
+        budget. Return the seconds waited.
+        """
+        self._refresh()
+        delay = self._reserve(kind, nbytes, ops)
+        if delay:
+            self.sleep(delay)
+        self._record(kind, delay, nbytes, ops)
+        return delay
+
+    def transfer(self, read_bytes=0, write_bytes=0, ops=1):
+        """Wait until a read and a write both fit the budget.
+
+        The two budgets are waited for together, with a single sleep as
+        long as the longer of the two waits. Return the seconds waited.
+        """
+        self._refresh()
+        delays = {
+            READ: self._reserve(READ, read_bytes, ops),
+            WRITE: self._reserve(WRITE, write_bytes, ops),
+        }
+        delay = max(delays.values())
+        if delay:
+            self.sleep(delay)
+        self._record(READ, delays[READ], read_bytes, ops)
+        self._record(WRITE, delays[WRITE], write_bytes, ops)
+        return delay
+
+    def read(self, nbytes=0, ops=1):
+        """Wait for a read to fit the budget."""
+        return self.wait(READ, nbytes, ops)
+
+    def write(self, nbytes=0, ops=1):
+        """Wait for a write to fit the budget."""
+        return self.wait(WRITE, nbytes, ops)
+
+    def copying(self, copy_function=sparse_copy2):
+        """Return a throttled version of a copy function.
+
+        copy_function still does the copy, so copiers such as FastCopier
+        or VerifyingCopier keep working. If it takes a progress keyword,
+        each chunk it reports waits for the budget as the copy goes.
+        Otherwise the budget for the whole file is reserved before the
+        copy, counting only the allocated bytes of sparse files.
+        """
+        chunked = _takes_progress(copy_function)
+
+        def progress(nbytes):
+            self.transfer(nbytes, nbytes, ops=0)
+
+        def copy(src, dst):
+            if chunked:
+                self.transfer()
+                return copy_function(src, dst, progress=progress)
+            stat_result = os.stat(src)
+            size = stat_result.st_size
+            if is_sparse(stat_result, src):
+                size = allocated_size(stat_result)
+            self.transfer(size, size)
+            return copy_function(src, dst)
+
+        return copy
+
+    def updating(self, update_function):
+        """Return a throttled version of an update function.
+
+        Both files are read in full before the update, and the bytes it
+        wrote are taken from the write budget once it returns.
+        """
+
+        def update(src, dst):
+            self.read(os.path.getsize(src) + os.path.getsize(dst), ops=2)
+            written = update_function(src, dst)
+            if written:
+                self.write(written)
+            return written
+
+        return update
+
+    def moving(self, move_function=shutil.move):
+        """Return a throttled version of a move function."""
+
+        def move(src, dst):
+            self.write()
+            return move_function(src, dst)
+
+        return move
+
+    def removing(self, remove_function):
+        """Return a throttled version of a remove function."""
+
+        def remove(path):
+            self.write()
+            remove_function(path)
+
+        return remove
+
+    def stats(self):
+        """Return the seconds waited and the bytes and operations done."""
+        with self.lock:
+            stats = {
+                f"{kind}_wait": self.waited[kind] for kind in (READ, WRITE)
+            }
+            stats.update(self.counts)
+        return stats
@@ -0,0 +1,233 @@
+"""This script copies files while hashing them and verifies the copies
+
+The source is read once: each chunk is hashed as it is written to the
+destination. The destination is then flushed, dropped from the page cache
+and read back, with O_DIRECT where the filesystem allows it, so the check
+sees what is on disk rather than what is still in memory. The digests of
+both files are then saved to the hash cache of the backup folder, which
+later deep scans reuse.
+"""
+
+import errno
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import threading
+from collections import Counter
+
+from .hashing import file_digest
+from .sparse import data_extents
+
+BUFFER_SIZE = 1024 * 1024
+ZEROS = bytes(BUFFER_SIZE)
+
+
+def _hash_zeros(hasher, count):
+    while count > 0:
+        hasher.update(ZEROS[: min(count, BUFFER_SIZE)])
+        count -= BUFFER_SIZE
+
+
+def _drop_cache(fd):
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+
+def _flush(path):
+    fd = os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        os.fsync(fd)
+        _drop_cache(fd)
+    finally:
+        os.close(fd)
+
+
+def stream_copy(src_fd, dst_fd, size, progress=None):
+    """Copy the data extents of a file and return its hex BLAKE2b digest.
+
+    Holes are hashed as zeros but not written, so sparse files stay sparse.
+    If progress is given, it is called with the size of each chunk written.
+    """
+    hasher = hashlib.blake2b()
+    position = 0
+    for start, end in data_extents(src_fd, size):
+        _hash_zeros(hasher, start - position)
+        position = start
+        while position < end:
+            data = os.pread(src_fd, min(BUFFER_SIZE, end - position), position)
+            if not data:
+                break
+            hasher.update(data)
+            os.pwrite(dst_fd, data, position)
+            position += len(data)
+            if progress is not None:
+                progress(len(data))
+    _hash_zeros(hasher, size - position)
+    return hasher.hexdigest()
+
+
+def _read_digest(fd):
+    hasher = hashlib.blake2b()
+    # O_DIRECT needs a buffer aligned to the block size, which an anonymous
+    # mmap is
+    with mmap.mmap(-1, BUFFER_SIZE) as buffer:
+        offset = 0
+        while count := os.preadv(fd, [buffer], offset):
+            hasher.update(memoryview(buffer)[:count])
+            offset += count
+    return hasher.hexdigest()
+
+
+def disk_digest(path):
+    """Return the hex BLAKE2b digest of a file as stored on disk.
+
+    The file is read with O_DIRECT, or after dropping it from the page
+    cache where the filesystem does not support O_DIRECT.
+    """
+    flags = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+    direct = getattr(os, "O_DIRECT", 0)
+    if direct:
+        try:
+            fd = os.open(path, flags | direct)
+        except OSError as error:
+            if error.errno != errno.EINVAL:
+                raise
+        else:
+            try:
+                return _read_digest(fd)
+            except OSError as error:
+                if error.errno != errno.EINVAL:
+                    raise
+            finally:
+                os.close(fd)
+    fd = os.open(path, flags)
+    try:
+        _drop_cache(fd)
+        return _read_digest(fd)
+    finally:
+        os.close(fd)
+
+
+class VerifyingCopier:
+    """Copies files, hashing them on the way, and checks each copy."""
+
+    def __init__(self):
+        self.digests = []
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(f"{__name__}.{type(self).__name__}")
+
+    def read_back(self, path):
+        """Return the digest of a written file, read from disk."""
+        return disk_digest(path)
+
+    def copy2(self, src, dst, progress=None):
+        """Copy a file and its metadata like shutil.copy2, then verify it.
+
+        progress is passed on to stream_copy. Raise OSError with errno EIO,
+        after removing the copy, if the data read back does not match the
+        data read from the source.
+        """
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        src_fd = os.open(src, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            src_stat = os.fstat(src_fd)
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            dst_fd = os.open(dst, flags | getattr(os, "O_BINARY", 0), 0o666)
+            try:
+                digest = stream_copy(
+                    src_fd, dst_fd, src_stat.st_size, progress
+                )
+                os.ftruncate(dst_fd, src_stat.st_size)
+                os.fsync(dst_fd)
+                _drop_cache(dst_fd)
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        shutil.copystat(src, dst)
+        self._check(src, src_stat, dst, digest)
+        return dst
+
+    def _check(self, src, src_stat, dst, digest):
+        if self.read_back(dst) != digest:
+            os.remove(dst)
+            with self.lock:
+                self.counts["mismatched"] += 1
+            self.logger.error("%s does not match %s", dst, src)
+            raise OSError(errno.EIO, "copy does not match the source", dst)
+        with self.lock:
+            self.digests.append((src, src_stat, digest))
+            self.digests.append((dst, os.stat(dst), digest))
+            self.counts["verified"] += 1
+            self.counts["bytes"] += src_stat.st_size
+
+    def updating(self, update_function):
+        """Return an update function whose results are verified.
+
+        The updated file is flushed and read back, and checked against the
+        digest of the source. A file that does not match is removed, as it
+        no longer holds its old contents either, and OSError with errno EIO
+        is raised.
+        """
+
+        def update(src, dst):
+            written = update_function(src, dst)
+            if written is None:
+                return None
+            src_stat = os.stat(src)
+            digest = file_digest(src)
+            _flush(dst)
+            self._check(src, src_stat, dst, digest)
+            return written
+
+        return update
+
+    def copying(self, copy_function):
+        """Return a copy function verifying the copies of copy_function.
+
+        The copy is flushed and read back from disk, and checked against
+        a digest of the source read once it is done. This lets another
+        copier, such as FastCopier, do the copy; copy2 instead hashes the
+        source while copying it. progress is passed on to copy_function.
+        """
+
+        def copy(src, dst, progress=None):
+            if os.path.isdir(dst):
+                dst = os.path.join(dst, os.path.basename(src))
+            src_stat = os.stat(src)
+            if progress is None:
+                copy_function(src, dst)
+            else:
+                copy_function(src, dst, progress=progress)
+            digest = file_digest(src)
+            _flush(dst)
+            self._check(src, src_stat, dst, digest)
+            return dst
+
+        return copy
+
+    def save(self, hash_cache):
+        """Record the digests of the files copied so far in a HashCache.
+
+        Files are keyed on their inode, so copies renamed into place after
+        they were verified keep their digest.
+        """
+        with self.lock:
+            digests, self.digests = self.digests, []
+        for path, stat_result, digest in digests:
+            hash_cache.store(path, stat_result, digest)
+
+    def stats(self):
+        """Return the number of files verified and mismatched."""
+        with self.lock:
+            return {
+                key: self.counts[key]
+                for key in ("verified", "mismatched", "bytes")
+            }
@@ -0,0 +1,309 @@
+"""This script keeps a scan report up to date by watching the source folder
+
+On Linux, inotify watches are registered on every folder of the source
+tree through ctypes. Each event updates the report of a BackupManager for
+the path it names, so the report stays live without rescanning the tree.
+Renames inside the tree are paired into moved_files entries, and chained
+renames collapse into one pair. If the kernel event queue overflows, the
+tree is rescanned.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+
+from .scanner import (
+    ADDED,
+    IGNORE,
+    KEYS,
+    REMOVED,
+    compare_category,
+    walk_diff,
+)
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONTFOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+WATCH_MASK |= IN_CREATE | IN_DELETE | IN_DELETE_SELF
+WATCH_MASK |= IN_ONLYDIR | IN_DONTFOLLOW
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+def inotify_available():
+    """Return True if inotify can be used on this platform."""
+    return sys.platform.startswith("linux") and bool(
+        ctypes.util.find_library("c")
+    )
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_uint32,
+    ]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+def parse_events(buffer):
+    """Yield (wd, mask, cookie, name) tuples from an inotify read buffer."""
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(buffer):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+        offset += EVENT_HEADER.size
+        name = buffer[offset : offset + length].rstrip(b"\0")
+        offset += length
+        yield wd, mask, cookie, os.fsdecode(name)
+
+
+class Watcher:
+    """Keeps the report of a BackupManager live using inotify."""
+
+    def __init__(self, manager):
+        if not inotify_available():
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.manager = manager
+        self.source = manager.source_directory
+        self.backup = manager.backup_directory
+        self.logger = logging.getLogger(f"{__name__}.{type(self).__name__}")
+        self.libc = _load_libc()
+        self.fd = None
+        self.watches = {}
+        self.overflows = 0
+
+    @property
+    def report(self):
+        """The report kept up to date by this watcher."""
+        return self.manager.report
+
+    def start(self):
+        """Register watches on the source tree.
+
+        The manager is scanned first if it has no report yet.
+        """
+        if ADDED not in self.report:
+            self.manager.scan(self.source, self.backup)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._watch_tree("")
+        return self
+
+    def stop(self):
+        """Close the inotify instance and drop every watch."""
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self.watches.clear()
+
+    def _watch_tree(self, relpath):
+        """Watch a folder of the source tree and all its subfolders."""
+        top = os.path.join(self.source, relpath)
+        for folder, dirs, _ in os.walk(top):
+            dirs[:] = [name for name in dirs if name not in IGNORE]
+            wd = self.libc.inotify_add_watch(
+                self.fd, os.fsencode(folder), WATCH_MASK
+            )
+            if wd < 0:
+                self.logger.warning("Could not watch %s", folder)
+                continue
+            self.watches[wd] = os.path.relpath(folder, self.source)
+
+    def _relpath(self, wd, name):
+        folder = self.watches.get(wd)
+        if folder is None:
+            return None
+        if folder == os.curdir:
+            return name
+        return os.path.join(folder, name) if name else folder
+
+    def poll(self, timeout=0):
+        """Apply the events that arrive within timeout seconds.
+
+        Return the number of events applied.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return 0
+        try:
+            buffer = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return 0
+        return self.apply(parse_events(buffer))
+
+    def run(self, stop_event, interval=1.0, on_change=None):
+        """Apply events until stop_event is set.
+
+        on_change is called with the manager after each batch of events,
+        which lets a background syncer push changes as they happen.
+        """
+        while not stop_event.is_set():
+            if self.poll(interval) and on_change is not None:
+                on_change(self.manager)
+
+    def apply(self, events):
+        """Update the report from (wd, mask, cookie, name) events."""
+        count = 0
+        moved_from = {}
+        for wd, mask, cookie, name in events:
+            count += 1
+            if mask & IN_Q_OVERFLOW:
+                self.overflows += 1
+                self.logger.warning("Event queue overflowed, rescanning")
+                self.rescan("")
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if name in IGNORE:
+                continue
+            relpath = self._relpath(wd, name)
+            if relpath is None or mask & IN_DELETE_SELF:
+                continue
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & IN_MOVED_FROM:
+                moved_from[cookie] = relpath
+            elif mask & IN_MOVED_TO and cookie in moved_from:
+                self.moved(moved_from.pop(cookie), relpath, is_dir)
+            elif mask & (IN_CREATE | IN_MOVED_TO) and is_dir:
+                self._watch_tree(relpath)
+                self.rescan(relpath)
+            else:
+                self.rescan(relpath)
+        for relpath in moved_from.values():
+            self.rescan(relpath)
+        return count
+
+    def _entries_under(self, relpath):
+        prefix = relpath + os.sep
+        for key in KEYS:
+            for item in self.report[key]:
+                if item == relpath or item.startswith(prefix):
+                    yield key, item
+
+    def drop(self, relpath):
+        """Remove a path and everything below it from the report."""
+        if not relpath:
+            for key in KEYS:
+                self.report[key] = []
+            return
+        for key, item in list(self._entries_under(relpath)):
+            self.report[key].remove(item)
+
+    def _backup_path(self, relpath):
+        """Return where the backup of a path is, allowing for pending moves."""
+        bak = os.path.join(self.backup, relpath)
+        for old_bak, new_bak in self.report["moved_files"]:
+            if new_bak == bak:
+                return old_bak
+        return bak
+
+    def rescan(self, relpath):
+        """Compare one path of both trees again and update the report."""
+        if not relpath:
+            self.manager.scan(self.source, self.backup)
+            return
+        self.drop(relpath)
+        src = os.path.join(self.source, relpath)
+        bak = self._backup_path(relpath)
+        if not os.path.lexists(src):
+            if os.path.lexists(bak):
+                self.report[REMOVED].append(relpath)
+        elif not os.path.lexists(bak):
+            self.report[ADDED].append(relpath)
+        elif os.path.isdir(src) and os.path.isdir(bak):
+            events = walk_diff(
+                src,
+                bak,
+                shallow=self.manager.shallow,
+                compare_cache=self.manager.compare_cache,
+            )
+            for event in events:
+                self.report[event.kind].append(
+                    os.path.join(relpath, event.path)
+                )
+        else:
+            try:
+                if os.path.isdir(src) or os.path.isdir(bak):
+                    kind = "errors"
+                else:
+                    kind = compare_category(
+                        src,
+                        os.stat(src),
+                        bak,
+                        os.stat(bak),
+                        self.manager.shallow,
+                        compare_cache=self.manager.compare_cache,
+                    )
+            except OSError:
+                kind = "errors"
+            self.report[kind].append(relpath)
+
+    def moved(self, old, new, is_dir):
+        """Record a rename inside the source tree."""
+        if is_dir:
+            for wd, folder in self.watches.items():
+                if folder == old or folder.startswith(old + os.sep):
+                    self.watches[wd] = new + folder[len(old) :]
+        old_bak = os.path.join(self.backup, old)
+        new_bak = os.path.join(self.backup, new)
+        if not os.path.lexists(old_bak) and self._chain(old_bak, new_bak):
+            self._rename_entries(old, new)
+        elif os.path.lexists(old_bak) and not os.path.lexists(new_bak):
+            self.report["moved_files"].append((old_bak, new_bak))
+            self._rename_entries(old, new)
+        else:
+            self.rescan(old)
+            self.rescan(new)
+
+    def _rename_entries(self, old, new):
+        for key, item in list(self._entries_under(old)):
+            self.report[key].remove(item)
+            self.report[key].append(new + item[len(old) :])
+
+    def _chain(self, old_bak, new_bak):
+        """Make the pending moves to or below old_bak end at new_bak.
+
+        A path renamed again before its move was synced keeps a single
+        pair, from where it is in the backup to its latest name; a pair
+        renamed back to where it started is dropped. Return True if any
+        pair was rewritten.
+        """
+        prefix = old_bak + os.sep
+        pairs = []
+        chained = False
+        for src_bak, dst_bak in self.report["moved_files"]:
+            if dst_bak == old_bak or dst_bak.startswith(prefix):
+                dst_bak = new_bak + dst_bak[len(old_bak) :]
+                if dst_bak != src_bak and os.path.lexists(dst_bak):
+                    return False
+                chained = True
+                if dst_bak == src_bak:
+                    continue
+            pairs.append((src_bak, dst_bak))
+        if chained:
+            self.report["moved_files"] = pairs
+        return chained
@@ -1,19 +1,66 @@
 #! usr/bin/env python3
 """Tests for backup_app.py."""
 
+import errno
+import glob
 import logging
 import os
 import shutil
+import time
 import tkinter as tk
 import unittest
+from datetime import datetime
+from types import SimpleNamespace
 
 import backup_app.backup_app as ba
 import backup_app.filesystem as fs
+from backup_app.backup_manager import BackupManager
+from backup_app.comparison import CompareCache
+from backup_app.copying import METHODS, FastCopier
+from backup_app.costmodel import CostModel
+from backup_app.delta import delta_update
+from backup_app.durability import BATCHED, STRICT, DurableWriter
 from backup_app.filesystem import copy_files_from_a_to_b, update_files_a_to_b
+from backup_app.hashing import (
+    PARTIAL_SIZE,
+    ContentDigests,
+    HashCache,
+    file_digest,
+)
+from backup_app.index import ScanIndex
+from backup_app.journal import REPLAYED, ROLLED_BACK, WRITTEN, Journal
+from backup_app.metadata import METADATA_DIR
+from backup_app.planner import (
+    COPY,
+    DELETE,
+    METADATA,
+    MKDIR,
+    MOVE,
+    Operation,
+    SyncPlan,
+    plan_sync,
+    run_plan,
+)
+from backup_app.quarantine import Quarantine
+from backup_app.report import EntryList, Report
+from backup_app.scanner import LOOKAHEAD, compare_trees, walk_diff
+from backup_app.scrubber import CORRUPT, Scrubber
+from backup_app.snapshots import STAMP_FORMAT, SnapshotHistory
+from backup_app.sparse import allocated_size, extents_equal, is_sparse
+from backup_app.store import ContentStore, chunk_boundaries
+from backup_app.throttle import Throttle, TokenBucket
+from backup_app.verify import VerifyingCopier
+from backup_app.watcher import IN_Q_OVERFLOW, inotify_available
 
 # from unittest.mock import Mock, MagicMock
 
 
+def match_attributes(*paths):
+    """Give backup files the times and permissions of the source files."""
+    for path in paths:
+        shutil.copystat(f"test_src/{path}", f"test_bak/{path}")
+
+
 class TestCopyFileFromAToB(unittest.TestCase):
     """Tests copy_files_from_a_to_b function."""
 
@@ -136,6 +183,24 @@ class TestCopyFileFromAToB(unittest.TestCase):
         self.assertTrue(os.path.exists("test_src/subdir/new_file2.txt"))
         self.assertFalse(os.path.exists("test_bak/subdir/new_file2.txt"))
 
+    def test_parallel_copy_failed_order(self):
+        """Test that a parallel copy reports failures in the given order."""
+        names = [f"file{i}.txt" for i in range(8)]
+        for name in names[::2]:
+            with open(f"test_src/{name}", "w", encoding="utf-8") as out:
+                out.write(name)
+        failed = copy_files_from_a_to_b(
+            "test_src",
+            "test_bak",
+            names,
+            workers=4,
+            max_open_files=4,
+            max_bytes_in_flight=8,
+        )
+        self.assertEqual(failed, names[1::2])
+        for name in names[::2]:
+            self.assertTrue(os.path.exists(f"test_bak/{name}"))
+
 
 class TestDeleteFileFromB(unittest.TestCase):
     """Tests delete_files_from_b function."""
@@ -252,6 +317,86 @@ class TestUpdateFilesAToB(unittest.TestCase):
         self.assertEqual(failed, [])
         self.assertTrue(src, bak)
 
+    def test_delta_update_in_place(self):
+        """Test that an in-place change only rewrites the changed block."""
+        data = os.urandom(512 * 1024)
+        with open("test_bak/image.bin", "wb") as out:
+            out.write(data)
+        with open("test_src/image.bin", "wb") as out:
+            out.write(data[:5000] + b"changed" + data[5007:])
+        inode = os.stat("test_bak/image.bin").st_ino
+        failed = update_files_a_to_b(
+            "test_src", "test_bak", ["image.bin"], delta_threshold=1024
+        )
+        self.assertEqual(failed, [])
+        self.assertEqual(os.stat("test_bak/image.bin").st_ino, inode)
+        self.assertEqual(
+            file_digest("test_src/image.bin"),
+            file_digest("test_bak/image.bin"),
+        )
+
+    def test_delta_update_shifted(self):
+        """Test that inserted data is handled by rebuilding the file."""
+        data = os.urandom(64 * 1024)
+        with open("test_bak/image.bin", "wb") as out:
+            out.write(data)
+        new = data[:5000] + b"inserted" + data[5000:]
+        with open("test_src/image.bin", "wb") as out:
+            out.write(new)
+        written = delta_update(
+            "test_src/image.bin", "test_bak/image.bin", block_size=4096
+        )
+        self.assertEqual(written, len(new))
+        with open("test_bak/image.bin", "rb") as filein:
+            self.assertEqual(filein.read(), new)
+
+    def test_delta_update_repeated_blocks(self):
+        """Test that repeated blocks still allow an update in place."""
+        data = bytes(4 * 4096) + os.urandom(4 * 4096)
+        with open("test_bak/image.bin", "wb") as out:
+            out.write(data)
+        new = data[:20000] + b"changed" + data[20007:]
+        with open("test_src/image.bin", "wb") as out:
+            out.write(new)
+        inode = os.stat("test_bak/image.bin").st_ino
+        written = delta_update(
+            "test_src/image.bin", "test_bak/image.bin", block_size=4096
+        )
+        self.assertEqual(written, 4096)
+        self.assertEqual(os.stat("test_bak/image.bin").st_ino, inode)
+        with open("test_bak/image.bin", "rb") as filein:
+            self.assertEqual(filein.read(), new)
+
+    def test_delta_update_through_pipeline(self):
+        """Test that delta updates are journaled, verified and throttled."""
+        data = os.urandom(512 * 1024)
+        with open("test_bak/image.bin", "wb") as out:
+            out.write(data)
+        with open("test_src/image.bin", "wb") as out:
+            out.write(data[:5000] + b"changed" + data[5007:])
+        throttle = Throttle()
+        manager = BackupManager(
+            "test_src",
+            "test_bak",
+            delta_threshold=1024,
+            use_journal=True,
+            durability=STRICT,
+            throttle=throttle,
+            verify_copies=True,
+        )
+        manager.scan("test_src", "test_bak")
+        with self.assertLogs(manager.logger, logging.INFO) as logs:
+            self.assertEqual(manager.update_files(), [])
+        self.assertIn("'verified': 1", "\n".join(logs.output))
+        self.assertEqual(throttle.stats()["write_bytes"], 64 * 1024)
+        self.assertEqual(
+            file_digest("test_src/image.bin"),
+            file_digest("test_bak/image.bin"),
+        )
+        journal = Journal.for_backup("test_bak")
+        self.assertEqual(journal.unfinished(), [])
+        journal.close()
+
 
 class TestFileSystemFunctions(unittest.TestCase):
     """Tests for the actual filesystem changes."""
@@ -478,6 +623,34 @@ class TestCopyCreatedFiles(unittest.TestCase):
         self.assertEqual(self.app.backup_panel.listing.get(0, tk.END), ())
         self.assertEqual(self.app.manager.report["removed_files"], [])
 
+    def test_attribute_file_selected(self):
+        """
+        Test that a file whose attributes changed, selected in the backup
+        folder list after a removed file, is removed from the display and
+        the report.
+        """
+        for fld in ["test_src", "test_bak"]:
+            with open(f"{fld}/touched.txt", "w", encoding="utf-8") as out:
+                out.write("same contents")
+        os.utime("test_src/touched.txt", ns=(1_000_000_000, 2_000_000_000))
+        with open("test_bak/new_file.txt", "w", encoding="utf-8") as out:
+            out.write("this is a removed file")
+        self.app.scan()
+        self.app.redraw()
+        self.assertEqual(
+            self.app.backup_panel.listing.get(0, tk.END),
+            ("new_file.txt", "touched.txt"),
+        )
+        self.app.select_file_backup(index=1)
+        self.app.redraw()
+        self.assertEqual(
+            self.app.backup_panel.listing.get(0, tk.END), ("new_file.txt",)
+        )
+        self.assertEqual(self.app.manager.report["attribute_files"], [])
+        self.assertEqual(
+            os.stat("test_bak/touched.txt").st_mtime_ns, 2_000_000_000
+        )
+
     def test_copy_to_b(self):
         """
         Test that new files are removed from the display and the report
@@ -521,6 +694,9 @@ class TestScan(unittest.TestCase):
                 f"{fld}/subdir/granddir/file3.txt", "w", encoding="utf-8"
             ) as out:
                 out.write("this is a third file")
+        match_attributes(
+            "file1.txt", "subdir/file2.txt", "subdir/granddir/file3.txt"
+        )
         self.root = tk.Tk()
         self.app = ba.App(self.root, "test_src", "test_bak")
 
@@ -727,7 +903,6 @@ class TestScan(unittest.TestCase):
             },
         )
 
-    @unittest.skip("Feature not yet implemented")
     def test_renamed_folder_with_missing_file_in_subdir(self):
         """
         Test that a renamed folder and a file moved into its subfolde
@@ -755,6 +930,1807 @@ class TestScan(unittest.TestCase):
         )
 
 
+class TestCompareTrees(unittest.TestCase):
+    """Tests for the single-pass scandir tree comparison."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(f"{fld}/subdir/granddir")
+            with open(f"{fld}/file1.txt", "w", encoding="utf-8") as out:
+                out.write("this is a file")
+            with open(f"{fld}/subdir/file2.txt", "w", encoding="utf-8") as out:
+                out.write("this is a second file")
+        match_attributes("file1.txt", "subdir/file2.txt")
+        self.manager = BackupManager("test_src", "test_bak")
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_categories(self):
+        """Test that every category is filled in dircmp order."""
+        with open("test_src/subdir/added.txt", "w", encoding="utf-8") as out:
+            out.write("added")
+        with open("test_src/a_added.txt", "w", encoding="utf-8") as out:
+            out.write("added")
+        with open(
+            "test_bak/subdir/granddir/gone.txt", "w", encoding="utf-8"
+        ) as out:
+            out.write("removed")
+        with open("test_src/file1.txt", "w", encoding="utf-8") as out:
+            out.write("this file changed")
+        report = compare_trees("test_src", "test_bak")
+        self.assertEqual(
+            report["added_files"],
+            ["a_added.txt", os.path.join("subdir", "added.txt")],
+        )
+        self.assertEqual(
+            report["removed_files"],
+            [os.path.join("subdir", "granddir", "gone.txt")],
+        )
+        self.assertEqual(
+            report["matched_files"], [os.path.join("subdir", "file2.txt")]
+        )
+        self.assertEqual(report["mismatched_files"], ["file1.txt"])
+        self.assertEqual(report["errors"], [])
+
+    def test_file_replaced_by_folder(self):
+        """Test that a name that changed type is reported as an error."""
+        os.remove("test_src/file1.txt")
+        os.makedirs("test_src/file1.txt")
+        report = compare_trees("test_src", "test_bak")
+        self.assertEqual(report["errors"], ["file1.txt"])
+
+    def test_parallel_matches_serial(self):
+        """Test that a parallel scan gives the same report as a serial one."""
+        for i in range(5):
+            os.makedirs(f"test_src/dir{i}/inner")
+            os.makedirs(f"test_bak/dir{i}")
+            with open(
+                f"test_src/dir{i}/inner/a.txt", "w", encoding="utf-8"
+            ) as out:
+                out.write("added")
+            with open(f"test_bak/dir{i}/b.txt", "w", encoding="utf-8") as out:
+                out.write("removed")
+        serial = compare_trees("test_src", "test_bak")
+        parallel = compare_trees("test_src", "test_bak", workers=4)
+        self.assertEqual(serial.items, parallel.items)
+        self.assertEqual(serial.stats.keys(), parallel.stats.keys())
+
+    def test_parallel_scan_works_ahead(self):
+        """Test that subtrees are listed before the walk reaches them."""
+        for root in ["test_src", "test_bak"]:
+            for branch in ["a", "b"]:
+                os.makedirs(f"{root}/{branch}/1/2/3")
+
+        class Recorder:
+            """Counts the directory listings of a walk."""
+
+            def __init__(self):
+                self.listed = 0
+
+            def read(self, nbytes=0, ops=1):
+                """Count one listing of a pair of directories."""
+                self.listed += 1
+
+        recorder = Recorder()
+        events = walk_diff(
+            "test_src", "test_bak", workers=4, throttle=recorder
+        )
+        self.assertEqual(next(events).path, "file1.txt")
+        deadline = time.monotonic() + 5
+        while recorder.listed < 11 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(recorder.listed, 11)
+        events.close()
+
+    def test_parallel_scan_bounds_look_ahead(self):
+        """Test that a parallel walk lists a bounded number of directories
+        ahead of the consumer.
+        """
+        for root in ["test_src", "test_bak"]:
+            for branch in "abcdef":
+                os.makedirs(f"{root}/{branch}/1/2/3")
+        listed = []
+
+        class Recorder:
+            """Counts the directory listings of a walk."""
+
+            def read(self, nbytes=0, ops=1):
+                """Count one listing of a pair of directories."""
+                listed.append(ops)
+
+        events = walk_diff(
+            "test_src", "test_bak", workers=2, throttle=Recorder()
+        )
+        self.assertEqual(next(events).path, "file1.txt")
+        window = 1 + LOOKAHEAD * 2
+        deadline = time.monotonic() + 5
+        while len(listed) < window and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        self.assertEqual(len(listed), window)
+        list(events)
+        self.assertEqual(len(listed), 27)
+
+    def test_scan_finds_moved_file(self):
+        """Test that BackupManager.scan still examines the new report."""
+        shutil.move("test_src/file1.txt", "test_src/subdir/file1.txt")
+        self.manager.scan("test_src", "test_bak")
+        self.assertEqual(
+            self.manager.report["moved_files"],
+            [
+                (
+                    os.path.join("test_bak", "file1.txt"),
+                    os.path.join("test_bak", "subdir", "file1.txt"),
+                )
+            ],
+        )
+        self.assertEqual(self.manager.report["added_files"], [])
+        self.assertEqual(self.manager.report["removed_files"], [])
+
+
+class TestScanIndex(unittest.TestCase):
+    """Tests for incremental scans using the persistent scan index."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(f"{fld}/subdir/granddir")
+            with open(f"{fld}/file1.txt", "w", encoding="utf-8") as out:
+                out.write("this is a file")
+            with open(f"{fld}/subdir/file2.txt", "w", encoding="utf-8") as out:
+                out.write("this is a second file")
+        match_attributes("file1.txt", "subdir/file2.txt")
+        self.index = ScanIndex.for_backup("test_bak")
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_unchanged_rescan_uses_index(self):
+        """Test that a rescan of unchanged trees reuses every directory."""
+        first = compare_trees("test_src", "test_bak", index=self.index)
+        second = compare_trees("test_src", "test_bak", index=self.index)
+        self.assertEqual(self.index.hits, 3)
+        self.assertEqual(self.index.misses, 0)
+        self.assertEqual(first.items, second.items)
+        self.assertNotIn(METADATA_DIR, second["removed_files"])
+
+    def test_changed_directory_is_rescanned(self):
+        """Test that a directory whose mtime changed is compared again."""
+        compare_trees("test_src", "test_bak", index=self.index)
+        with open(
+            "test_src/subdir/granddir/new.txt", "w", encoding="utf-8"
+        ) as out:
+            out.write("added")
+        report = compare_trees("test_src", "test_bak", index=self.index)
+        self.assertEqual(self.index.misses, 1)
+        self.assertEqual(
+            report["added_files"],
+            [os.path.join("subdir", "granddir", "new.txt")],
+        )
+        self.assertEqual(
+            report["matched_files"],
+            ["file1.txt", os.path.join("subdir", "file2.txt")],
+        )
+
+    def test_rewritten_file_is_compared_again(self):
+        """Test that a file changed in place is not taken from the index."""
+        compare_trees("test_src", "test_bak", index=self.index)
+        mtimes = os.stat("test_src/subdir").st_mtime_ns
+        with open("test_src/subdir/file2.txt", "w", encoding="utf-8") as out:
+            out.write("this file was rewritten in place")
+        self.assertEqual(os.stat("test_src/subdir").st_mtime_ns, mtimes)
+        report = compare_trees("test_src", "test_bak", index=self.index)
+        self.assertEqual(self.index.misses, 1)
+        self.assertEqual(
+            report["mismatched_files"], [os.path.join("subdir", "file2.txt")]
+        )
+        self.assertEqual(report["matched_files"], ["file1.txt"])
+
+
+class TestHashCache(unittest.TestCase):
+    """Tests for deep comparison through the content hash cache."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(fld)
+        with open("test_src/same.txt", "w", encoding="utf-8") as out:
+            out.write("identical")
+        with open("test_bak/same.txt", "w", encoding="utf-8") as out:
+            out.write("identical")
+        with open("test_src/changed.txt", "w", encoding="utf-8") as out:
+            out.write("aaaa")
+        with open("test_bak/changed.txt", "w", encoding="utf-8") as out:
+            out.write("bbbb")
+        match_attributes("same.txt", "changed.txt")
+        self.cache = HashCache()
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_deep_scan_compares_digests(self):
+        """Test that deep mode finds a change hidden by equal signatures."""
+        report = compare_trees(
+            "test_src", "test_bak", shallow=False, hash_cache=self.cache
+        )
+        self.assertEqual(report["mismatched_files"], ["changed.txt"])
+        self.assertEqual(report["matched_files"], ["same.txt"])
+        self.assertEqual(self.cache.stats(), {"hits": 0, "misses": 4})
+
+    def test_rescan_reads_nothing(self):
+        """Test that a deep rescan of unchanged files only hits the cache."""
+        compare_trees(
+            "test_src", "test_bak", shallow=False, hash_cache=self.cache
+        )
+        compare_trees(
+            "test_src", "test_bak", shallow=False, hash_cache=self.cache
+        )
+        self.assertEqual(self.cache.stats(), {"hits": 4, "misses": 4})
+
+
+class TestStreamingScan(unittest.TestCase):
+    """Tests for the streaming diff-event scan API."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(f"{fld}/subdir")
+            with open(f"{fld}/file1.txt", "w", encoding="utf-8") as out:
+                out.write("this is a file")
+        with open("test_src/subdir/new.txt", "w", encoding="utf-8") as out:
+            out.write("added")
+        with open("test_bak/old.txt", "w", encoding="utf-8") as out:
+            out.write("removed")
+        match_attributes("file1.txt")
+        self.manager = BackupManager("test_src", "test_bak")
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_events(self):
+        """Test that the walk yields typed events in visiting order."""
+        events = list(walk_diff("test_src", "test_bak"))
+        self.assertEqual(
+            [(event.kind, event.path) for event in events],
+            [
+                ("matched_files", "file1.txt"),
+                ("removed_files", "old.txt"),
+                ("added_files", os.path.join("subdir", "new.txt")),
+            ],
+        )
+
+    def test_scan_and_copy(self):
+        """Test that added files are copied while the scan runs."""
+        self.manager.scan_and_copy("test_src", "test_bak")
+        self.assertTrue(os.path.exists("test_bak/subdir/new.txt"))
+        self.assertEqual(self.manager.report["added_files"], [])
+        self.assertEqual(self.manager.report["removed_files"], ["old.txt"])
+
+
+@unittest.skipUnless(inotify_available(), "inotify is not available")
+class TestWatcher(unittest.TestCase):
+    """Tests for keeping the report live with inotify."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(f"{fld}/subdir")
+            with open(f"{fld}/file1.txt", "w", encoding="utf-8") as out:
+                out.write("this is a file")
+        match_attributes("file1.txt")
+        self.manager = BackupManager("test_src", "test_bak")
+        self.manager.scan("test_src", "test_bak")
+        self.watcher = self.manager.watch()
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def poll(self):
+        """Apply events until none are left."""
+        while self.watcher.poll(0.2):
+            pass
+
+    def test_created_file(self):
+        """Test that a created file is added to the report."""
+        with open("test_src/subdir/new.txt", "w", encoding="utf-8") as out:
+            out.write("added")
+        self.poll()
+        self.assertEqual(
+            self.manager.report["added_files"],
+            [os.path.join("subdir", "new.txt")],
+        )
+
+    def test_modified_file(self):
+        """Test that a modified file becomes mismatched."""
+        with open("test_src/file1.txt", "w", encoding="utf-8") as out:
+            out.write("this file changed")
+        self.poll()
+        self.assertEqual(self.manager.report["matched_files"], [])
+        self.assertEqual(
+            self.manager.report["mismatched_files"], ["file1.txt"]
+        )
+
+    def test_renamed_file(self):
+        """Test that a rename is paired into a moved_files entry."""
+        os.rename("test_src/file1.txt", "test_src/subdir/file1.txt")
+        self.poll()
+        self.assertEqual(
+            self.manager.report["moved_files"],
+            [
+                (
+                    os.path.join("test_bak", "file1.txt"),
+                    os.path.join("test_bak", "subdir", "file1.txt"),
+                )
+            ],
+        )
+        self.assertEqual(
+            self.manager.report["matched_files"],
+            [os.path.join("subdir", "file1.txt")],
+        )
+        self.assertEqual(self.manager.report["added_files"], [])
+
+    def test_chained_renames(self):
+        """Test that renames of a renamed file collapse into one pair."""
+        os.rename("test_src/file1.txt", "test_src/file2.txt")
+        self.poll()
+        os.rename("test_src/file2.txt", "test_src/subdir/file3.txt")
+        self.poll()
+        self.assertEqual(
+            self.manager.report["moved_files"],
+            [
+                (
+                    os.path.join("test_bak", "file1.txt"),
+                    os.path.join("test_bak", "subdir", "file3.txt"),
+                )
+            ],
+        )
+        self.assertEqual(
+            self.manager.report["matched_files"],
+            [os.path.join("subdir", "file3.txt")],
+        )
+        self.assertEqual(self.manager.report["added_files"], [])
+        os.rename("test_src/subdir/file3.txt", "test_src/file1.txt")
+        self.poll()
+        self.assertEqual(self.manager.report["moved_files"], [])
+        self.assertEqual(self.manager.report["matched_files"], ["file1.txt"])
+        self.assertEqual(self.manager.report["removed_files"], [])
+
+    def test_overflow_rescans(self):
+        """Test that a queue overflow falls back to a rescan."""
+        with open("test_bak/old.txt", "w", encoding="utf-8") as out:
+            out.write("removed")
+        self.watcher.apply([(-1, IN_Q_OVERFLOW, 0, "")])
+        self.assertEqual(self.watcher.overflows, 1)
+        self.assertEqual(self.manager.report["removed_files"], ["old.txt"])
+
+
+class TestExamine(unittest.TestCase):
+    """Tests for move detection in Report.examine."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(f"{fld}/subdir")
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def write(self, path, text):
+        """Write text to a file."""
+        with open(path, "w", encoding="utf-8") as out:
+            out.write(text)
+
+    def test_same_size_different_contents(self):
+        """Test that files of equal size but other contents are not moves."""
+        self.write("test_src/subdir/a.txt", "aaaa")
+        self.write("test_bak/a.txt", "bbbb")
+        report = compare_trees("test_src", "test_bak").examine()
+        self.assertEqual(report["moved_files"], [])
+        self.assertEqual(
+            report["added_files"], [os.path.join("subdir", "a.txt")]
+        )
+        self.assertEqual(report["removed_files"], ["a.txt"])
+
+    def test_each_removed_file_moves_once(self):
+        """Test that a removed file is paired with one added file only."""
+        self.write("test_src/subdir/a.txt", "same")
+        self.write("test_src/subdir/b.txt", "same")
+        self.write("test_bak/old.txt", "same")
+        report = compare_trees("test_src", "test_bak").examine()
+        self.assertEqual(
+            report["moved_files"],
+            [
+                (
+                    os.path.join("test_bak", "old.txt"),
+                    os.path.join("test_bak", "subdir", "a.txt"),
+                )
+            ],
+        )
+        self.assertEqual(
+            report["added_files"], [os.path.join("subdir", "b.txt")]
+        )
+        self.assertEqual(report["removed_files"], [])
+
+    def test_renamed_folder_fingerprint(self):
+        """Test that a renamed folder is found by its fingerprint."""
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(f"{fld}/subdir/granddir")
+            self.write(f"{fld}/subdir/granddir/c.txt", "deep file")
+        match_attributes("subdir/granddir/c.txt")
+        os.rename("test_src/subdir", "test_src/newdir")
+        report = compare_trees("test_src", "test_bak").examine()
+        pair = (
+            os.path.join("test_bak", "subdir"),
+            os.path.join("test_bak", "newdir"),
+        )
+        self.assertEqual(report["moved_files"], [pair])
+        self.assertEqual(report.move_scores[pair], 1.0)
+
+    def test_renamed_folder_coarse_mtimes(self):
+        """Test that a renamed folder is found when its backup copy kept
+        its times to a coarser unit than the source."""
+        for fld in ["test_src/newdir", "test_bak/olddir"]:
+            os.makedirs(fld)
+            self.write(f"{fld}/c.txt", "four")
+        os.utime("test_src/newdir/c.txt", ns=(0, 1_999_999_999))
+        os.utime("test_bak/olddir/c.txt", ns=(0, 2_000_000_000))
+        report = compare_trees("test_src", "test_bak").examine()
+        pair = (
+            os.path.join("test_bak", "olddir"),
+            os.path.join("test_bak", "newdir"),
+        )
+        self.assertEqual(report["moved_files"], [pair])
+        self.assertEqual(report.move_scores[pair], 1.0)
+
+    def test_renamed_folder_with_broken_link(self):
+        """Test that a broken link in a moved folder is skipped."""
+        for fld in ["test_src/newdir", "test_bak/olddir"]:
+            os.makedirs(fld)
+            self.write(f"{fld}/a.txt", "first file")
+            self.write(f"{fld}/b.txt", "second file")
+        for name in ("a.txt", "b.txt"):
+            shutil.copystat(
+                f"test_src/newdir/{name}", f"test_bak/olddir/{name}"
+            )
+        os.symlink("missing", "test_src/newdir/link")
+        report = compare_trees("test_src", "test_bak").examine()
+        self.assertEqual(
+            report["moved_files"],
+            [
+                (
+                    os.path.join("test_bak", "olddir"),
+                    os.path.join("test_bak", "newdir"),
+                )
+            ],
+        )
+
+    def test_same_layout_other_files(self):
+        """Test that folders with equal names and sizes but other files are
+        not taken for a move."""
+        for fld in ["test_src/newdir", "test_bak/olddir"]:
+            os.makedirs(fld)
+            self.write(f"{fld}/c.txt", "four")
+        os.utime("test_bak/olddir/c.txt", (1000000000, 1000000000))
+        report = compare_trees("test_src", "test_bak").examine()
+        self.assertEqual(report["moved_files"], [])
+
+    def test_renamed_folder_with_file_moved_into_subdir(self):
+        """Test that a file moved deep into a renamed folder is found."""
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(f"{fld}/subdir/granddir")
+            self.write(f"{fld}/subdir/b.txt", "second file")
+            self.write(f"{fld}/subdir/granddir/c.txt", "third file")
+            self.write(f"{fld}/a.txt", "first file")
+        match_attributes("subdir/b.txt", "subdir/granddir/c.txt", "a.txt")
+        shutil.move("test_src/a.txt", "test_src/subdir/granddir/a.txt")
+        os.rename("test_src/subdir", "test_src/newdir")
+        report = compare_trees("test_src", "test_bak").examine()
+        self.assertEqual(
+            report["moved_files"],
+            [
+                (
+                    os.path.join("test_bak", "subdir"),
+                    os.path.join("test_bak", "newdir"),
+                ),
+                (
+                    os.path.join("test_bak", "a.txt"),
+                    os.path.join("test_bak", "newdir", "granddir", "a.txt"),
+                ),
+            ],
+        )
+        self.assertEqual(report["added_files"], [])
+        self.assertEqual(report["removed_files"], [])
+
+    def test_full_digest_reuses_partial_read(self):
+        """Test that the full digest matches a fresh digest of the file."""
+        self.write("test_src/big.txt", "x" * (PARTIAL_SIZE + 10))
+        digests = ContentDigests()
+        digests.partial("test_src/big.txt")
+        self.assertEqual(
+            digests.full("test_src/big.txt"), file_digest("test_src/big.txt")
+        )
+
+
+class TestEntryList(unittest.TestCase):
+    """Tests for the indexed report categories."""
+
+    def test_list_compatibility(self):
+        """Test that a category still reads like a list."""
+        report = Report({"added_files": ["a.txt", "b.txt"]})
+        report["added_files"].append("c.txt")
+        report["added_files"].remove("b.txt")
+        self.assertEqual(report["added_files"], ["a.txt", "c.txt"])
+        self.assertEqual(report["added_files"][-1], "c.txt")
+        self.assertIn("a.txt", report["added_files"])
+        self.assertEqual(len(report["added_files"]), 2)
+        with self.assertRaises(ValueError):
+            report["added_files"].remove("b.txt")
+
+    def test_index_after_changes(self):
+        """Test that positions follow every change to a category."""
+        entries = EntryList(["a.txt", "b.txt", "c.txt"])
+        self.assertEqual(entries[1], "b.txt")
+        self.assertIs(entries._key_list(), entries._key_list())
+        entries.discard("a.txt")
+        self.assertEqual(entries[0], "b.txt")
+        entries.append("d.txt")
+        self.assertEqual(entries[-1], "d.txt")
+        self.assertEqual(entries.index("d.txt"), 2)
+        entries.remove("b.txt")
+        self.assertEqual(entries[0:2], ["c.txt", "d.txt"])
+        entries.clear()
+        with self.assertRaises(IndexError):
+            entries[0]
+        with self.assertRaises(ValueError):
+            entries.index("c.txt")
+
+    def test_assigned_list_is_indexed(self):
+        """Test that assigning a list to a category wraps it."""
+        report = Report()
+        report["moved_files"] = [("old", "new")]
+        self.assertIsInstance(report["moved_files"], EntryList)
+        self.assertEqual(
+            report["moved_files"].entry(("old", "new")).pair, ("old", "new")
+        )
+
+    def test_scan_records_sizes(self):
+        """Test that scanned entries keep their size."""
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        os.makedirs("test_src")
+        os.makedirs("test_bak")
+        with open("test_src/new.txt", "w", encoding="utf-8") as out:
+            out.write("12345")
+        report = compare_trees("test_src", "test_bak")
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        self.assertEqual(report["added_files"].entry("new.txt").size, 5)
+
+
+class TestFastCopier(unittest.TestCase):
+    """Tests for the kernel-offloaded copy backend."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(fld)
+        with open("test_src/data.bin", "wb") as out:
+            out.write(os.urandom(3 * 1024 * 1024 + 17))
+        os.utime("test_src/data.bin", ns=(1_000_000_000, 2_000_000_000))
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def assert_copied(self):
+        """Check the copy has the same contents and mtime as the source."""
+        self.assertEqual(
+            file_digest("test_src/data.bin"), file_digest("test_bak/data.bin")
+        )
+        self.assertEqual(
+            os.stat("test_bak/data.bin").st_mtime_ns, 2_000_000_000
+        )
+
+    def test_each_method(self):
+        """Test that every method that works here copies correctly."""
+        for method in METHODS:
+            copier = FastCopier(methods=(method, "readwrite"))
+            copier.copy2("test_src/data.bin", "test_bak/data.bin")
+            self.assert_copied()
+            self.assertIn(copier.used["test_bak/data.bin"], METHODS)
+
+    def test_manager_copies_with_fast_copier(self):
+        """Test that BackupManager records the method of each copy."""
+        manager = BackupManager("test_src", "test_bak", fast_copy=True)
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.copy_added_files(), [])
+        self.assert_copied()
+        self.assertEqual(sum(manager.copier.counts.values()), 1)
+
+    def test_fast_copies_are_verified(self):
+        """Test that verification checks the copies of the fast copier."""
+        manager = BackupManager(
+            "test_src", "test_bak", fast_copy=True, verify_copies=True
+        )
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.copy_added_files(), [])
+        self.assert_copied()
+        self.assertEqual(sum(manager.copier.counts.values()), 1)
+        cache = HashCache.for_backup("test_bak")
+        path = "test_bak/data.bin"
+        self.assertEqual(
+            cache.lookup(path, os.stat(path)),
+            file_digest("test_src/data.bin"),
+        )
+        cache.close()
+        copier = CorruptingCopier()
+        copy = copier.copying(manager.copier.copy2)
+        with self.assertRaises(OSError):
+            copy("test_src/data.bin", "test_bak/other.bin")
+        self.assertFalse(os.path.exists("test_bak/other.bin"))
+
+
+class TestQuarantine(unittest.TestCase):
+    """Tests for the quarantine store inside the backup folder."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak/subdir"]:
+            os.makedirs(fld)
+        for name in ["old.txt", os.path.join("subdir", "older.txt")]:
+            with open(
+                os.path.join("test_bak", name), "w", encoding="utf-8"
+            ) as out:
+                out.write(f"contents of {name}")
+        self.quarantine = Quarantine("test_bak")
+
+    def tearDown(self):
+        self.quarantine.close()
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_delete_and_restore(self):
+        """Test that deleted files are quarantined and can be restored."""
+        with self.quarantine.batch():
+            failed = fs.delete_files_from_b(
+                "test_bak",
+                ["old.txt", os.path.join("subdir", "older.txt")],
+                remove_function=self.quarantine.put,
+            )
+        self.assertEqual(failed, [])
+        self.assertFalse(os.path.exists("test_bak/old.txt"))
+        self.assertEqual(len(self.quarantine.entries()), 2)
+        self.assertEqual(self.quarantine.total_size(), 47)
+        restored = self.quarantine.restore(os.path.join("subdir", "older.txt"))
+        self.assertEqual(
+            restored, os.path.join("test_bak", "subdir", "older.txt")
+        )
+        with open(restored, encoding="utf-8") as filein:
+            self.assertIn("older.txt", filein.read())
+        self.assertEqual(
+            [row[1] for row in self.quarantine.entries()], ["old.txt"]
+        )
+        with self.assertRaises(KeyError):
+            self.quarantine.restore("missing.txt")
+
+    def test_same_file_twice(self):
+        """Test that two versions of one path are both kept."""
+        with self.quarantine.batch():
+            self.quarantine.put("test_bak/old.txt")
+            with open("test_bak/old.txt", "w", encoding="utf-8") as out:
+                out.write("second")
+            self.quarantine.put("test_bak/old.txt")
+        self.assertEqual(len(self.quarantine.entries("old.txt")), 2)
+        self.quarantine.restore("old.txt")
+        with open("test_bak/old.txt", encoding="utf-8") as filein:
+            self.assertEqual(filein.read(), "second")
+        with self.assertRaises(FileExistsError):
+            self.quarantine.restore("old.txt")
+
+    def test_purge(self):
+        """Test that entries are purged by size, then by age."""
+        self.quarantine.put("test_bak/old.txt")
+        self.quarantine.put("test_bak/subdir")
+        self.quarantine.max_bytes = 30
+        self.assertEqual(self.quarantine.purge(), 1)
+        self.assertEqual(
+            [row[1] for row in self.quarantine.entries()], ["subdir"]
+        )
+        self.quarantine.max_bytes = None
+        self.assertEqual(self.quarantine.purge(), 0)
+        self.assertEqual(self.quarantine.purge(now=2**40), 1)
+        self.assertEqual(self.quarantine.entries(), [])
+        self.assertEqual(os.listdir(self.quarantine.folder), [])
+
+    def test_reconcile_after_crash(self):
+        """Test that an unclean quarantine is matched with its folder."""
+        self.quarantine.put("test_bak/old.txt")
+        os.remove(os.path.join(self.quarantine.folder, self.stored("old.txt")))
+        # a file moved in a batch whose rows were never committed
+        batch = os.path.join(self.quarantine.folder, "1000000000")
+        os.makedirs(batch)
+        shutil.move("test_bak/subdir", os.path.join(batch, "subdir"))
+        self.quarantine.connection.close()
+        self.quarantine = Quarantine("test_bak")
+        entries = self.quarantine.entries()
+        self.assertEqual(
+            [(row[1], row[3]) for row in entries],
+            [(os.path.join("subdir", "older.txt"), 1.0)],
+        )
+        self.assertEqual(
+            self.quarantine.restore(os.path.join("subdir", "older.txt")),
+            os.path.join("test_bak", "subdir", "older.txt"),
+        )
+        self.assertEqual(self.quarantine.reconcile(), 0)
+
+    def stored(self, original):
+        """Return the stored path of the newest entry of original."""
+        return self.quarantine.connection.execute(
+            "SELECT stored FROM entries WHERE original = ?", (original,)
+        ).fetchone()[0]
+
+    def test_quarantine_is_opt_in(self):
+        """Test that a manager only quarantines files when asked to."""
+        self.assertFalse(BackupManager("test_src", "test_bak").use_quarantine)
+
+    def test_manager_quarantines_overwritten_files(self):
+        """Test that BackupManager moves replaced files into the quarantine."""
+        with open("test_src/old.txt", "w", encoding="utf-8") as out:
+            out.write("a newer version")
+        manager = BackupManager("test_src", "test_bak", use_quarantine=True)
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.update_files(), [])
+        self.assertEqual(manager.delete_files(), [])
+        self.assertEqual(
+            sorted(row[1] for row in self.quarantine.entries()),
+            ["old.txt", "subdir"],
+        )
+        self.assertEqual(
+            manager.restore_file("subdir"), os.path.join("test_bak", "subdir")
+        )
+
+
+class TestJournal(unittest.TestCase):
+    """Tests for the write-ahead journal and crash recovery."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(fld)
+        with open("test_src/big.bin", "wb") as out:
+            out.write(os.urandom(3 * 1024 * 1024))
+        self.journal = Journal.for_backup("test_bak")
+        self.manager = BackupManager("test_src", "test_bak", use_journal=True)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_rename_checkpointed_copy(self):
+        """Test that a copy written before a crash is only renamed."""
+        dst = os.path.join("test_bak", "big.bin")
+        op_id = self.journal.plan(
+            COPY, os.path.join("test_src", "big.bin"), dst
+        )
+        temp = Journal.temp_path(dst, op_id)
+        shutil.copy2("test_src/big.bin", temp)
+        self.journal.checkpoint(op_id, os.path.getsize(temp), WRITTEN)
+        inode = os.stat(temp).st_ino
+        self.assertEqual(
+            self.manager.recover(),
+            [(COPY, os.path.join("test_src", "big.bin"), dst, REPLAYED)],
+        )
+        self.assertFalse(os.path.exists(temp))
+        self.assertEqual(os.stat(dst).st_ino, inode)
+        self.assertEqual(file_digest(dst), file_digest("test_src/big.bin"))
+        self.assertEqual(self.journal.unfinished(), [])
+
+    def test_copy_torn_write_again(self):
+        """Test that a copy interrupted while writing is made again."""
+        dst = os.path.join("test_bak", "big.bin")
+        op_id = self.journal.plan(
+            COPY, os.path.join("test_src", "big.bin"), dst
+        )
+        temp = Journal.temp_path(dst, op_id)
+        with open(temp, "wb") as out:
+            out.write(b"torn write")
+        self.assertEqual(self.manager.recover()[0][3], REPLAYED)
+        self.assertFalse(os.path.exists(temp))
+        self.assertEqual(file_digest(dst), file_digest("test_src/big.bin"))
+
+    def test_overwrite_that_never_started(self):
+        """Test that an overwrite planned before a crash is not taken as
+        done because the old file is still there.
+        """
+        dst = os.path.join("test_bak", "big.bin")
+        with open(dst, "wb") as out:
+            out.write(b"old")
+        self.journal.plan(COPY, os.path.join("test_src", "big.bin"), dst)
+        self.assertEqual(self.manager.recover()[0][3], REPLAYED)
+        self.assertEqual(file_digest(dst), file_digest("test_src/big.bin"))
+
+    def test_large_copies_are_verified_and_throttled(self):
+        """Test that journaled large copies go through the copy pipeline."""
+        throttle = Throttle()
+        manager = BackupManager(
+            "test_src",
+            "test_bak",
+            use_journal=True,
+            checkpoint_bytes=1024 * 1024,
+            throttle=throttle,
+            verify_copies=True,
+        )
+        manager.scan("test_src", "test_bak")
+        with self.assertLogs(manager.logger, logging.INFO) as logs:
+            self.assertEqual(manager.copy_added_files(), [])
+        self.assertIn("'verified': 1", "\n".join(logs.output))
+        self.assertEqual(throttle.stats()["write_bytes"], 3 * 1024 * 1024)
+        self.assertEqual(
+            sorted(os.listdir("test_bak")), [METADATA_DIR, "big.bin"]
+        )
+        self.assertEqual(self.journal.unfinished(), [])
+
+    def test_roll_back_copy_of_missing_source(self):
+        """Test that a copy whose source is gone is undone."""
+        dst = os.path.join("test_bak", "gone.txt")
+        op_id = self.journal.plan(
+            COPY, os.path.join("test_src", "gone.txt"), dst
+        )
+        temp = Journal.temp_path(dst, op_id)
+        with open(temp, "wb") as out:
+            out.write(b"partial")
+        self.assertEqual(self.manager.recover()[0][3], ROLLED_BACK)
+        self.assertFalse(os.path.exists(temp))
+        self.assertFalse(os.path.exists(dst))
+
+    def test_replay_delete(self):
+        """Test that a planned delete is finished on the next sync."""
+        with open("test_bak/old.txt", "w", encoding="utf-8") as out:
+            out.write("old")
+        self.journal.plan(DELETE, os.path.join("test_bak", "old.txt"))
+        self.manager.scan("test_src", "test_bak")
+        self.assertEqual(self.manager.copy_added_files(), [])
+        self.assertFalse(os.path.exists("test_bak/old.txt"))
+        self.assertEqual(self.journal.unfinished(), [])
+        self.assertEqual(self.manager.recover(), [])
+
+    def test_replace_removes_old_file_last(self):
+        """Test that an old file is only removed once its copy is written."""
+        with open("test_bak/big.bin", "wb") as out:
+            out.write(b"old")
+        seen = []
+
+        def remove(path):
+            seen.append(sorted(os.listdir("test_bak")))
+            os.remove(path)
+
+        failed = update_files_a_to_b(
+            "test_src", "test_bak", ["big.bin"], remove_function=remove
+        )
+        self.assertEqual(failed, [])
+        self.assertEqual(seen, [[METADATA_DIR, ".big.bin.replace", "big.bin"]])
+        self.assertEqual(
+            sorted(os.listdir("test_bak")), [METADATA_DIR, "big.bin"]
+        )
+        self.assertEqual(
+            file_digest("test_bak/big.bin"), file_digest("test_src/big.bin")
+        )
+
+    def test_crash_while_replacing(self):
+        """Test that a crash between removal and rename is recovered."""
+        dst = os.path.join("test_bak", "big.bin")
+        with open(dst, "wb") as out:
+            out.write(b"old")
+
+        def crash(path):
+            os.remove(path)
+            raise SystemExit
+
+        copy = self.journal.copying(shutil.copy2, remove_function=crash)
+        with self.assertRaises(SystemExit):
+            copy(os.path.join("test_src", "big.bin"), dst)
+        self.assertFalse(os.path.exists(dst))
+        self.manager.scan("test_src", "test_bak")
+        self.assertEqual(self.manager.report["removed_files"], [])
+        self.assertEqual(self.manager.report["matched_files"], ["big.bin"])
+        self.assertEqual(self.journal.unfinished(), [])
+
+    def test_journaled_sync_leaves_no_temporary_files(self):
+        """Test that journaled copies are renamed into place."""
+        self.manager.scan("test_src", "test_bak")
+        self.assertEqual(self.manager.copy_added_files(), [])
+        self.assertEqual(
+            sorted(os.listdir("test_bak")), [METADATA_DIR, "big.bin"]
+        )
+        self.assertEqual(self.journal.unfinished(), [])
+
+
+class TestDurableWriter(unittest.TestCase):
+    """Tests for batched durable writes."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(fld)
+        for i in range(5):
+            with open(f"test_src/file{i}.txt", "w", encoding="utf-8") as out:
+                out.write(f"file {i}")
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_batched(self):
+        """Test that files are renamed into place a batch at a time."""
+        writer = DurableWriter(BATCHED, batch_files=3, batch_ms=60_000)
+        committed = []
+        for i in range(5):
+            writer.copy2(f"test_src/file{i}.txt", "test_bak")
+            committed.append(
+                len(glob.glob(os.path.join("test_bak", "file*.txt")))
+            )
+        self.assertEqual(committed, [0, 0, 3, 3, 3])
+        writer.close()
+        self.assertEqual(
+            sorted(os.listdir("test_bak")), sorted(os.listdir("test_src"))
+        )
+        stats = writer.stats()
+        self.assertEqual((stats["batches"], stats["files"]), (2, 5))
+
+    def test_strict(self):
+        """Test that strict mode commits every file before returning."""
+        writer = DurableWriter(STRICT)
+        for i in range(3):
+            writer.copy2(f"test_src/file{i}.txt", "test_bak")
+            self.assertTrue(os.path.exists(f"test_bak/file{i}.txt"))
+        self.assertEqual(writer.stats()["batches"], 3)
+
+    def test_failed_commit(self):
+        """Test that a file failing to commit does not hold up its batch."""
+        writer = DurableWriter(BATCHED, batch_files=5, batch_ms=60_000)
+        journal = Journal.for_backup("test_bak")
+        copy = journal.copying(shutil.copy2, writer)
+        for i in range(4):
+            copy(f"test_src/file{i}.txt", "test_bak")
+        os.makedirs("test_bak/file1.txt/taken")
+        writer.close()
+        self.assertEqual(
+            writer.take_failed(), [os.path.join("test_bak", "file1.txt")]
+        )
+        self.assertEqual(journal.unfinished(), [])
+        journal.close()
+        self.assertEqual(glob.glob("test_bak/.*.part"), [])
+        for i in (0, 2, 3):
+            self.assertTrue(os.path.isfile(f"test_bak/file{i}.txt"))
+
+    def test_unknown_mode(self):
+        """Test that an unknown mode is refused."""
+        with self.assertRaises(ValueError):
+            DurableWriter("sometimes")
+
+    def test_manager_with_journal(self):
+        """Test that journaled operations complete once files are durable."""
+        manager = BackupManager(
+            "test_src", "test_bak", use_journal=True, durability=BATCHED
+        )
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.copy_added_files(), [])
+        self.assertEqual(
+            sorted(os.listdir("test_bak")),
+            sorted(os.listdir("test_src") + [METADATA_DIR]),
+        )
+        journal = Journal.for_backup("test_bak")
+        self.assertEqual(journal.unfinished(), [])
+        journal.close()
+
+
+class FakeClock:
+    """A clock that only moves when something sleeps."""
+
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+    def sleep(self, seconds):
+        """Move the clock forward instead of sleeping."""
+        self.time += seconds
+
+
+class TestThrottle(unittest.TestCase):
+    """Tests for token-bucket throttling of reads and writes."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(fld)
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def make_throttle(self, limits=None, profiles=(), hour=12):
+        """Return a throttle running on the fake clock."""
+        return Throttle(
+            limits,
+            profiles,
+            clock=self.clock,
+            sleep=self.clock.sleep,
+            now=lambda: datetime(2024, 1, 1, hour),
+        )
+
+    def test_token_bucket(self):
+        """Test that a bucket allows its burst, then paces requests."""
+        bucket = TokenBucket(100, clock=self.clock)
+        self.assertEqual(bucket.reserve(100), 0)
+        self.assertEqual(bucket.reserve(50), 0.5)
+        self.clock.sleep(1.5)
+        self.assertEqual(bucket.reserve(100), 0)
+        self.assertEqual(TokenBucket(None).reserve(10**9), 0)
+
+    def test_throttled_copy(self):
+        """Test that a large copy is paced by the write bandwidth."""
+        with open("test_src/big.bin", "wb") as out:
+            out.write(os.urandom(3 * 1024 * 1024))
+        throttle = self.make_throttle({"write_bytes": 1024 * 1024})
+        failed = copy_files_from_a_to_b(
+            "test_src",
+            "test_bak",
+            ["big.bin"],
+            copy_function=throttle.copying(),
+        )
+        self.assertEqual(failed, [])
+        self.assertEqual(
+            file_digest("test_src/big.bin"), file_digest("test_bak/big.bin")
+        )
+        stats = throttle.stats()
+        self.assertEqual(stats["write_wait"], 2.0)
+        self.assertEqual(stats["read_wait"], 0.0)
+        self.assertEqual(stats["write_bytes"], 3 * 1024 * 1024)
+
+    def test_throttled_copier(self):
+        """Test that throttled copies still go through the given copier."""
+        with open("test_src/big.bin", "wb") as out:
+            out.write(os.urandom(3 * 1024 * 1024))
+        throttle = self.make_throttle({"write_bytes": 1024 * 1024})
+        verifier = VerifyingCopier()
+        copy_function = throttle.copying(verifier.copy2)
+        copy_function("test_src/big.bin", "test_bak")
+        self.assertEqual(verifier.stats()["verified"], 1)
+        self.assertEqual(throttle.stats()["write_wait"], 2.0)
+
+    def test_reads_and_writes_wait_together(self):
+        """Test that a copy waits for reads and writes at once, per chunk."""
+        with open("test_src/big.bin", "wb") as out:
+            out.write(os.urandom(3 * 1024 * 1024))
+        limit = 1024 * 1024
+        throttle = self.make_throttle(
+            {"read_bytes": limit, "write_bytes": limit}
+        )
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            self.clock.sleep(seconds)
+
+        throttle.sleep = sleep
+        throttle.copying()("test_src/big.bin", "test_bak")
+        self.assertEqual(sleeps, [1.0, 1.0])
+        self.assertEqual(throttle.stats()["read_wait"], 2.0)
+        self.assertEqual(throttle.stats()["write_wait"], 2.0)
+        sleeps.clear()
+        self.clock.sleep(10)
+        throttle.copying(lambda src, dst: shutil.copy2(src, dst))(
+            "test_src/big.bin", "test_bak"
+        )
+        self.assertEqual(sleeps, [2.0])
+
+    def test_time_of_day_profiles(self):
+        """Test that profiles apply only during their hours."""
+        profiles = [
+            ("09:00", "17:00", {"write_ops": 1}),
+            ("22:00", "06:00", {"write_ops": 2}),
+        ]
+        for hour, waited in [(10, 1.0), (23, 0.5), (3, 0.5), (20, 0.0)]:
+            throttle = self.make_throttle({}, profiles, hour)
+            throttle.write(ops=2)
+            self.assertEqual(throttle.write(), waited)
+
+    def test_throttled_scan(self):
+        """Test that the scan walker waits for the read budget."""
+        os.makedirs("test_src/subdir")
+        with open("test_src/subdir/a.txt", "w", encoding="utf-8") as out:
+            out.write("added")
+        throttle = self.make_throttle({"read_ops": 2})
+        manager = BackupManager("test_src", "test_bak", throttle=throttle)
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.report["added_files"], ["subdir"])
+        self.assertEqual(throttle.stats()["read_ops"], 2)
+        self.assertEqual(manager.copy_added_files(), [])
+        self.assertTrue(os.path.exists("test_bak/subdir/a.txt"))
+        self.assertGreater(throttle.stats()["write_ops"], 0)
+
+
+class TestSyncPlan(unittest.TestCase):
+    """Tests for the dependency-aware sync planner."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(fld)
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_plan_dependencies(self):
+        """Test the order constraints between planned operations."""
+        old = os.path.join("test_bak", "old", "a.txt")
+        new = os.path.join("test_bak", "new", "a.txt")
+        report = Report(
+            {
+                "added_files": [
+                    os.path.join("x", "y", "b.txt"),
+                    os.path.join("new", "a.txt"),
+                ],
+                "removed_files": ["old"],
+                "mismatched_files": [],
+                "moved_files": [(old, new)],
+            },
+            source="test_src",
+            backup="test_bak",
+        )
+        plan = plan_sync(report, "test_bak")
+        self.assertEqual(
+            plan.counts(), {MOVE: 1, MKDIR: 3, COPY: 1, DELETE: 1}
+        )
+        self.assertEqual(plan.dropped, [(os.path.join("new", "a.txt"), 0)])
+        index = {operation: i for i, operation in enumerate(plan)}
+        move = index[Operation(MOVE, old, new)]
+        make_new = index[Operation(MKDIR, os.path.join("test_bak", "new"))]
+        make_x = index[Operation(MKDIR, os.path.join("test_bak", "x"))]
+        make_y = index[Operation(MKDIR, os.path.join("test_bak", "x", "y"))]
+        copy = index[Operation(COPY, os.path.join("x", "y", "b.txt"))]
+        delete = index[Operation(DELETE, "old")]
+        self.assertEqual(plan.depends[move], {make_new})
+        self.assertEqual(plan.depends[make_y], {make_x})
+        self.assertEqual(plan.depends[copy], {make_y})
+        self.assertEqual(plan.depends[delete], {move})
+
+    def test_run_plan_skips_dependents_and_breaks_cycles(self):
+        """Test that a failure skips what waits for it."""
+        plan = SyncPlan()
+        first = plan.add(Operation(MKDIR, "a"))
+        second = plan.add(Operation(COPY, "b"), [first])
+        third = plan.add(Operation(DELETE, "c"), [second])
+        swap_a = plan.add(Operation(MOVE, "d", "e"))
+        swap_b = plan.add(Operation(MOVE, "e", "d"), [swap_a])
+        plan.depends[swap_a].add(swap_b)
+        ran = []
+        handlers = {
+            MKDIR: lambda operation: False,
+            MOVE: lambda operation: ran.append(operation.path) or True,
+        }
+        failed = run_plan(plan, handlers, workers=2)
+        self.assertEqual(failed, [first, second, third])
+        self.assertEqual(ran, ["d", "e"])
+
+    def test_sync(self):
+        """Test that one planned sync brings the backup up to date."""
+        for folder in ["test_src/new", "test_bak/old"]:
+            os.makedirs(folder)
+        for path, text in [
+            ("test_src/new/a.txt", "moved"),
+            ("test_bak/old/a.txt", "moved"),
+            ("test_src/added.txt", "added"),
+            ("test_bak/removed.txt", "removed"),
+            ("test_src/changed.txt", "changed!"),
+            ("test_bak/changed.txt", "changed"),
+        ]:
+            with open(path, "w", encoding="utf-8") as out:
+                out.write(text)
+        shutil.copystat("test_src/new/a.txt", "test_bak/old/a.txt")
+        manager = BackupManager("test_src", "test_bak", copy_workers=4)
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.sync(), [])
+        for key in [
+            "added_files",
+            "removed_files",
+            "mismatched_files",
+            "moved_files",
+        ]:
+            self.assertEqual(manager.report[key], [])
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(
+            manager.report["matched_files"],
+            ["added.txt", "changed.txt", os.path.join("new", "a.txt")],
+        )
+
+
+class TestCostModel(unittest.TestCase):
+    """Tests for dry runs and the sync cost model."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src/folder", "test_bak"]:
+            os.makedirs(fld)
+        for path, size in [
+            ("test_src/small.txt", 100),
+            ("test_src/folder/medium.bin", 100_000),
+            ("test_src/folder/large.bin", 2_000_000),
+            ("test_bak/removed.txt", 10),
+        ]:
+            with open(path, "wb") as out:
+                out.write(b"x" * size)
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_fit(self):
+        """Test that throughput and overhead are fitted to recorded runs."""
+        model = CostModel()
+        self.assertEqual(model.predict(0, 0), 0)
+        for nbytes, files in [(10**6, 10), (10**8, 5), (10**7, 1000)]:
+            model.record(nbytes, files, nbytes / 10**6 + files * 0.01)
+        self.assertAlmostEqual(model.throughput, 10**6)
+        self.assertAlmostEqual(model.overhead, 0.01)
+
+    def test_single_run(self):
+        """Test that one run calibrates the throughput only."""
+        model = CostModel()
+        model.record(10**6, 200, 2.0)
+        self.assertAlmostEqual(model.overhead, 0.005)
+        self.assertAlmostEqual(model.throughput, 10**6)
+
+    def test_dry_run(self):
+        """Test that a dry run sizes the plan without changing anything."""
+        manager = BackupManager("test_src", "test_bak")
+        manager.scan("test_src", "test_bak")
+        estimate = manager.dry_run()
+        self.assertEqual(estimate.bytes, 2_100_100)
+        self.assertEqual(estimate.files, 4)
+        self.assertEqual(estimate.counts["copy"], 2)
+        self.assertEqual(estimate.counts["delete"], 1)
+        self.assertEqual(
+            [count for count in estimate.histogram.values() if count],
+            [1, 1, 1],
+        )
+        self.assertTrue(os.path.exists("test_bak/removed.txt"))
+        self.assertEqual(manager.sync(), [])
+        model = CostModel.for_backup("test_bak")
+        self.assertEqual(len(model.runs), 1)
+        self.assertEqual(model.runs[0]["bytes"], 2_100_100)
+
+
+class TestContentStore(unittest.TestCase):
+    """Tests for the deduplicating content store."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src/folder", "test_bak"]:
+            os.makedirs(fld)
+        self.data = os.urandom(600_000)
+        with open("test_src/big.bin", "wb") as out:
+            out.write(self.data)
+        with open("test_src/folder/copy.bin", "wb") as out:
+            out.write(self.data)
+        with open("test_src/small.txt", "w", encoding="utf-8") as out:
+            out.write("small")
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_chunk_boundaries(self):
+        """Test that an insert only changes the chunks around it."""
+        chunks = set()
+        shifted = b"insert" + self.data
+        for data in (self.data, shifted):
+            start = 0
+            for end in chunk_boundaries(data):
+                self.assertLessEqual(end - start, 256 * 1024)
+                chunks.add((data is shifted, data[start:end]))
+                start = end
+            self.assertEqual(start, len(data))
+        original = {chunk for shifted, chunk in chunks if not shifted}
+        changed = {chunk for shifted, chunk in chunks if shifted}
+        self.assertGreater(len(original & changed), 0)
+
+    def test_deduplication(self):
+        """Test that identical files are stored once and restored intact."""
+        store = ContentStore("test_bak")
+        store.add("test_src", "")
+        self.assertEqual(store.stats()["stored_bytes"], 600_005)
+        self.assertEqual(store.stats()["deduplicated_bytes"], 600_000)
+        self.assertGreater(store.stats()["bloom_skips"], 0)
+        store.restore("folder", "test_bak/restored")
+        with open("test_bak/restored/copy.bin", "rb") as filein:
+            self.assertEqual(filein.read(), self.data)
+        self.assertTrue(store.remove("big.bin"))
+        self.assertEqual(store.collect_garbage(), 0)
+        self.assertTrue(store.remove("folder"))
+        self.assertEqual(store.collect_garbage(), 600_000)
+        self.assertEqual(
+            [name for name, _ in store.list_directory("")], ["small.txt"]
+        )
+        store.close()
+
+    def test_sweep_after_crash(self):
+        """Test that objects written before a crash are collected."""
+        store = ContentStore("test_bak")
+        store.add("test_src/small.txt", "small.txt")
+        digest = store._put_chunk(b"never committed")
+        path = store._object_path(digest)
+        self.assertTrue(os.path.exists(path))
+        store.connection.close()
+        store = ContentStore("test_bak")
+        self.assertTrue(store.unclean)
+        self.assertEqual(store.collect_garbage(), len(b"never committed"))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(
+            [name for name, _ in store.list_directory("")], ["small.txt"]
+        )
+        store.close()
+        store = ContentStore("test_bak")
+        self.assertFalse(store.unclean)
+        store.close()
+
+    def test_failed_add_keeps_old_version(self):
+        """Test that a file that cannot be read does not replace the old."""
+        store = ContentStore("test_bak")
+        store.add("test_src/small.txt", "small.txt")
+        with open("test_src/small.txt", "w", encoding="utf-8") as out:
+            out.write("a new version that cannot be read")
+
+        def failing(src):
+            raise OSError(errno.EIO, "Input/output error", src)
+
+        store._put_file = failing
+        with self.assertRaises(OSError):
+            store.add("test_src/small.txt", "small.txt")
+        self.assertTrue(store.unclean)
+        self.assertEqual(store.collect_garbage(sweep=False), 0)
+        store.restore("small.txt", "test_bak/restored.txt")
+        with open("test_bak/restored.txt", encoding="utf-8") as filein:
+            self.assertEqual(filein.read(), "small")
+        store.close()
+
+    def test_symlink_loop(self):
+        """Test that a link back to a parent folder is not followed."""
+        os.symlink("..", "test_src/folder/loop")
+        store = ContentStore("test_bak")
+        store.add("test_src", "")
+        self.assertEqual(
+            [name for name, _ in store.list_directory("folder")],
+            ["copy.bin"],
+        )
+        store.close()
+
+    def test_scan_and_sync(self):
+        """Test that a manager in store mode diffs against the manifest."""
+        manager = BackupManager("test_src", "test_bak", use_store=True)
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(len(manager.report["added_files"]), 3)
+        self.assertEqual(manager.sync(), [])
+        self.assertEqual(os.listdir("test_bak"), [METADATA_DIR])
+        with open("test_src/small.txt", "w", encoding="utf-8") as out:
+            out.write("SMALL")
+        os.remove("test_src/big.bin")
+        manager.shallow = False
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.report["mismatched_files"], ["small.txt"])
+        self.assertEqual(manager.report["removed_files"], ["big.bin"])
+        self.assertEqual(manager.report["matched_files"], ["folder/copy.bin"])
+        self.assertEqual(manager.update_files(), [])
+        self.assertEqual(manager.delete_files(), [])
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(len(manager.report["matched_files"]), 2)
+        manager.restore_stored("small.txt", "test_bak/restored.txt")
+        with open("test_bak/restored.txt", encoding="utf-8") as filein:
+            self.assertEqual(filein.read(), "SMALL")
+
+
+class TestSnapshots(unittest.TestCase):
+    """Tests for the hard-linked snapshot history."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src/folder", "test_bak"]:
+            os.makedirs(fld)
+        for path in ["same.txt", "changed.txt", "folder/moved.txt"]:
+            with open(f"test_src/{path}", "w", encoding="utf-8") as out:
+                out.write(path)
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_snapshots(self):
+        """Test that unchanged files are linked to the previous snapshot."""
+        manager = BackupManager("test_src", "test_bak", use_snapshots=True)
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.sync(), [])
+        first = manager.open_history().latest()
+        with open("test_src/changed.txt", "w", encoding="utf-8") as out:
+            out.write("new contents")
+        os.rename("test_src/folder/moved.txt", "test_src/moved.txt")
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(len(manager.report["moved_files"]), 1)
+        self.assertEqual(manager.sync(), [])
+        second = manager.open_history().latest()
+        self.assertNotEqual(first, second)
+        for path, linked in [
+            ("same.txt", True),
+            ("changed.txt", False),
+        ]:
+            self.assertEqual(
+                os.path.samefile(
+                    os.path.join(first, path), os.path.join(second, path)
+                ),
+                linked,
+            )
+        self.assertTrue(
+            os.path.samefile(
+                os.path.join(first, "folder/moved.txt"),
+                os.path.join(second, "moved.txt"),
+            )
+        )
+        self.assertFalse(
+            os.path.exists(os.path.join(second, "folder/moved.txt"))
+        )
+        with open(os.path.join(first, "changed.txt"), encoding="utf-8") as f:
+            self.assertEqual(f.read(), "changed.txt")
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(len(manager.report["matched_files"]), 3)
+
+    def test_thin(self):
+        """Test that thinning keeps one snapshot per period."""
+        stamps = [
+            datetime(2024, 1, 1, 10, 0),
+            datetime(2024, 1, 1, 10, 30),
+            datetime(2024, 1, 1, 11, 0),
+            datetime(2024, 1, 2, 9, 0),
+            datetime(2024, 1, 3, 9, 0),
+        ]
+        for stamp in stamps:
+            os.makedirs(os.path.join("test_bak", stamp.strftime(STAMP_FORMAT)))
+        history = SnapshotHistory(
+            "test_bak", {"hourly": 3, "daily": 2, "weekly": 0}
+        )
+        deleted = history.thin()
+        self.assertEqual(
+            sorted(os.path.basename(path) for path in deleted),
+            [
+                stamps[0].strftime(STAMP_FORMAT),
+                stamps[1].strftime(STAMP_FORMAT),
+            ],
+        )
+        self.assertEqual(len(history.snapshots()), 3)
+
+
+class TestSparseFiles(unittest.TestCase):
+    """Tests for copying and comparing sparse files."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(fld)
+        with open("test_src/disk.img", "wb") as out:
+            out.write(b"a" * 4096)
+            out.seek(8 * 1024 * 1024)
+            out.write(b"b" * 4096)
+        if not is_sparse(os.stat("test_src/disk.img"), "test_src/disk.img"):
+            self.skipTest("the filesystem does not support sparse files")
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_sparse_copy(self):
+        """Test that copies keep the holes and compare equal."""
+        manager = BackupManager("test_src", "test_bak")
+        manager.scan("test_src", "test_bak")
+        apparent, allocated = manager.report.size_summary()["added_files"]
+        self.assertEqual(apparent, 8 * 1024 * 1024 + 4096)
+        self.assertLess(allocated, 1024 * 1024)
+        self.assertEqual(manager.copy_added_files(), [])
+        copied = os.stat("test_bak/disk.img")
+        self.assertEqual(copied.st_size, apparent)
+        self.assertLess(allocated_size(copied), 1024 * 1024)
+        self.assertTrue(
+            extents_equal("test_src/disk.img", "test_bak/disk.img")
+        )
+        with open("test_bak/disk.img", "r+b") as out:
+            out.seek(8 * 1024 * 1024 + 100)
+            out.write(b"c")
+        self.assertFalse(
+            extents_equal("test_src/disk.img", "test_bak/disk.img")
+        )
+        manager.shallow = False
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.report["mismatched_files"], ["disk.img"])
+
+    def test_compressed_file_is_not_sparse(self):
+        """Test that a file with fewer blocks than bytes needs a hole."""
+        with open("test_src/packed.bin", "wb") as out:
+            out.write(b"a" * 64 * 1024)
+        stat_result = os.stat("test_src/packed.bin")
+        compressed = SimpleNamespace(
+            st_mode=stat_result.st_mode,
+            st_size=stat_result.st_size,
+            st_blocks=8,
+        )
+        self.assertTrue(is_sparse(compressed))
+        self.assertFalse(is_sparse(compressed, "test_src/packed.bin"))
+        self.assertTrue(
+            is_sparse(os.stat("test_src/disk.img"), "test_src/disk.img")
+        )
+
+
+class CorruptingCopier(VerifyingCopier):
+    """A VerifyingCopier whose copies go bad before they are read back."""
+
+    def read_back(self, path):
+        with open(path, "r+b") as out:
+            out.write(b"X")
+        return super().read_back(path)
+
+
+class TestVerifiedCopies(unittest.TestCase):
+    """Tests for copies checked against the data read from the source."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(fld)
+        with open("test_src/data.bin", "wb") as out:
+            out.write(os.urandom(3 * 1024 * 1024 + 17))
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_verified_copy(self):
+        """Test that copies are verified and their digests recorded."""
+        manager = BackupManager(
+            "test_src", "test_bak", verify_copies=True, durability=BATCHED
+        )
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.copy_added_files(), [])
+        cache = HashCache.for_backup("test_bak")
+        digest = file_digest("test_src/data.bin")
+        for path in ["test_src/data.bin", "test_bak/data.bin"]:
+            self.assertEqual(cache.lookup(path, os.stat(path)), digest)
+        cache.close()
+
+    def test_corrupt_copy(self):
+        """Test that a copy that does not read back intact fails."""
+        copier = CorruptingCopier()
+        with self.assertRaises(OSError):
+            copier.copy2("test_src/data.bin", "test_bak/data.bin")
+        self.assertFalse(os.path.exists("test_bak/data.bin"))
+        self.assertEqual(copier.stats()["mismatched"], 1)
+        for workers in (1, 2):
+            failed = copy_files_from_a_to_b(
+                "test_src",
+                "test_bak",
+                ["data.bin"],
+                workers=workers,
+                copy_function=CorruptingCopier().copy2,
+            )
+            self.assertEqual(failed, ["data.bin"])
+
+
+class TestScrubber(unittest.TestCase):
+    """Tests for scrubbing the backup folder for corrupt files."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src/b", "test_bak/b"]:
+            os.makedirs(fld)
+        self.files = ["a.txt", "b/c.txt", "b/d.txt", "e.txt"]
+        for root in ["test_src", "test_bak"]:
+            for path in self.files:
+                with open(f"{root}/{path}", "w", encoding="utf-8") as out:
+                    out.write(path * 100)
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_cursor(self):
+        """Test that sessions stop at their budget and resume after it."""
+        scrubber = Scrubber("test_bak", HashCache(), byte_budget=1000)
+        self.assertEqual(list(scrubber.files()), self.files)
+        self.assertEqual(list(scrubber.files("b/c.txt")), self.files[2:])
+        result = scrubber.run()
+        self.assertEqual(result.checked, 2)
+        self.assertFalse(result.finished_pass)
+        scrubber = Scrubber("test_bak", scrubber.hash_cache, byte_budget=1000)
+        self.assertEqual(scrubber.cursor, "b/c.txt")
+        result = scrubber.run()
+        self.assertEqual(result.checked, 2)
+        self.assertTrue(result.finished_pass)
+        self.assertEqual(scrubber.passes, 1)
+
+    def test_corrupt_file(self):
+        """Test that corrupt files are reported and can be copied again."""
+        manager = BackupManager("test_src", "test_bak")
+        self.assertEqual(manager.scrub().recorded, 4)
+        path = "test_bak/b/d.txt"
+        stat_result = os.stat(path)
+        with open(path, "r+b") as out:
+            out.write(b"X")
+        os.utime(path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+        result = manager.scrub()
+        self.assertEqual(result.problems, [("b/d.txt", CORRUPT)])
+        self.assertEqual(manager.report["errors"], ["b/d.txt"])
+        self.assertEqual(manager.report["mismatched_files"], ["b/d.txt"])
+        self.assertEqual(manager.update_files(), [])
+        self.assertEqual(manager.scrub().problems, [])
+
+
+class TestAttributes(unittest.TestCase):
+    """Tests for files whose contents match but attributes differ."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(fld)
+        for root in ["test_src", "test_bak"]:
+            for name in ["same.txt", "touched.txt"]:
+                with open(f"{root}/{name}", "w", encoding="utf-8") as out:
+                    out.write(name)
+        match_attributes("same.txt", "touched.txt")
+        os.chmod("test_src/touched.txt", 0o600)
+        os.utime("test_src/touched.txt", (1000000000, 1000000000))
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_attribute_files(self):
+        """Test that touched files are listed apart and fixed in place."""
+        for shallow in (True, False):
+            manager = BackupManager("test_src", "test_bak", shallow=shallow)
+            manager.scan("test_src", "test_bak")
+            self.assertEqual(
+                manager.report["attribute_files"], ["touched.txt"]
+            )
+            self.assertEqual(manager.report["mismatched_files"], [])
+            self.assertEqual(manager.report["matched_files"], ["same.txt"])
+        inode = os.stat("test_bak/touched.txt").st_ino
+        self.assertEqual(manager.sync_attributes(), [])
+        backup = os.stat("test_bak/touched.txt")
+        self.assertEqual(backup.st_ino, inode)
+        self.assertEqual(backup.st_mtime, 1000000000)
+        self.assertEqual(backup.st_mode & 0o777, 0o600)
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.report["attribute_files"], [])
+
+    def test_sync_selected_attributes(self):
+        """Test that syncing some files keeps the others listed."""
+        os.chmod("test_src/same.txt", 0o600)
+        manager = BackupManager("test_src", "test_bak")
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(
+            manager.report["attribute_files"], ["same.txt", "touched.txt"]
+        )
+        self.assertEqual(manager.sync_attributes(["touched.txt"]), [])
+        self.assertEqual(manager.report["attribute_files"], ["same.txt"])
+        self.assertEqual(
+            os.stat("test_bak/touched.txt").st_mode & 0o777, 0o600
+        )
+
+    def test_mtime_tolerance(self):
+        """Test that mtimes rounded by the backup filesystem still match."""
+        source = os.stat("test_src/same.txt").st_mtime_ns
+        rounded = (source // 2_000_000_000 + 1) * 2_000_000_000
+        os.utime("test_bak/same.txt", ns=(rounded, rounded))
+        manager = BackupManager("test_src", "test_bak", shallow=False)
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.report["matched_files"], ["same.txt"])
+        self.assertEqual(manager.report["attribute_files"], ["touched.txt"])
+
+    def test_plan(self):
+        """Test that a sync fixes attributes without copying files."""
+        manager = BackupManager("test_src", "test_bak")
+        manager.scan("test_src", "test_bak")
+        plan = plan_sync(manager.report, "test_bak")
+        self.assertEqual(plan.counts(), {METADATA: 1})
+        inode = os.stat("test_bak/touched.txt").st_ino
+        self.assertEqual(manager.sync(), [])
+        self.assertEqual(os.stat("test_bak/touched.txt").st_ino, inode)
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(
+            manager.report["matched_files"], ["same.txt", "touched.txt"]
+        )
+
+
+class TestCompareCache(unittest.TestCase):
+    """Tests for the bounded cache of comparison results."""
+
+    def setUp(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+        for fld in ["test_src", "test_bak"]:
+            os.makedirs(fld)
+        for root in ["test_src", "test_bak"]:
+            for name in ["a.txt", "b.txt"]:
+                with open(f"{root}/{name}", "w", encoding="utf-8") as out:
+                    out.write(name)
+
+    def tearDown(self):
+        shutil.rmtree("test_src/", ignore_errors=True)
+        shutil.rmtree("test_bak/", ignore_errors=True)
+
+    def test_eviction(self):
+        """Test that the least recently used result is evicted."""
+        cache = CompareCache(max_entries=2)
+        cache.store("a", True)
+        cache.store("b", False)
+        self.assertTrue(cache.lookup("a"))
+        cache.store("c", True)
+        self.assertIsNone(cache.lookup("b"))
+        self.assertFalse(cache.compare("d", lambda: False))
+        self.assertEqual(
+            cache.stats(),
+            {"hits": 1, "misses": 2, "evictions": 2, "entries": 2},
+        )
+
+    def test_deep_scans(self):
+        """Test that rescans reuse results until a file or folder changes."""
+        match_attributes("a.txt", "b.txt")
+        manager = BackupManager("test_src", "test_bak", shallow=False)
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.compare_cache.stats()["misses"], 2)
+        with open("test_src/b.txt", "a", encoding="utf-8") as out:
+            out.write("more")
+        with open("test_bak/b.txt", "a", encoding="utf-8") as out:
+            out.write("else")
+        manager.scan("test_src", "test_bak")
+        self.assertEqual(manager.report["matched_files"], ["a.txt"])
+        self.assertEqual(manager.report["mismatched_files"], ["b.txt"])
+        stats = manager.compare_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 3))
+        manager.set_directories("test_bak", "test_src")
+        self.assertEqual(manager.compare_cache.stats()["entries"], 0)
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.ERROR)
     unittest.main()